@@ -177,4 +177,111 @@ def readPT3(inputfile, numRecords):
             sys.stdout.write("\rProgress: %.1f%%" % (float(recNum)*100/float(numRecords)))
             sys.stdout.flush()
             
-    return dtime_array, truensync_array
\ No newline at end of file
+    return dtime_array, truensync_array
+
+T3WRAPAROUND = 65536
+
+
+def decodePT3(records, oflcorrection=0):
+    """Decode an array of PicoHarp T3 records.
+
+    Parameters
+    ----------
+    records : numpy.ndarray
+        uint32 records
+    oflcorrection : int
+        Overflow correction at the start of the records (in syncs), used to
+        decode a stream in blocks
+
+    Returns
+    -------
+    channel, dtime, truensync : numpy.ndarray
+        Channel, micro-time and overflow corrected sync number of each photon
+    markers : numpy.ndarray
+        (n_markers, 2) array with the sync number and marker bits of each
+        marker record
+    oflcorrection : int
+        Overflow correction at the end of the records
+    """
+    records = np.asarray(records, dtype=np.uint32)
+    channel = (records >> 28).astype(np.uint8)
+    dtime = ((records >> 16) & 0xFFF).astype(np.uint16)
+    nsync = (records & 0xFFFF).astype(np.int64)
+    special = channel == 0xF
+    overflow = special & (dtime == 0)
+    truensync = np.cumsum(overflow, dtype=np.int64)
+    truensync *= T3WRAPAROUND
+    truensync += oflcorrection
+    if len(truensync):
+        oflcorrection = int(truensync[-1])
+    truensync += nsync
+    is_marker = special & ~overflow
+    markers = np.stack((truensync[is_marker], dtime[is_marker].astype(np.int64)),
+                       axis=1)
+    photons = ~special
+    n_illegal = np.count_nonzero(photons & ((channel == 0) | (channel > 4)))
+    if n_illegal:  # Should not occur
+        print("Illegal Channel in %d records" % n_illegal)
+    return channel[photons], dtime[photons], truensync[photons], markers, oflcorrection
+
+
+def readPT3_fast(inputfile, numRecords=-1):
+    """Read and decode PicoHarp T3 records from a file, vectorized.
+
+    Reads numRecords records (all remaining if -1) from the current position
+    of inputfile, that can be an open file or a filename.
+
+    Returns
+    -------
+    dtime_array, truensync_array, channel_array : numpy.ndarray
+        Micro-time, overflow corrected sync number and channel of each photon
+    markers : numpy.ndarray
+        (n_markers, 2) array with the sync number and marker bits of each
+        marker record
+    """
+    records = np.fromfile(inputfile, dtype='<u4', count=numRecords)
+    if numRecords >= 0 and len(records) < numRecords:
+        print("The file ended earlier than expected, at record %d/%d."
+              % (len(records), numRecords))
+    channel, dtime, truensync, markers, _ = decodePT3(records)
+    return dtime, truensync, channel, markers
+
+
+class PT3StreamDecoder:
+    """Incremental decoder of a PicoHarp T3 record stream.
+
+    Keeps the overflow correction between blocks, so records can be decoded
+    as they are read from the device. If `keep` is True, decoded photons
+    and markers are also accumulated and can be retrieved with `arrays`.
+    """
+
+    def __init__(self, keep=True):
+        self.keep = keep
+        self.reset()
+
+    def reset(self):
+        self.oflcorrection = 0
+        self.numRecords = 0
+        self._blocks = []
+
+    def decode(self, records):
+        """Decode a block of records.
+
+        Returns
+        -------
+        channel, dtime, truensync, markers : numpy.ndarray
+            See `decodePT3`
+        """
+        channel, dtime, truensync, markers, self.oflcorrection = decodePT3(
+            records, self.oflcorrection)
+        self.numRecords += len(records)
+        if self.keep:
+            self._blocks.append((dtime, truensync, channel, markers))
+        return channel, dtime, truensync, markers
+
+    def arrays(self):
+        """Return all the decoded data, as returned by `readPT3_fast`."""
+        if not self._blocks:
+            return (np.zeros((0,), np.uint16), np.zeros((0,), np.int64),
+                    np.zeros((0,), np.uint8), np.zeros((0, 2), np.int64))
+        return tuple(np.concatenate(column) for column in zip(*self._blocks))
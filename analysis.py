@@ -56,10 +56,6 @@ from tkinter import Tk, filedialog
 from datetime import date, datetime
 import numpy as np
 import imageio as iio
-from scipy import optimize as opt
-from scipy.interpolate import interp1d
-from scipy.signal import savgol_filter
-from scipy import ndimage as ndi
 import matplotlib.pyplot as plt
 
 import pyqtgraph as pg
@@ -73,6 +69,10 @@ import tools.tools as tools
 import gui.AnalysisDesign
 import qdarkstyle
 from tools.lineprofile import linePlotWidget
+from tools.analysis import MinFluxLocator, window_counts
+from tools.PSF_tools import zoom_shift_sum, PolyPSFFitter
+import tools.lifetime as lifetime
+import tools.psf_cache as psf_cache
 
 π = np.pi
 donutmarker = [[29, 112, 183], [243, 170, 80], [128, 128, 128], [255, 237, 0]]
@@ -489,6 +489,7 @@ class Backend(QtCore.QObject):
         self.ABS_TIME_CONVERSION = 1.0*10**(-3) #convert absTime to s
         self.size = None
         self.pxexp = None
+        self._locator = None  # built on demand from self.PSF
         
     def emit_param(self):
         
@@ -582,6 +583,47 @@ class Backend(QtCore.QObject):
         self.pxexp = float(pxex) * 1000.0 # convert to nm
         print('[analysis] psf image pixel size [nm]:', self.pxexp)
     
+        # fits are cached, keyed by everything they depend on. The key is
+        # computed before crop_window is converted to interpolated pixels
+        key = psf_cache.make_key(
+            psf=psf_cache.array_digest(self.psfexp),
+            drift=psf_cache.file_digest(drift_file),
+            pxexp=self.pxexp, PX=self.PX, k=self.k,
+            crop=[float(c) for c in self.crop_window])
+        cache = psf_cache.PSFCache.for_file(self.psffilename)
+        cached = cache.load(key)
+        if cached is not None:
+            self.PSF = cached['PSF']
+            self.x0 = cached['x0']
+            self.y0 = cached['y0']
+            self.aopt = cached['aopt']
+            self.crop_window[:] = [int(c) for c in cached['crop_window']]
+            self.size = np.size(self.PSF, axis = 1)
+            self.index = np.zeros((self.k,2))
+            print(datetime.now(), '[analysis] PSF fit loaded from cache')
+        else:
+            self._fit_psf_data(drift_file)
+            cache.store(key, PSF=self.PSF, x0=self.x0, y0=self.y0,
+                        aopt=self.aopt, crop_window=np.array(self.crop_window))
+
+#        #use code for swapping PSF order
+#        psfTc[0,:,:] = self.PSF[0, :, :]
+#        self.PSF[0, :, :] = self.PSF[1, :, :]
+#        self.PSF[1, :, :] = psfTc[0,:,:]
+#        psfTc[0,:,:] = self.PSF[2, :, :]
+#        self.PSF[2, :, :] = self.PSF[3, :, :]
+#        self.PSF[3, :, :] = psfTc[0,:,:]
+        
+        self._locator = None
+        self.emit_param()
+        self.sendPsffitSignal.emit(self.PSF, self.x0, self.y0)
+
+    def _fit_psf_data(self, drift_file):
+        """Interpolate, drift correct and fit the experimental PSFs.
+
+        Sets PSF, x0, y0, aopt, size and index, and converts crop_window to
+        interpolated pixels.
+        """
         # open txt file with xy drift data
         coord = np.loadtxt(drift_file, unpack=True)
         
@@ -600,18 +642,15 @@ class Backend(QtCore.QObject):
         # initial frame of each PSF
         fi = fxpsf*np.arange((self.k+1))  
         
-        # interpolation to have 1 nm px and realignment with drift data
-        psf = np.zeros((frames, sizepsf, sizepsf))        
-        for i in np.arange(frames):
-            psfz = ndi.interpolation.zoom(self.psfexp[i,:,:], self.pxexp)
-            deltax = coord[1, i] - coord[1, 0]
-            deltay = coord[2, i] - coord[2, 0]
-            psf[i, :, :] = ndi.interpolation.shift(psfz, [deltax, deltay])
-        
-        # sum all interpolated and re-centered images for each PSF
-        psfT = np.zeros((frames//fxpsf, sizepsf, sizepsf))
-        for i in np.arange(self.k):
-            psfT[i, :, :] = np.sum(psf[fi[i]:fi[i+1], :, :], axis = 0)
+        # interpolation to have 1 nm px and realignment with drift data,
+        # summing all interpolated and re-centered images for each PSF.
+        # Frames after the last complete PSF are skipped (group -1)
+        shifts = np.column_stack((coord[1, :frames] - coord[1, 0],
+                                  coord[2, :frames] - coord[2, 0]))
+        groups = np.searchsorted(fi, np.arange(frames), side='right') - 1
+        groups[groups >= self.k] = -1
+        psfT = zoom_shift_sum(self.psfexp, self.pxexp, shifts, groups, self.k,
+                              (sizepsf, sizepsf), os.cpu_count() or 1)
             
         # crop borders to avoid artifacts
         #selected ROI windwow from GUI has pixel size pxexp compared to 
@@ -638,18 +677,18 @@ class Backend(QtCore.QObject):
         self.index = np.zeros((self.k,2))
         self.aopt = np.zeros((self.k,27))
             
+        # poly_func is linear in the coefficients and (x0, y0) only sets the
+        # expansion point, so all donuts are fitted at once by least squares,
+        # expanded around the minimum of each PSF
         print('[analysis] Fitting loop started')
+        centers = np.zeros((self.k, 2))
         for i in np.arange(self.k): 
-            # initial values for fit parameters x0,y0 and c00
             ind1 = np.unravel_index(np.argmin(psfTc[i, :, :], 
                 axis=None), psfTc[i, :, :].shape)
-            x0i = x[ind1]
-            y0i = y[ind1]
-            c00i = np.min(psfTc[i, :, :])     
-            p0 = [x0i, y0i, c00i, 0 ,1, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 
-                  0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-            print('fit started')
-            self.aopt[i,:], cov = opt.curve_fit(self.poly_func, (x,y), psfTc[i, :, :].ravel(), p0)   
+            centers[i] = x[ind1], y[ind1]
+        coeffs = PolyPSFFitter(x, y, 4).fit(psfTc[:self.k], centers)
+        for i in np.arange(self.k): 
+            self.aopt[i,:] = np.concatenate((centers[i], coeffs[i].ravel()))
             q = self.poly_func((x,y), *self.aopt[i,:])   
             self.PSF[i, :, :] = np.reshape(q, (self.size, self.size))
             # find min value for each fitted function (EBP centers)
@@ -658,17 +697,6 @@ class Backend(QtCore.QObject):
             self.x0[i] = ind[0]
             self.y0[i] = ind[1]
             print(datetime.now(), '[analysis]', str(i+1), '/', str(self.k), ' donuts fitted')
-       
-#        #use code for swapping PSF order
-#        psfTc[0,:,:] = self.PSF[0, :, :]
-#        self.PSF[0, :, :] = self.PSF[1, :, :]
-#        self.PSF[1, :, :] = psfTc[0,:,:]
-#        psfTc[0,:,:] = self.PSF[2, :, :]
-#        self.PSF[2, :, :] = self.PSF[3, :, :]
-#        self.PSF[3, :, :] = psfTc[0,:,:]
-        
-        self.emit_param()
-        self.sendPsffitSignal.emit(self.PSF, self.x0, self.y0)
 
 
     @pyqtSlot()
@@ -702,6 +730,11 @@ class Backend(QtCore.QObject):
         #convert absTime to s, relTime already given in ns
         self.abs_time = coord[1, :] * self.ABS_TIME_CONVERSION
         self.rel_time = coord[0, :] - shift
+        # windows are located by binary search on the macro-times
+        if np.any(np.diff(self.abs_time) < 0):
+            order = np.argsort(self.abs_time, kind='stable')
+            self.abs_time = self.abs_time[order]
+            self.rel_time = self.rel_time[order]
 #        vecmax = np.max(self.rel_time)
 #        print(vecmax)
 #        for i in range(self.rel_time.shape[0]):
@@ -731,6 +764,7 @@ class Backend(QtCore.QObject):
         print(datetime.now(), '[analysis] PSF fit received in backend.')
         self.PSF = np.zeros((self.k, psffit_array.shape[1], psffit_array.shape[2]))
         self.PSF = psffit_array
+        self._locator = None
         self.read_parameterfile()
         
         self.sendPsffitSignal.emit(self.PSF, self.x0, self.y0)
@@ -779,21 +813,15 @@ class Backend(QtCore.QObject):
             tfabs = ontimes[1]
             num_windows = int((tfabs - tiabs) / self.NP_binning)
             timeON = np.zeros(2*num_windows)
-            for i in np.arange(0, 2*num_windows, 2):
-                timeON[i] = tiabs
-                tiabs = tiabs + self.NP_binning
-                timeON[i+1] = tiabs
+            timeON[0::2] = tiabs + self.NP_binning * np.arange(num_windows)
+            timeON[1::2] = timeON[0::2] + self.NP_binning
             timeON[-1] = tfabs
             
         elif mode == 'Origami (manual)':
             timeON = ontimes
         
         elif mode == 'Origami (auto)':
-#            [T, bwt] = self.trace_seg(self.abs_time)
-            [T, bwt] = [10, 0.005] #self.trace_seg(self.abs_time)
-            #TODO: soft-code scaling factors
-            bwt = 10*bwt
-            T = 5*T
+            T, bwt = self.trace_seg(self.abs_time)
             nbinsopt = int((np.max(self.abs_time)/bwt))
             seqbin, times = np.histogram(self.abs_time, bins=nbinsopt)
             
@@ -803,51 +831,46 @@ class Backend(QtCore.QObject):
             ax1.legend(['bin width = ' + str(bwt), 'T = ' + str(T)], loc='upper right')
             
             mask = seqbin>T
-            indexes = np.argwhere(np.diff(mask)).squeeze()
-            timeON = times[indexes[1:]]           
+            # ON segments go from the bin edge where the mask switches on to
+            # the one where it switches off, also if the trace starts ON
+            change = np.diff(np.concatenate(([False], mask, [False])).astype(int))
+            timeON = np.empty(2 * np.count_nonzero(change == 1))
+            timeON[0::2] = times[change == 1]
+            timeON[1::2] = times[change == -1]
             print(timeON)
             print('Threshold:', T, 'Binwidth:', bwt)
         
         self.timeON = timeON
-        number = len(timeON)
-        t = {}
-        absTimeON = {}
-        self.relTimeON = {}
-        
-        for i in np.arange(0, number, 2):
-            j = i//2
-            t[i] = (timeON[i] < self.abs_time) & (self.abs_time < timeON[i+1])
-            absTimeONp = self.abs_time * t[i]
-            #changed fron relTime... to not exclude rel. times exactly equal to 0.000...
-            absTimeON[j] = self.abs_time[np.nonzero(absTimeONp)]
-            self.relTimeON[j] = self.rel_time[np.nonzero(absTimeONp)] 
-            
-        Nsegments = len(absTimeON)                
-        Tot = Nsegments
-        n = np.zeros((Tot, 4))
+        starts = timeON[0:-1:2]
+        stops = timeON[1::2]
+        gate_starts = self.τ + self.lifetime_win_i
+        gate_stops = gate_starts + self.lifetime_win_f
+        # (windows, k) photon counts in a single pass over the photons
+        n, lo, hi = window_counts(self.abs_time, self.rel_time, starts, stops,
+                                  gate_starts, gate_stops)
+        self.relTimeON = [self.rel_time[l:h] for l, h in zip(lo, hi)]
+
+        Tot = len(n)
         self.pos = np.zeros((Tot, 2))
-        indrec = np.zeros((Tot, 2))    
-        self.N = np.zeros(Tot)
+        indrec = np.zeros((Tot, 2))
+        self.N = n.sum(axis=1).astype(float)
+        # time length of each trace segment, 0 if empty
+        signal = hi - lo
         deltaT = np.zeros(Tot)
-        
-        
-        for i in np.arange(Tot):
-            n[i, :] = self.n_minflux(self.relTimeON[i])
-            self.N[i] = np.sum(n[i, :])
-            
-            #calculate time length of selected trace segment
-            deltaT[i] = absTimeON[i][-1] - absTimeON[i][0]
-
-            #check if above min. time length and photon threshold
-            if deltaT[i] > self.deltaTmin:
-                if self.N[i] > self.Nmin:
-                    signal = self.relTimeON[i].shape[0]
-                    [indrec[i,:], self.pos[i, :], Ltot] = self.pos_minflux(n[i, :], deltaT[i], signal)
-                else:
-                    print(datetime.now(), '[analysis] Time window', str(i), ' neglected as it contains too few photons')
-            else:
-                print(datetime.now(), '[analysis] Time window', str(i), ' neglected as too short')
-        
+        full = signal > 0
+        deltaT[full] = self.abs_time[hi[full] - 1] - self.abs_time[lo[full]]
+
+        # check if above min. time length and photon threshold
+        for i in np.flatnonzero(deltaT <= self.deltaTmin):
+            print(datetime.now(), '[analysis] Time window', str(i), ' neglected as too short')
+        for i in np.flatnonzero((deltaT > self.deltaTmin) & (self.N <= self.Nmin)):
+            print(datetime.now(), '[analysis] Time window', str(i), ' neglected as it contains too few photons')
+        valid = np.flatnonzero((deltaT > self.deltaTmin) & (self.N > self.Nmin))
+        Ltot = np.zeros((0, 0))  # likelihood of the last valid window
+        if len(valid):
+            [indrec[valid], self.pos[valid], Ltot] = self.pos_minflux_batch(
+                n[valid], deltaT[valid], signal[valid])
+
         self.positionSignal.emit(indrec, self.pos, Ltot, self.N)
 
     def n_minflux(self, reltimes_i):
@@ -899,37 +922,57 @@ class Backend(QtCore.QObject):
             
         """
         # FOV size
-        norm_psf = np.sum(self.PSF, axis = 0)
         self.size = np.size(self.PSF, axis = 1)
         
-        # probabilitiy vector 
-        p = np.zeros((self.k, self.size, self.size))
-        
         #calculate sbr from background in kHz, num of photons in win and window length
         #convert signal from counts to kHz
         signal = signal/(deltaT*1000)
         sbr = signal / self.bkg
         print('[analysis] SBR', np.round(sbr,1))
 
-        for i in np.arange(self.k):        
-            p[i,:,:] = (sbr/(sbr + 1)) * self.PSF[i,:,:]/norm_psf + (1/(sbr + 1)) * (1/self.k)
-    
-    #    else:        
-    #    for i in np.arange(K):
-    #        p[i,:,:] = PSF[i,:,:]/normPSF
-                    
-        # likelihood function
-        like = np.zeros((self.k, self.size, self.size))
-        for i in np.arange(self.k):
-            like[i, :, :] = n[i] * np.log(p[i, : , :])        
-        like_tot = np.sum(like, axis = 0)
-        
-        # maximum likelihood estimator for the position    
-        indrec = np.unravel_index(np.argmax(like_tot, axis=None), like_tot.shape)
+        # the locator caches the normalized PSF and the probability grids,
+        # so only the likelihood is computed for each window
+        if self._locator is None:
+            self._locator = MinFluxLocator(self.PSF, sbr, self.PX)
+        indrec, _, like_tot = self._locator(n, sbr)
         pos_estimator = self.index_to_space(indrec)
         
         return indrec, pos_estimator, like_tot
     
+    def pos_minflux_batch(self, n, deltaT, signal):
+        """
+        MINFLUX position estimator (using ML) for many trace segments at once
+
+        Inputs
+        ----------
+        n : (M, k) array with photon numbers corresponding to each exposure
+        deltaT: (M,) array with the length in s of each trace segment
+        signal: (M,) array with the total number of photons in each segment
+
+        Returns
+        -------
+        indrec : (M, 2) array, position estimators in index coordinates (MLE)
+        pos_estimator : (M, 2) array, position estimators (MLE)
+        like_tot : Likelihood function of the last segment
+
+        """
+        self.size = np.size(self.PSF, axis = 1)
+
+        #convert signal from counts to kHz
+        sbr = signal/(deltaT*1000) / self.bkg
+        print('[analysis] SBR', np.round(sbr,1))
+
+        if self._locator is None:
+            self._locator = MinFluxLocator(self.PSF, sbr[0], self.PX)
+        positions = self._locator.locate_batch(n, SBR=sbr)
+        # back to grid indices, as returned by the single window locator
+        indrec = np.rint(positions / self._locator.step_nm
+                         + self._locator.size / 2)
+        pos_estimator = np.array([self.index_to_space(i) for i in indrec])
+        _, _, like_tot = self._locator(n[-1], sbr[-1])
+
+        return indrec, pos_estimator, like_tot
+
     def save_psffit(self):
             
         root = os.path.splitext(self.psffilename)[0]
@@ -1030,172 +1073,99 @@ class Backend(QtCore.QObject):
         print(datetime.now(), '[analysis] Saved Results')
         
     def find_lifetime(self):
-                
-        self.fitarray = []
-        for i in np.arange(len(self.relTimeON)):
-            self.fitarray = np.concatenate((self.fitarray, self.relTimeON[i]))
-        
+        """
+        Lifetime of the ON segments (Poisson MLE)
+
+        The decay after the brightest excitation pulse is fitted with a
+        mono-exponential convolved with a gaussian IRF, on a log-binned
+        histogram of all the ON segments. Each ON window is then fitted with
+        the same IRF, background and tail fractions (self.lifetimes).
+        """
+        if len(self.relTimeON):
+            self.fitarray = np.concatenate(self.relTimeON)
+        else:
+            self.fitarray = np.zeros(0)
+
+        # fit range: from the rise of the brightest pulse to the rise of the
+        # next one
+        pulses = np.sort(self.τ)
+        which = np.searchsorted(pulses, self.fitarray, 'right') - 1
+        j = int(np.argmax(np.bincount(which[which >= 0], minlength=len(pulses))))
+        t_next = pulses[j + 1] if j + 1 < len(pulses) else np.max(self.fitarray)
+        margin = min(1.0, (t_next - pulses[j]) / 4)
+        t_start = pulses[j] - margin
+        t_stop = t_next - margin if j + 1 < len(pulses) else t_next
+        edges = lifetime.log_bins(t_start, t_stop, 64, 0.01)
+        counts = np.histogram(self.fitarray, bins=edges)[0]
+
+        # previous pulses leave an exponential tail in the range
+        fit = lifetime.fit_decay(counts, edges, tail=len(pulses) > 1)
+        self.lifetime_fit = fit
+        print(datetime.now(), '[analysis] Optimization parameter:', fit.params)
+        print(datetime.now(), '[analysis] Lifetime:', fit.params['tau'], '+-', fit.errors['tau'])
+
+        # one lifetime per ON window
+        hist = lifetime.window_histograms(self.abs_time, self.rel_time,
+                                          self.timeON[0:-1:2], self.timeON[1::2],
+                                          edges)
+        self.lifetimes, self.lifetime_errors = lifetime.window_lifetimes(
+            hist, edges, fit.params['t0'], fit.params['sigma'],
+            fit.background_fraction, fit.tail_fraction)
+        print(datetime.now(), '[analysis] Window lifetimes:', np.round(self.lifetimes, 2))
 
-        # inter-photon times histogram 
-        nbins = int((np.max(self.abs_time)/self.tcspc_binning))
-        counts, bin_edges = np.histogram(self.fitarray, bins = nbins) 
-        x = np.ediff1d(bin_edges) + bin_edges[:-1]
-        
-        
-        # exponential fit of the ipt histogram
-        def single_exp(t, a, b, offset, t0):
-            return (a * np.exp(b * (t-t0)) + offset)
-        
-        x = x[np.argmax(counts):]
-        counts = counts[np.argmax(counts):]
-        
-        xx = np.linspace(x.min(), x.max(), nbins)
-        
-        # interpolate + smooth
-        itp = interp1d(x,counts, kind='linear')
-        window_size, poly_order = 101, 3
-        yy_sg = savgol_filter(itp(xx), window_size, poly_order)
-        
         #plot histogram
+        widths = np.diff(edges)
+        centers = edges[:-1] + widths / 2
         fig, ax = plt.subplots()
-        ax.plot(x, counts, label='Raw data')
-        ax.plot(xx, yy_sg, label='Filtered')
+        ax.semilogy(centers, counts / widths, '.', label='Data')
+        ax.semilogy(centers, fit.expected() / widths, label='Fit')
         ax.set_title('Rel-time histogram of ON-interval')
         ax.set_xlabel('Time in ns')
-        ax.set_ylabel('counts')
-        
-        #fit
-        lifetguess = -1.0
-        offsetguess = np.median(yy_sg)
-        aguess = np.max(yy_sg) - offsetguess
-        t0 = x[np.argmax(yy_sg)]
-        
-        p0 = [aguess, lifetguess, offsetguess, t0]
-        
-        start = np.argmax(yy_sg) + 10
-        end = start + 100
-        
-        xnew = xx[start:end]
-        ynew = yy_sg[start:end]
-        
-        p, cov = opt.curve_fit(single_exp, xnew, ynew, p0)
-        
-        print(datetime.now(), '[analysis] Optimization parameter:', p, cov)
-        print(datetime.now(), '[analysis] Lifetime guess:', -1/p[1], '+-', np.abs(1/p[1]**2 *cov[1,1]))
+        ax.set_ylabel('counts / ns')
+        ax.legend()
 
-        
         fig, ax = plt.subplots()
-        ax.plot(xnew, ynew)
-        ax.plot(xnew, single_exp(xnew, *p))
-   
-            
+        ax.errorbar(np.arange(len(self.lifetimes)), self.lifetimes,
+                    self.lifetime_errors, fmt='o')
+        ax.set_xlabel('Window')
+        ax.set_ylabel('Lifetime in ns')
+
     def trace_seg(self, absTime):
-        #TODO: NEEDS TO BE FULLY AUTOMATED
         """    
         Trace segmentation in case of blinking
         Find optimal bin width and threshold
         (Adapted from F.D. Stefani PhD Thesis)
             
+        The inter-photon times are fitted with ON and OFF exponentials
+        (Poisson MLE on a log-binned histogram) and the bin width and
+        threshold that misclassify the fewest bins are chosen (see
+        tools.lifetime.segmentation_threshold).
+
         Inputs
         ----------
         absTime : time tags of detected photons (macro time)
     
         Returns
         -------
+        T : threshold (a bin is ON if it holds more than T photons)
         bw : optimal bin width
-        T : threshold
-        
-        Parameters
-        ----------
-        bwmin, bwmax : boundaries for bw
-        Tamx : max threshold
            
         """
-        # compute inter-photon times (in absTime units)
-        ipt = np.ediff1d(absTime)
-        size = len(ipt)
-        binsipt = int(np.sqrt(size))
-        # inter-photon times histogram 
-        [y, bin_edges] = np.histogram(ipt, bins=binsipt)
-        x = np.ediff1d(bin_edges) + bin_edges[:-1]
-        
-        ind = np.min(np.where(y<0.01)) 
-        x = x[0:ind]
-        y = y[0:ind]
-        # double exponential fit of the ipt histogram
-        def double_exp(t, a1, a2, b1, b2, offset):
-            return a1 * np.exp(b1 * t) + a2 * np.exp(b2 * t) + offset
-        
-        #TODO: write add initial guess for optimization
-        p,cov = opt.curve_fit(double_exp, x, y)
-        
-        # ON and OFF parameters from fit
-        Ion = -np.min(p[2:4])
-        Ioff = -np.max(p[2:4])
-        Aon = np.max(p[0:2])
-        Aoff = np.min(p[0:2])
-        
+        fit = lifetime.fit_ipt(absTime)
+        T, bwt, error = lifetime.segmentation_threshold(absTime, fit=fit)
+
         fig, ax = plt.subplots()
-        ax.plot(x, y)
-        lifelabel = 'τ_on = ' + str(1/Ion*10**(6)) + ' +/- ' + str(1/cov[3, 3]*10**(6)) + ' ns'
-        ax.plot(x, double_exp(x, *p), label = lifelabel)
-        ax.set_xlabel('t [ms]')
+        centers = np.sqrt(fit.edges[:-1] * fit.edges[1:])
+        ax.loglog(centers, fit.counts, '.')
+        lifelabel = ('I_on = ' + str(np.round(fit.rate_on)) + ' Hz, I_off = '
+                     + str(np.round(fit.rate_off)) + ' Hz')
+        ax.loglog(centers, fit.expected(), label = lifelabel)
+        ax.set_xlabel('t [s]')
         ax.set_ylabel('counts')
+        ax.legend()
         print(lifelabel)
-         
-        # minimum bin width
-#        bwmin = 2*(np.max(absTime)/len(absTime))  
-#        ordermin = int(-np.log10(bwmin))
-        
-        # bw boundaries
-        bwmin = 0.001
-        bwmax = 0.005
-        
-        # iterations over bw and over threshold T    
-        for i in np.arange(bwmin, bwmax, 0.0001):
-      
-            bwt = i     
-            # average ON and OFF times
-            Ton = Aon/(Ion*(1-np.exp(-Ion*bwt)))
-            Toff = Aoff/(Ioff*(1-np.exp(-Ioff*bwt)))
-            # bins on and off
-            bon = Ton/bwt
-            boff = Toff/bwt
-            
-    #        # maximum threshold for a given bw
-    #        Tmax = Ion * bwt
-            # Pon and Poff functions
-            def P(n, I, b):
-                
-                a = (((I*b)**n)*np.exp(-I*b))
-                b = np.math.factorial(n)
-         
-                r = (a/b)
-                
-                return r
-            # maximum threshold for a given bw
-            Tmax = 30000 #Tmax
-            for j in np.arange(0, int(Tmax), 1):
-            
-                T = j 
-                Pon = np.zeros(T+1)
-                Poff = np.zeros(T+1)
-                
-                for n in np.arange(0, T+1, 1):
-                    Pon[n] = P(n, Ion, bwt)
-                    Poff[n] = P(n, Ioff, bwt)
-                
-                PonT = np.sum(Pon)
-                PoffT = np.sum(Poff)
-                # evaluate wrong bins for a given bw and T
-                Wb = bon*PonT + boff*(1-PoffT)
-    #            print(Wb)
-    #        
-                if Wb <0.0000001:
-                    break
-            if Wb <0.000001:
-                break 
-    
+        print('Expected fraction of wrong bins:', error)
+
         return T, bwt
     
     def poly_func(self, grid, x0, y0, c00, c01, c02, c03, c04, c10, c11, c12, c13, c14, 
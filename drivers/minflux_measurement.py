@@ -8,9 +8,11 @@ Created on Thu Aug 29 09:58:46 2024
 
 import TimeTagger
 import numpy as np
-import numba
 import time
 import logging as _lgn
+from collections import deque as _deque
+
+from tools import gating as _gating
 
 
 _lgr = _lgn.getLogger(__name__)
@@ -19,33 +21,65 @@ _lgr = _lgn.getLogger(__name__)
 _lgn.getLogger("numba").setLevel(_lgn.WARNING)
 
 
+# Default number of ring buffer slots handed to the callback
+_N_SLOTS = 8
+# Default micro-time histogram resolution in ps
+_HIST_RESOLUTION = 100
+
+
 class MinfluxMeasurement(TimeTagger.CustomMeasurement):
-    """Swabian measurement that returns localizations."""
+    """Swabian measurement that returns localizations.
+
+    Each block of tags is processed in a single numba pass that extracts time
+    differences, bins them into gates and accumulates a micro-time histogram
+    per detector.
+
+    Gates are described by a `tools.gating.GateTable`, that allows any number
+    of gates and detectors. If none is given, the original 4 gates layout
+    is built from `delays` for `APD_channel`.
+
+    If `copy_data` is False, the callback receives views into a ring of
+    `n_slots` preallocated buffers instead of copies. The consumer owns the
+    slot until it hands the `bins` array back with `release`. When no slot is
+    free (the consumer is lagging), the block is passed as a copy instead and
+    counted in `n_overruns`, so unread data is never overwritten.
+    """
 
-    _delays = np.empty((0,), dtype=np.int32)
+    _delays = np.empty((0,), dtype=np.int64)
     _bins = np.zeros((4,), dtype=np.int64)
     _errors: int = 0
+    _overruns: int = 0
     _last_time: int = 0
 
     def __init__(self, tagger, APD_channel, laser_channel, period, max_events,
-                 delays, callback, other_channels: int = None):
+                 delays, callback, other_channels: int = None,
+                 copy_data: bool = True, n_slots: int = _N_SLOTS,
+                 hist_resolution: int = _HIST_RESOLUTION,
+                 gates: _gating.GateTable = None):
         super().__init__(tagger)
         self._APD_channel = APD_channel
         self._laser_channel = laser_channel
         self._period = period
         self._max_events = max_events
-        # Hacemos la cuenta de los delays como vamos a calcularlos después
         # Exigimos que los delays estén ordenados. No los ordenamos acá para
         # forzar al caller a hacer bien
-        if sorted(delays) != list(delays):
-            raise ValueError("Delays are not sorted")
-        self.shutter_delays = period - np.array(delays, dtype=np.int64)
+        if gates is None:
+            gates = _gating.GateTable.from_delays(delays, period, (APD_channel,))
+        elif gates.period != period:
+            raise ValueError("Gate table period does not match")
+        self._gates = gates
+        self._apd_channels = np.array(gates.channels, dtype=np.int64)
         self._cb = callback
+        self._copy_data = copy_data
+        self._n_slots = max(int(n_slots), 1)
+        self._hist_resolution = int(hist_resolution)
+        self._n_hist_bins = -(-int(period) // self._hist_resolution)
 
         # The method register_channel(channel) activates
         # data transmission from the Time Tagger to the PC
         # for the respective channels.
-        self.register_channel(channel=APD_channel)
+        for channel in gates.channels:
+            self.register_channel(channel=channel)
         self.register_channel(channel=laser_channel)
         if other_channels is not None:
             self.register_channel(channel=other_channels)
@@ -69,12 +103,61 @@ class MinfluxMeasurement(TimeTagger.CustomMeasurement):
     #     with self.mutex:
     #         return self._delays[:self._last_pos].copy()
 
+    @property
+    def gates(self) -> _gating.GateTable:
+        """Gate table in use."""
+        return self._gates
+
+    def get_histogram(self) -> np.ndarray:
+        """Return a copy of the accumulated micro-time histograms.
+
+        One row per detector channel. Bin `i` holds the photons with (folded) micro-times in
+        [i * hist_resolution, (i + 1) * hist_resolution) ps.
+        """
+        with self.mutex:
+            return self._histogram.copy()
+
+    @property
+    def n_errors(self) -> int:
+        """Total number of error tags received since last clear."""
+        return self._errors
+
+    @property
+    def n_overruns(self) -> int:
+        """Number of blocks copied because no ring slot was free."""
+        return self._overruns
+
+    def release(self, bins: np.ndarray):
+        """Return a ring slot to the measurement.
+
+        Parameters
+        ----------
+        bins : numpy.ndarray
+            The `bins` array received by the callback. Must be released only
+            once. Copies and slots of a previous (cleared) ring are ignored.
+        """
+        ring = self._ring_bins
+        offset = bins.__array_interface__['data'][0] - ring.__array_interface__['data'][0]
+        slot, rem = divmod(offset, ring.strides[0])
+        if rem == 0 and 0 <= slot < self._n_slots:
+            self._free_slots.append(slot)
+
     def clear_impl(self):
         """Reset."""
         # The lock is already acquired within the backend.
         self._last_time = 0
-        self._delays = np.empty(self._max_events, dtype=np.int64)
-        self._bins = np.zeros((4,), dtype=np.int64)
+        self._errors = 0
+        self._overruns = 0
+        # deque append/popleft are atomic: release is called from other threads
+        self._free_slots = _deque(range(self._n_slots))
+        # One extra row used as scratch space for copied blocks
+        self._ring_delays = np.empty((self._n_slots + 1, self._max_events), dtype=np.int64)
+        self._ring_bins = np.zeros((self._n_slots + 1, self._gates.n_gates), dtype=np.int64)
+        self._delays = self._ring_delays[0]
+        self._bins = self._ring_bins[0]
+        self._histogram = np.zeros((len(self._apd_channels), self._n_hist_bins),
+                                   dtype=np.int64)
+        self._last_timestamps = np.zeros((len(self._apd_channels),), dtype=np.int64)
 
     def on_start(self):
         # The lock is already acquired within the backend.
@@ -86,62 +169,6 @@ class MinfluxMeasurement(TimeTagger.CustomMeasurement):
         _lgr.info("Stoping TCSPC aquisition")
         ...
 
-    @staticmethod
-    @numba.jit((numba.uint64)(
-        numba.from_dtype(TimeTagger.CustomMeasurement.INCOMING_TAGS_DTYPE)[:],
-        numba.int64[:], numba.int64, numba.int64,
-        numba.int64[:]),
-        nopython=True, nogil=True, boundscheck=True)
-    def process_tags(tags: np.ndarray, data: np.ndarray,
-                     APD_channel: int, laser_channel: int,
-                     errors: np.ndarray):
-        """Save time differences in data, return number of records."""
-        # FIXME: a veces td puede ser negativo, hay que ver qué hacer con esos casos
-        n_errors = 0
-        last_pos = 0
-        last_timestamp = 0  # Puede ser que perdamos info, ponerlo en errors[1]
-        for tag in tags:
-            # tag.type can be: 0 - TimeTag, 1- Error, 2 - OverflowBegin, 3 -
-            # OverflowEnd, 4 - MissedEvents (you can use the TimeTagger.TagType IntEnum)
-            if tag['type'] != TimeTagger.TagType.TimeTag:
-                # tag is not a TimeTag, so we are in an error state, e.g. overflow
-                last_timestamp = 0
-                n_errors += 1
-            elif tag['channel'] == laser_channel and last_timestamp != 0:
-                # valid event
-                data[last_pos] = (tag['time'] - last_timestamp)
-                if last_pos < data.size - 1:  # overkill
-                    last_pos += 1
-                else:
-                    n_errors += 1
-            if tag['channel'] == APD_channel:
-                last_timestamp = tag['time']
-        errors[0] = n_errors
-        return last_pos
-
-    @staticmethod
-    @numba.jit((numba.int64[:], numba.int64[:], numba.int64[:]),
-               nopython=True, nogil=True, boundscheck=True)
-    def process_delays(data: np.ndarray, delays, bins):
-        """Bin time differences in data, return number of records.
-
-        WARNING: delays must be ORDERED.
-
-        FIXME: a veces td puede ser negativo, hay que ver qué hacer con esos casos
-        """
-        bins[:] = 0
-        for td in data:  # hardcoded para 4
-            # bins[3 - ((td+4290) % 50000) // 12500] += 1
-            td = ((td+4290) % 50000)
-            if td <= delays[3]:
-                bins[3] += 1
-            elif td <= delays[2]:
-                bins[2] += 1
-            elif td <= delays[1]:
-                bins[1] += 1
-            else:
-                bins[0] += 1
-
     def process(self, incoming_tags, begin_time, end_time):
         """
         Main processing method for the incoming raw time-tags.
@@ -163,26 +190,67 @@ class MinfluxMeasurement(TimeTagger.CustomMeasurement):
         end_time
             End timestamp of the of the current data block.
         """
-        # TODO: meter todo el pipeline en una sola función
-        errors = np.empty((2,), dtype=np.int64)  # Todo: usar structured con nombres
-        n_times = MinfluxMeasurement.process_tags(
-            incoming_tags,
-            self._delays,
-            self._APD_channel,
+        gates = self._gates
+        copy_data = self._copy_data
+        slot = self._n_slots  # scratch row, never lent
+        if not copy_data:
+            try:
+                slot = self._free_slots.popleft()
+            except IndexError:
+                # Consumer still holds every slot: use the scratch row and copy
+                copy_data = True
+                self._overruns += 1
+                if self._overruns == 1:
+                    _lgr.warning("Data consumer is lagging: copying blocks")
+        self._delays = self._ring_delays[slot]
+        self._bins = self._ring_bins[slot]
+        self._bins[:] = 0
+        n_times, n_errors = _gating.gate_tags(
+            incoming_tags['time'],
+            incoming_tags['channel'],
+            incoming_tags['type'],
             self._laser_channel,
-            errors)
-        if errors[0]:
-            _lgr.error("Hubo %s errores", errors[0])
-        # TODO: pasar esta línea a numba
-        # n_times = max(n_times, 100)  # usar los últimos 100 fotones.
-        MinfluxMeasurement.process_delays(self._delays[:n_times],
-                                          self.shutter_delays, self._bins)
-        self._cb(self._delays[:n_times].copy(), end_time - begin_time, self._bins.copy(), (0, 0))
+            self._apd_channels,
+            gates.lut,
+            gates.period,
+            gates.offset,
+            gates.resolution,
+            self._last_timestamps,
+            self._delays,
+            self._bins,
+            self._histogram,
+            self._hist_resolution)
+        if n_errors:
+            self._errors += n_errors
+            _lgr.error("Hubo %s errores", n_errors)
+        if copy_data:
+            self._cb(self._delays[:n_times].copy(), end_time - begin_time,
+                     self._bins.copy(), (0, 0))
+        else:
+            self._cb(self._delays[:n_times], end_time - begin_time, self._bins, (0, 0))
+
 
 if __name__ == '__main__':
     delays = np.array([0, 2000, 12000, 25000])
-    # test = MinfluxMeasurement(None, 4, 2, int(50E3), _MAX_EVENTS, delays, test)
-    idelays = int(50E3) - delays
-    data = np.random.randint(0, int(50E3), 100000, dtype=np.int32)
-    bins = np.zeros((4,), dtype=np.int64)
-    MinfluxMeasurement.process_delays(data, idelays, bins)
+    period = int(50E3)
+    gates = _gating.GateTable.from_delays(delays, period, (4,))
+    # Synthetic stream: alternating APD (channel 4) and laser (channel 2) tags
+    n_photons = 100000
+    tags = np.zeros(2 * n_photons, dtype=TimeTagger.CustomMeasurement.INCOMING_TAGS_DTYPE)
+    pulses = np.arange(1, n_photons + 1, dtype=np.int64) * period
+    tags['channel'][0::2] = 4
+    tags['time'][0::2] = pulses - np.random.randint(0, period, n_photons)
+    tags['channel'][1::2] = 2
+    tags['time'][1::2] = pulses
+    data = np.empty((n_photons,), dtype=np.int64)
+    bins = np.zeros((gates.n_gates,), dtype=np.int64)
+    histogram = np.zeros((1, period // _HIST_RESOLUTION,), dtype=np.int64)
+    last = np.zeros((1,), dtype=np.int64)
+    args = (tags['time'], tags['channel'], tags['type'], 2,
+            np.array(gates.channels, dtype=np.int64), gates.lut, gates.period, gates.offset,
+            gates.resolution, last, data, bins, histogram, _HIST_RESOLUTION)
+    _gating.gate_tags(*args)
+    bins[:] = 0
+    t0 = time.perf_counter()
+    n, n_errors = _gating.gate_tags(*args)
+    print(n, bins, f"{(time.perf_counter() - t0) * 1E9 / len(tags):.1f} ns/tag")
@@ -10,6 +10,8 @@ from ctypes import byref, POINTER
 from lantz import LibraryDriver
 from lantz import Driver, Feat, Action
 import time
+import threading
+import queue
 from datetime import datetime
 import numpy as np
 
@@ -21,6 +23,8 @@ TTREADMAX = 131072
 FLAG_OVERFLOW = 0x0040
 FLAG_FIFOFULL = 0x0003
 DEV_NUM = 0     # device number, works for only 1 PH device
+N_BUFFERS = 16  # FIFO read buffers shared by the reader and writer threads
+N_PENDING_BLOCKS = 64  # blocks waiting for data_callback before dropping
 
 
 class PicoHarp300(LibraryDriver):
@@ -34,6 +38,15 @@ class PicoHarp300(LibraryDriver):
         
         # Variables to store information read from DLLs
         self.buffer = (ctypes.c_uint * TTREADMAX)()
+        self._buffers = [(ctypes.c_uint * TTREADMAX)() for _ in range(N_BUFFERS)]
+        self._reader_thread = None
+        self._writer_thread = None
+        self._processor_thread = None
+        self.n_dropped_blocks = 0
+        self._stop_event = threading.Event()
+        self.measure_done = threading.Event()
+        self.measure_state = 'idle'
+        self.numRecords = 0
         self.libVersion = ctypes.create_string_buffer(b"", 8)
         self.hwSerial = ctypes.create_string_buffer(b"", 8)
         self.hwPartno = ctypes.create_string_buffer(b"", 8)
@@ -214,62 +227,151 @@ class PicoHarp300(LibraryDriver):
         self.syncDiv = value
                
     def startTTTR(self, outputfilename):
-        
-        outputfile = open(outputfilename, "wb+") 
-        progress = 0
-       
+        """Run a TTTR measurement, blocking until it finishes."""
+        self.startTTTR_async(outputfilename)
+        self.measure_done.wait()
+
+    def startTTTR_async(self, outputfilename, done_callback=None,
+                        data_callback=None):
+        """Start a TTTR measurement and return immediately.
+
+        A reader thread moves records from the device FIFO into a pool of
+        preallocated buffers, and a writer thread saves them to
+        outputfilename. Completion is signaled by the `measure_done` event,
+        and by calling `done_callback()` (from the writer thread) if given.
+
+        If given, `data_callback(records)` is called from a separate
+        processing thread with a numpy uint32 copy of each block of records,
+        so slow processing never holds the FIFO buffers. If more than
+        `N_PENDING_BLOCKS` blocks are waiting, new blocks are not passed to
+        the callback (they are still saved) and are counted in
+        `n_dropped_blocks`.
+        """
+        if self._reader_thread is not None and self._reader_thread.is_alive():
+            raise RuntimeError("A TTTR measurement is already running")
+        outputfile = open(outputfilename, "wb+")
+        # save real time for correlating with confocal images for FLIM
+        ref_file = open(outputfilename + '_ref_time_tcspc', "w+")
+        ref_file.write(str(datetime.now()) + '\n')
+        ref_file.write(str(time.time()) + '\n')
+
+        self.numRecords = 0
+        self.n_dropped_blocks = 0
+        self.measure_done.clear()
+        self._stop_event.clear()
+        free_buffers = queue.Queue()
+        full_buffers = queue.Queue()
+        for idx in range(N_BUFFERS):
+            free_buffers.put(idx)
+        data_queue = None
+        if data_callback is not None:
+            data_queue = queue.Queue(N_PENDING_BLOCKS)
+            self._processor_thread = threading.Thread(
+                target=self._process_loop, args=(data_queue, data_callback),
+                name="PH300 processor", daemon=True)
+            self._processor_thread.start()
+
         self.lib.PH_StartMeas(ctypes.c_int(DEV_NUM), ctypes.c_int(self.tacq))
         print(datetime.now(), '[picoharp 300] TCSPC measurement started')
-        
-        # save real time for correlating with confocal images for FLIM
-        f = open(outputfilename + '_ref_time_tcspc', "w+")
-        f.write(str(datetime.now()) + '\n')
-        f.write(str(time.time()) + '\n')
-        
-        meas = True
         self.measure_state = 'measuring'
-        
-        while meas is True:
-            self.lib.PH_GetFlags(ctypes.c_int(DEV_NUM), byref(self.flags))
-            
-            if self.flags.value & FLAG_FIFOFULL > 0:
-                print(datetime.now(), "[picoharp 300] FiFo Overrun!")
-                self.stopTTTR()
-            
-            
-            self.lib.PH_ReadFiFo(ctypes.c_int(DEV_NUM), byref(self.buffer), 
-                                 TTREADMAX, byref(self.nactual))
-                
-        
-            if self.nactual.value > 0:
-                print(datetime.now(), '[picoharp 300] current photon count:', self.nactual.value)
-                # We could just iterate through our buffer with a for loop, however,
-                # this is slow and might cause a FIFO overrun. So instead, we shrinken
-                # the buffer to its appropriate length with array slicing, which gives
-                # us a python list. This list then needs to be converted back into
-                # a ctype array which can be written at once to the output file
-                outputfile.write((ctypes.c_uint*self.nactual.value)(*self.buffer[0:self.nactual.value]))
-                progress += self.nactual.value
-#                sys.stdout.write("\rProgress:%9u" % progress)
-#                sys.stdout.flush()
-                
-            else:
-                self.lib.PH_CTCStatus(ctypes.c_int(DEV_NUM), byref(self.ctcDone))
-                
-                if self.ctcDone.value > 0: 
-                    print(datetime.now(), "[picoharp 300] Done")
-                    self.numRecords = progress
+
+        self._reader_thread = threading.Thread(
+            target=self._read_loop, args=(free_buffers, full_buffers),
+            name="PH300 reader", daemon=True)
+        self._writer_thread = threading.Thread(
+            target=self._write_loop,
+            args=(outputfile, ref_file, free_buffers, full_buffers,
+                  done_callback, data_queue),
+            name="PH300 writer", daemon=True)
+        self._writer_thread.start()
+        self._reader_thread.start()
+
+    def stop_async(self):
+        """Request the end of a running TTTR measurement."""
+        self._stop_event.set()
+
+    def _read_loop(self, free_buffers: queue.Queue, full_buffers: queue.Queue):
+        """Move records from the device FIFO to the buffers (reader thread)."""
+        try:
+            while True:
+                self.lib.PH_GetFlags(ctypes.c_int(DEV_NUM), byref(self.flags))
+                if self.flags.value & FLAG_FIFOFULL > 0:
+                    print(datetime.now(), "[picoharp 300] FiFo Overrun!")
                     self.stopTTTR()
-                    
-                    # save real time for correlating with confocal images for FLIM
-                    f.write(str(datetime.now()) + '\n')
-                    f.write(str(time.time()) + '\n')
-                    f.close()
-                    
-                    print(datetime.now(), '[picoharp 300] {} events recorded'.format(self.numRecords))
-                    meas = False
-                    self.measure_state = 'done'
-                    
+                    break
+                if self._stop_event.is_set():
+                    print(datetime.now(), "[picoharp 300] Stop requested")
+                    self.stopTTTR()
+                    break
+                idx = free_buffers.get()
+                nactual = ctypes.c_int()
+                self.lib.PH_ReadFiFo(ctypes.c_int(DEV_NUM), byref(self._buffers[idx]),
+                                     TTREADMAX, byref(nactual))
+                if nactual.value > 0:
+                    full_buffers.put((idx, nactual.value))
+                else:
+                    free_buffers.put(idx)
+                    self.lib.PH_CTCStatus(ctypes.c_int(DEV_NUM), byref(self.ctcDone))
+                    if self.ctcDone.value > 0:
+                        print(datetime.now(), "[picoharp 300] Done")
+                        self.stopTTTR()
+                        break
+                    # FIFO empty: give the device some time to fill it
+                    time.sleep(0.001)
+        finally:
+            full_buffers.put(None)
+
+    def _write_loop(self, outputfile, ref_file, free_buffers: queue.Queue,
+                    full_buffers: queue.Queue, done_callback, data_queue):
+        """Save buffers to file and pass them along (writer thread)."""
+        progress = 0
+        try:
+            while True:
+                item = full_buffers.get()
+                if item is None:
+                    break
+                idx, n = item
+                buffer = self._buffers[idx]
+                # zero-copy write of the used part of the buffer
+                outputfile.write(memoryview(buffer)[:n])
+                if data_queue is not None:
+                    try:
+                        data_queue.put_nowait(
+                            np.frombuffer(buffer, dtype=np.uint32, count=n).copy())
+                    except queue.Full:
+                        self.n_dropped_blocks += 1
+                progress += n
+                self.numRecords = progress
+                free_buffers.put(idx)
+        finally:
+            if data_queue is not None:
+                data_queue.put(None)
+                self._processor_thread.join()
+            outputfile.close()
+            # save real time for correlating with confocal images for FLIM
+            ref_file.write(str(datetime.now()) + '\n')
+            ref_file.write(str(time.time()) + '\n')
+            ref_file.close()
+            print(datetime.now(), '[picoharp 300] {} events recorded'.format(self.numRecords))
+            if self.n_dropped_blocks:
+                print(datetime.now(), '[picoharp 300] {} blocks not processed'.format(
+                    self.n_dropped_blocks))
+            self.measure_state = 'done'
+            self.measure_done.set()
+            if done_callback is not None:
+                done_callback()
+
+    def _process_loop(self, data_queue: queue.Queue, data_callback):
+        """Pass blocks of records to the callback (processing thread)."""
+        while True:
+            records = data_queue.get()
+            if records is None:
+                break
+            try:
+                data_callback(records)
+            except Exception as e:
+                print(datetime.now(), '[picoharp 300] Error processing data:', e)
+
     def stopTTTR(self):
         
         self.lib.PH_StopMeas(ctypes.c_int(DEV_NUM))
@@ -352,7 +352,8 @@ if __name__ == '__main__':
     adw = ADwin.ADwin(DEVICENUMBER, 1)
     scan.setupDevice(adw)
     camera_info = takyaq.info_types.CameraInfo(29.4, 52, 3.00)
-    controller = controllers.PIController()
+    # Same response as PIController with the default window and aggregation
+    controller = controllers.VectorPIController()
     with IDSWrapper() as camera, PiezoActuatorWrapper(adw) as piezo, stabilizer.Stabilizer(camera, piezo, camera_info, controller) as stb:
         stabilization_gui = PyQt_frontend.Frontend(camera, piezo, controller, camera_info, stb)
         stabilization_gui.setWindowTitle("Takyaq with PyQt frontend")
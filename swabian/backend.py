@@ -13,6 +13,7 @@ import pathlib as _plib
 from PyQt5.QtCore import pyqtSignal as _pyqtSignal, QObject as _QObject
 import TimeTagger as _TimeTagger
 import tools.swabiantools as _st
+from tools.gating import GateTable as _GateTable
 from tools.config_handler import TCSPInstrumentInfo as _TCSPInstrumentInfo
 from typing import Union as _Union
 
@@ -30,6 +31,8 @@ _lgr.setLevel(_lgn.DEBUG)
 
 
 _MAX_EVENTS = 131072
+_COARSE_STEP = 4  # coarse-to-fine localization search (see MinFluxLocator)
+_N_SLOTS = 32  # ring buffer slots passed from the measurement to the frontend
 
 
 def change_stem(path: _plib.Path, new_stem: str):
@@ -169,9 +172,17 @@ class TCSPC_Backend(metaclass=_Singleton):
                       filename: str,
                       acq_time_s: _Union[float, None] = None,
                       PSF: _Union[np.ndarray, None] = None,
-                      PSF_info: _Union[PSFMetadata, None] = None) -> bool:
+                      PSF_info: _Union[PSFMetadata, None] = None,
+                      SBR: float = 8.,
+                      background_kHz: _Union[float, None] = None) -> bool:
         """Start a measurement.
 
+        SBR is the initial Signal to Bkgd Ratio used for localization. If the
+        background count rate (in kHz, measured without emitter) is given,
+        the SBR of each localization is computed from the count rate of its
+        photons, as in the offline analysis (count rate / background rate).
+        It can also be updated during the measurement using `set_SBR`.
+
         Returns
         =======
             True if successful, False otherwise
@@ -181,13 +192,18 @@ class TCSPC_Backend(metaclass=_Singleton):
             return False
         sorted_indexes = np.argsort(self.iinfo.shutter_delays)
         self._shutter_delays = [self.iinfo.shutter_delays[idx] for idx in sorted_indexes]
-        self._accumulated_data = np.zeros((4,), np.int64)
+        self._gates = _GateTable.from_delays(
+            self._shutter_delays, self.iinfo.period,
+            [APDi.channel for APDi in self.iinfo.APD_info])
+        self._accumulated_data = np.zeros((self._gates.n_gates,), np.int64)
+        self._accumulated_time = 0  # ps
+        self._background_kHz = background_kHz if background_kHz else None
         if (PSF is not None) and (PSF_info is not None):
             _lgr.info("Starting measurement with location")
             self._PSF = PSF[sorted_indexes]
-            # FIXME
-            SBR = 8
-            self._locator = _analysis.MinFluxLocator(PSF, SBR, PSF_info.px_size * 1E3)
+            self._SBR = SBR
+            self._locator = _analysis.MinFluxLocator(PSF, SBR, PSF_info.px_size * 1E3,
+                                                     coarse_step=_COARSE_STEP)
         else:
             _lgr.info("Starting measurement without location")
             self._locator = None
@@ -204,6 +220,10 @@ class TCSPC_Backend(metaclass=_Singleton):
             self._shutter_delays,
             self.report,
             other_channels=self.iinfo.tick_channel,
+            # Slots are handed back by the frontend with `release_data`
+            copy_data=False,
+            n_slots=_N_SLOTS,
+            gates=self._gates,
         )
         self._file_measurement = _TimeTagger.FileWriter(
             self._measurementGroup.getTagger(), self.currentfname + '.ttbin',
@@ -226,15 +246,35 @@ class TCSPC_Backend(metaclass=_Singleton):
         if self._locator:
             try:
                 self._accumulated_data += bins
-                if self._accumulated_data.sum() >= 400:
-                    new_pos = self._locator(bins)[1]
+                self._accumulated_time += period_length
+                n_photons = self._accumulated_data.sum()
+                if n_photons >= 400:
+                    if self._background_kHz and self._accumulated_time > 0:
+                        rate_kHz = n_photons / (self._accumulated_time * 1E-12) / 1E3
+                        self.set_SBR(rate_kHz / self._background_kHz)
+                    new_pos = self._locator(bins, self._SBR)[1]
                     self._accumulated_data[:] = 0
+                    self._accumulated_time = 0
                 # new_pos = self._locator(bins)[1]
             except Exception as e:
                 _lgr.error("Excepción %s reportando data: %s", type(e), e)
                 self.stop_measure()
         self._reporter.sgnl_new_data.emit(delta_t, period_length, bins, new_pos)
 
+    def release_data(self, bins: np.ndarray):
+        """Return the buffers of a block received via `sgnl_new_data`.
+
+        Listeners of `sgnl_new_data` must call this once they are done with
+        `delta_t` and `bins`, that are views into the measurement buffers.
+        """
+        measurement = self._TCSPC_measurement
+        if measurement is not None:
+            measurement.release(bins)
+
+    def set_SBR(self, SBR: float):
+        """Set the Signal to Bkgd Ratio used for subsequent localizations."""
+        self._SBR = SBR
+
     def stop_measure(self) -> bool:
         """Stop measure.
 
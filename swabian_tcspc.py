@@ -97,7 +97,12 @@ class TCSPCFrontend(QtWidgets.QFrame):
             filename = self.filenameEdit.text()
         except Exception:
             filename = "lefilename"
-        self._backend.start_measure(filename, None, self._PSF, self._config)
+        try:
+            background_kHz = float(self.backgroundEdit.text())
+        except ValueError:
+            background_kHz = None  # fixed SBR
+        self._backend.start_measure(filename, None, self._PSF, self._config,
+                                    background_kHz=background_kHz)
 
     @pyqtSlot(str)
     def process_measurement_start(self, filename: str):
@@ -122,11 +127,11 @@ class TCSPCFrontend(QtWidgets.QFrame):
         Sin error checking por hora
         """
         self.measureButton.setEnabled(True)
-        _st.swabian2numpy(self._current_filename, self._backend.period,
-                          self._backend.iinfo.APD_info[0].channel,
-                          self._backend.iinfo.laser_channel,
-                          self._backend.iinfo.tick_channel
-                          )
+        _st.swabian2columns(self._current_filename, self._backend.period,
+                            [APDi.channel for APDi in self._backend.iinfo.APD_info],
+                            self._backend.iinfo.laser_channel,
+                            self._backend.iinfo.tick_channel
+                            )
 
     def load_folder(self):
         """Muestra una ventana de selección de carpeta."""
@@ -214,6 +219,8 @@ class TCSPCFrontend(QtWidgets.QFrame):
                 self._last_pos = 0
         except Exception as e:
             _lgr.error("Excepción %s recibiendo la información: %s", type(e), e)
+        finally:
+            self._backend.release_data(binned)
 
     def add_localization(self, pos_x, pos_y, last_pos, update: bool):
         """Receive a new localization from backend (_via_ callback)."""
@@ -274,6 +281,10 @@ class TCSPCFrontend(QtWidgets.QFrame):
         # self.channel1Value.setReadOnly(True)
 
         self.filenameEdit = QtWidgets.QLineEdit("filename")
+        # background count rate, used to compute the SBR of live localizations
+        self.backgroundLabel = QtWidgets.QLabel("Background [kHz]")
+        self.backgroundEdit = QtWidgets.QLineEdit("")
+        self.backgroundEdit.setToolTip("Leave empty to use a fixed SBR")
 
         # microTime histogram and timetrace
         self.histWidg = self.dataWidget.addPlot(
@@ -349,6 +360,8 @@ class TCSPCFrontend(QtWidgets.QFrame):
 
         # subgrid.addWidget(self.exportDataButton, 16, 1)
 
+        subgrid.addWidget(self.backgroundLabel, 16, 0)
+        subgrid.addWidget(self.backgroundEdit, 16, 1)
         subgrid.addWidget(self.measureButton, 17, 0)
         # subgrid.addWidget(self.prepareButton, 18, 0)
         subgrid.addWidget(self.stopButton, 17, 1)
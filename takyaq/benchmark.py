@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Stabilizer benchmark
+
+Runs a Stabilizer on recorded (see `takyaq.replay`) or simulated frames and
+reports throughput, fit latency and controller response. With a
+`VirtualClock` the loop runs as fast as possible and no frame is dropped, so
+results can be compared between versions.
+
+Use from the command line:
+    python -m takyaq.benchmark  # simulated camera
+    python -m takyaq.benchmark frames.npy --roi 10 40 10 40 --z-roi 100 160 100 160
+    python -m takyaq.benchmark --controller vector --window 5 --aggregation median
+
+@author: azelcer
+"""
+
+import numpy as _np
+import time as _time
+import threading as _th
+import logging as _lgn
+import warnings as _warnings
+from typing import List as _List, Optional as _Optional
+
+from .stabilizer import Stabilizer
+from .info_types import ROI, CameraInfo, PointInfo
+from .clocks import VirtualClock
+from . import base_classes as _bc
+
+_lgr = _lgn.getLogger(__name__)
+
+_PERCENTILES = (50, 90, 99)
+
+
+def run_benchmark(camera: _bc.BaseCamera, piezo: _bc.BasePiezo,
+                  camera_info: CameraInfo, controller: _bc.BaseController,
+                  xy_rois: _Optional[_List[ROI]] = None, z_roi: _Optional[ROI] = None,
+                  n_frames: int = 200, clock=None, period: float = 0.,
+                  fit_mode: str = 'batch', stabilize: bool = True,
+                  timeout: float = 600.) -> dict:
+    """Run the stabilizer for a number of frames and collect statistics.
+
+    Parameters
+    ----------
+    camera, piezo, camera_info, controller:
+        As in `Stabilizer`
+    xy_rois: list of ROI, optional
+        XY ROIs. XY is not tracked if None.
+    z_roi: ROI, optional
+        Z ROI. Z is not tracked if None.
+    n_frames: int, default 200
+        Number of processed frames
+    clock: optional
+        Stabilizer clock. Defaults to a new `VirtualClock`.
+    period: float, default 0.
+        Minimum loop period (in clock time)
+    fit_mode: str, default 'batch'
+        See `Stabilizer.set_fit_mode`
+    stabilize: bool, default True
+        Enable stabilization (otherwise only tracking)
+    timeout: float, default 600.
+        Maximum (real) duration in seconds
+
+    Returns
+    -------
+    dict with:
+        - frames, wall_time, fps: processed frames, real duration and rate.
+          Failed acquisitions (reported with NaN shifts) are not frames.
+        - dropped_frames
+        - failed_frames: reports of failed acquisitions. The benchmark ends
+          on the first one after a non looping replay camera is exhausted.
+        - latency_ms: {'mean', 'p50', 'p90', 'p99', 'max'} of the processing
+          stage (fit + controller)
+        - acquisition_ms: same, for image acquisition
+        - xy_std, z_std: std of the mean measured shifts (nm)
+        - n_moves, move_rms: number and rms size (nm) of piezo commands that
+          moved the stage, if the piezo records its history (see
+          `replay.RecordingPiezo`)
+    """
+    if xy_rois is None and z_roi is None:
+        raise ValueError("Nothing to track")
+    clock = VirtualClock() if clock is None else clock
+    points: _List[PointInfo] = []
+    n_failed = [0]
+    done = _th.Event()
+
+    def collect(data: PointInfo):
+        if _failed(data):
+            n_failed[0] += 1
+            # a non looping replay camera has no more frames
+            if getattr(camera, 'exhausted', False):
+                done.set()
+            return
+        points.append(data)
+        if len(points) >= n_frames:
+            done.set()
+
+    stabilizer = Stabilizer(camera, piezo, camera_info, controller, clock=clock)
+    stabilizer.set_fit_mode(fit_mode)
+    stabilizer.set_min_period(period)
+    if xy_rois is not None:
+        stabilizer.set_xy_rois(xy_rois)
+    if z_roi is not None:
+        stabilizer.set_z_roi(z_roi)
+    # images are not needed (and copying them would be timed)
+    stabilizer.add_callbacks(collect, None, None, image_period=_np.inf)
+    stabilizer.reset_stats(None)
+    with stabilizer:
+        if xy_rois is not None:
+            stabilizer.enable_xy_tracking()
+            if stabilize:
+                stabilizer.enable_xy_stabilization()
+        if z_roi is not None:
+            stabilizer.enable_z_tracking()
+            if stabilize:
+                stabilizer.enable_z_stabilization()
+        t0 = _time.perf_counter()
+        if not done.wait(timeout):
+            _lgr.warning("Benchmark timed out after %s frames", len(points))
+        wall_time = _time.perf_counter() - t0
+    stats = stabilizer.get_stats()
+    times = stabilizer.get_stage_times()
+    points = points[:n_frames]
+    rv = {
+        'frames': len(points),
+        'wall_time': wall_time,
+        'fps': len(points) / wall_time,
+        'dropped_frames': stats['dropped_frames'],
+        'failed_frames': n_failed[0],
+        'latency_ms': _summary(times['processing']),
+        'acquisition_ms': _summary(times['acquisition']),
+    }
+    with _warnings.catch_warnings():
+        _warnings.simplefilter("ignore")
+        if xy_rois is not None:
+            xy = _np.array([_np.nanmean(p.xy_shifts, axis=0) for p in points
+                            if p.xy_shifts is not None and p.xy_shifts.size])
+            rv['xy_std'] = _np.nanstd(xy, axis=0) if len(xy) else _np.full((2,), _np.nan)
+        if z_roi is not None:
+            rv['z_std'] = _np.nanstd([p.z_shift for p in points])
+    if callable(getattr(piezo, 'moves', None)):
+        moves = _np.diff(piezo.moves(), axis=0)
+        moves = moves[_np.any(moves != 0, axis=1)]
+        rv['n_moves'] = len(moves)
+        rv['move_rms'] = (_np.sqrt(_np.mean(moves ** 2, axis=0)) if len(moves)
+                          else _np.zeros((3,)))
+    return rv
+
+
+def _failed(data: PointInfo) -> bool:
+    """Tell if a report is from a failed acquisition (every shift is NaN)."""
+    return not (_np.isfinite(data.z_shift) or _np.isfinite(data.xy_shifts).any())
+
+
+def _summary(times: _np.ndarray) -> dict:
+    """Return mean, percentiles and max of durations, in ms."""
+    if not len(times):
+        return {}
+    times = times * 1E3
+    rv = {'mean': times.mean()}
+    rv.update({f'p{p}': v for p, v in zip(_PERCENTILES, _np.percentile(times, _PERCENTILES))})
+    rv['max'] = times.max()
+    return rv
+
+
+def print_results(results: dict):
+    """Print benchmark results."""
+    print(f"{results['frames']} frames in {results['wall_time']:.2f} s: "
+          f"{results['fps']:.1f} frames/s, {results['dropped_frames']} dropped, "
+          f"{results['failed_frames']} failed")
+    for name in ('latency_ms', 'acquisition_ms'):
+        print(f"{name}: " + ", ".join(f"{k} = {v:.2f}" for k, v in results[name].items()))
+    for name in ('xy_std', 'z_std', 'n_moves', 'move_rms'):
+        if name in results:
+            print(f"{name}: {_np.round(results[name], 3)}")
+
+
+def main(argv=None):
+    """Command line interface."""
+    import argparse
+    from .controllers import PIController, VectorPIController
+    parser = argparse.ArgumentParser(description="Benchmark the takyaq stabilizer")
+    parser.add_argument('stack', nargs='?', default=None,
+                        help="npy or TIFF frame stack. Uses a simulated camera if omitted")
+    parser.add_argument('--roi', nargs=4, type=int, action='append',
+                        metavar=('MIN_X', 'MAX_X', 'MIN_Y', 'MAX_Y'), help="XY ROI (repeatable)")
+    parser.add_argument('--z-roi', nargs=4, type=int, default=None,
+                        metavar=('MIN_X', 'MAX_X', 'MIN_Y', 'MAX_Y'), help="Z ROI")
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--marks', type=int, default=None,
+                        help="number of XY marks of the simulated camera")
+    parser.add_argument('--mode', choices=('batch', 'pool'), default='batch')
+    parser.add_argument('--period', type=float, default=0.)
+    parser.add_argument('--realtime', action='store_true',
+                        help="use the system clock instead of a virtual one")
+    parser.add_argument('--no-stabilize', action='store_true')
+    parser.add_argument('--controller', choices=('pi', 'vector'), default='pi',
+                        help="PIController or VectorPIController")
+    parser.add_argument('--window', type=int, default=1,
+                        help="smoothing window of the vector controller")
+    parser.add_argument('--aggregation', choices=('mean', 'median', 'weighted'),
+                        default='mean', help="ROI aggregation of the vector controller")
+    parser.add_argument('--max-step', type=float, default=_np.inf,
+                        help="max. response per cycle of the vector controller (nm)")
+    parser.add_argument('--nmpp-xy', type=float, default=23.5)
+    parser.add_argument('--nmpp-z', type=float, default=10.)
+    parser.add_argument('--angle', type=float, default=_np.pi / 4)
+    args = parser.parse_args(argv)
+    camera_info = CameraInfo(args.nmpp_xy, args.nmpp_z, args.angle)
+    if args.stack is None:
+        from .mocks import MockCamera, MockPiezo
+        camera = MockCamera(args.nmpp_xy, args.nmpp_xy, args.nmpp_z, 200, args.angle,
+                            n_marks=args.marks)
+        piezo = MockPiezo(camera)
+        xy_rois = [ROI(x - 15, x + 15, y - 15, y + 15) for x, y in camera.centers[:-1]]
+        x, y = camera.centers[-1]
+        z_roi = ROI(x - 20, x + 20, y - 20, y + 20)
+    else:
+        from .replay import ReplayCamera, RecordingPiezo
+        camera = ReplayCamera(args.stack)
+        piezo = RecordingPiezo()
+        xy_rois = [ROI(*r) for r in args.roi] if args.roi else None
+        z_roi = ROI(*args.z_roi) if args.z_roi else None
+    clock = None
+    if args.realtime:
+        from .clocks import SystemClock
+        clock = SystemClock()
+    if args.controller == 'vector':
+        controller = VectorPIController(window=args.window, aggregation=args.aggregation,
+                                        max_step=args.max_step)
+    else:
+        controller = PIController()
+    results = run_benchmark(camera, piezo, camera_info, controller, xy_rois,
+                            z_roi, args.frames, clock, args.period, args.mode,
+                            not args.no_stabilize)
+    print_results(results)
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Clocks
+
+The stabilizer timestamps frames and paces its loop using a clock object.
+`SystemClock` uses the wall clock. `VirtualClock` only advances when asked to
+sleep, so a loop paced with it runs as fast as possible while reporting the
+timestamps it would have in real time. It is useful for replaying recorded
+data (see `takyaq.replay`).
+
+@author: azelcer
+"""
+
+import time as _time
+import threading as _th
+
+
+class SystemClock:
+    """Real time clock."""
+
+    # Frames keep coming while the previous one is processed
+    realtime = True
+
+    @staticmethod
+    def time() -> float:
+        """Return timestamp in seconds since the epoch."""
+        return _time.time()
+
+    @staticmethod
+    def monotonic() -> float:
+        """Return a monotonic time in seconds."""
+        return _time.monotonic()
+
+    @staticmethod
+    def sleep(seconds: float):
+        """Wait."""
+        _time.sleep(seconds)
+
+
+class VirtualClock:
+    """Simulated clock: time only advances when sleeping.
+
+    `sleep` returns immediately (yielding the GIL) after moving the time
+    forward. Since processing takes no simulated time, the stabilizer does not
+    drop frames when using this clock.
+    """
+
+    realtime = False
+
+    def __init__(self, start: float = 0.):
+        """Init clock.
+
+        Parameters
+        ----------
+        start: float, default 0.
+            Initial time in seconds
+        """
+        self._t = float(start)
+        self._start = float(start)
+        self._lock = _th.Lock()
+
+    def time(self) -> float:
+        """Return the current simulated time."""
+        return self._t
+
+    def monotonic(self) -> float:
+        """Return the current simulated time."""
+        return self._t
+
+    def sleep(self, seconds: float):
+        """Advance time by `seconds` without waiting."""
+        self.advance(seconds)
+        _time.sleep(0)
+
+    def advance(self, seconds: float):
+        """Advance time."""
+        if seconds > 0:
+            with self._lock:
+                self._t += seconds
+
+    def elapsed(self) -> float:
+        """Return the simulated time elapsed since creation."""
+        return self._t - self._start
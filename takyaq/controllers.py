@@ -18,11 +18,16 @@ _lgr.setLevel(_lgn.DEBUG)
 
 
 class boxaverage:
-    """Helper boxed average class."""
+    """Helper boxed average class.
+
+    Ignores NaNs. Keeps a running sum, so `put` and `get` are O(1).
+    """
 
     _data: _np.ndarray
     _n_points: int
     _cur_pos: int = 0
+    _sum: float = 0.
+    _count: int = 0
 
     def __init__(self, n_points: int):
         self._n_points = n_points
@@ -31,22 +36,33 @@ class boxaverage:
     def reset(self):
         self._data[:] = _np.nan
         self._cur_pos = 0
+        self._sum = 0.
+        self._count = 0
 
     def put(self, value):
+        old = self._data[self._cur_pos]
+        if old == old:  # not NaN
+            self._sum -= old
+            self._count -= 1
+        if value == value:
+            self._sum += value
+            self._count += 1
         self._data[self._cur_pos] = value
         self._cur_pos = (self._cur_pos + 1) % self._n_points
+        if self._cur_pos == 0:  # avoid accumulating rounding errors
+            self._sum = float(_np.nansum(self._data))
 
     def get(self):
-        return _np.nanmean(self._data)
+        return self._sum / self._count if self._count else _np.nan
 
 
 class PIController:
     """PI Controller. Proportional Integral."""
 
-    _Kp = _np.ones((3,))
-    _Ki = _np.ones((3,))
-    _cum = _np.zeros((3,))
-    _last_times = _np.zeros((3,))
+    _Kp: _np.ndarray
+    _Ki: _np.ndarray
+    _cum: _np.ndarray
+    _last_times: _np.ndarray
 
     def __init__(self, Kp: _Union[float, _Tuple[float]] = 1.,
                  Ki: _Union[float, _Tuple[float]] = 1.):
@@ -59,6 +75,10 @@ class PIController:
             Ki: float or collection[3]
                 Intergral term constant. Single value or one for x, y, and z
         """
+        self._Kp = _np.ones((3,))
+        self._Ki = _np.ones((3,))
+        self._cum = _np.zeros((3,))
+        self._last_times = _np.zeros((3,))
         self.set_Kp(Kp)
         self.set_Ki(Ki)
 
@@ -111,10 +131,10 @@ class PIController:
 class SmoothedPIController:
     """PI Controller. Proportional Integral, smoothed."""
 
-    _Kp = _np.ones((3,))
-    _Ki = _np.ones((3,))
-    _cum = _np.zeros((3,))
-    _last_times = _np.zeros((3,))
+    _Kp: _np.ndarray
+    _Ki: _np.ndarray
+    _cum: _np.ndarray
+    _last_times: _np.ndarray
 
     def __init__(self, Kp: _Union[float, _Tuple[float]] = 1.,
                  Ki: _Union[float, _Tuple[float]] = 1.):
@@ -127,6 +147,10 @@ class SmoothedPIController:
             Ki: float or collection[3]
                 Intergral term constant. Single value or one for x, y, and z
         """
+        self._Kp = _np.ones((3,))
+        self._Ki = _np.ones((3,))
+        self._cum = _np.zeros((3,))
+        self._last_times = _np.zeros((3,))
         self.set_Kp(Kp)
         self.set_Ki(Ki)
         self._x_boxed = boxaverage(5)
@@ -191,21 +215,28 @@ class SmoothedPIController:
 class PIDController:
     """PID Controller. mean of last 5 derivatives used as derivative param."""
 
-    _Kp = _np.ones((3,))
-    _Ki = _np.ones((3,))
-    _Kd = _np.ones((3,))
-    _deriv = _np.zeros((3,))
-    _last_e = _np.zeros((3,))
-    _cum = _np.zeros((3,))
+    _Kp: _np.ndarray
+    _Ki: _np.ndarray
+    _Kd: _np.ndarray
+    _deriv: _np.ndarray
+    _last_e: _np.ndarray
+    _cum: _np.ndarray
     next_val = 0
-    _last_deriv = _np.full((1, 3,), _np.nan)
-    _last_times = _np.zeros((3,))
+    _last_deriv: _np.ndarray
+    _last_times: _np.ndarray
     _n_deriv_points = 10
 
     def __init__(self, Kp: _Union[float, _Tuple[float]] = 1.,
                  Ki: _Union[float, _Tuple[float]] = 1.,
                  Kd: _Union[float, _Tuple[float]] = 1.,
                  deriv_points: int = 10):
+        self._Kp = _np.ones((3,))
+        self._Ki = _np.ones((3,))
+        self._Kd = _np.ones((3,))
+        self._deriv = _np.zeros((3,))
+        self._last_e = _np.zeros((3,))
+        self._cum = _np.zeros((3,))
+        self._last_times = _np.zeros((3,))
         self.set_Kp(Kp)
         self.set_Ki(Ki)
         self.set_Kd(Kd)
@@ -278,17 +309,18 @@ class PIDController:
 class PIController2:
     """PI Controller."""
 
-    _Kp = _np.ones((3,))
-    _Ki = _np.ones((3,))
-    _deriv = _np.zeros((3,))
-    _last_e = _np.zeros((3,))
-    _cum = _np.zeros((3,))
-    next_val = 0
-    _last_times = _np.zeros((3,))
+    _Kp: _np.ndarray
+    _Ki: _np.ndarray
+    _cum: _np.ndarray
+    _last_times: _np.ndarray
 
     def __init__(self, Kp: _Union[float, _Tuple[float]] = 1.,
                  Ki: _Union[float, _Tuple[float]] = 1.,
                  ):
+        self._Kp = _np.ones((3,))
+        self._Ki = _np.ones((3,))
+        self._cum = _np.zeros((3,))
+        self._last_times = _np.zeros((3,))
         self.set_Kp(Kp)
         self.set_Ki(Ki)
 
@@ -336,3 +368,233 @@ class PIController2:
         rv = error * self._Kp + self._Ki * self._cum
         self._last_times[:] = t
         return -rv
+
+
+class VectorPIController:
+    """PI(D) controller with per ROI smoothing and robust aggregation.
+
+    Errors are handled as a (n_rois + 1, 3) matrix: one row per XY ROI (x, y
+    and an unused z) plus a last row for z (only the z column used). All the
+    state lives in a single contiguous buffer:
+        - a ring of the last `window` error matrices
+        - running sums, sums of squares and counts of valid (not NaN) values
+          of the ring, so smoothing costs O(1) per sample
+        - integral, last error, last time and last output per axis
+
+    Each cycle, every ROI is smoothed with its running mean and ROIs are
+    aggregated with:
+        - 'mean': average of the ROIs
+        - 'median': median of the ROIs, robust against outliers
+        - 'weighted': average weighted by the inverse of the variance of each
+          ROI within the window, so noisy ROIs count less
+
+    Anti-windup: the integral term is clamped to `i_limit` and, when the
+    output is clamped to `max_step`, the integral is not updated.
+    """
+
+    _AGGREGATIONS = ('mean', 'median', 'weighted')
+    _MIN_VARIANCE = 1E-6  # nm², avoids infinite weights
+    # state rows: integral, last error, last time, last output
+    _N_AXIS_ROWS = 4
+
+    def __init__(self, Kp: _Union[float, _Tuple[float]] = 1.,
+                 Ki: _Union[float, _Tuple[float]] = 1.,
+                 Kd: _Union[float, _Tuple[float]] = 0.,
+                 window: int = 1, aggregation: str = 'mean',
+                 i_limit: _Union[float, _Tuple[float]] = _np.inf,
+                 max_step: _Union[float, _Tuple[float]] = _np.inf):
+        """Init controller.
+
+        Parameters
+        ==========
+            Kp, Ki, Kd: float or collection[3]
+                Proportional, integral and derivative constants. Single value
+                or one for x, y, and z
+            window: int, default 1
+                Number of samples averaged for each ROI (1: no smoothing)
+            aggregation: str, default 'mean'
+                'mean', 'median' or 'weighted'
+            i_limit: float or collection[3], default inf
+                Maximum absolute value of the integral term, in nm
+            max_step: float or collection[3], default inf
+                Maximum absolute response per call, in nm
+        """
+        self._Kp = _np.ones((3,))
+        self._Ki = _np.ones((3,))
+        self._Kd = _np.zeros((3,))
+        self._i_limit = _np.full((3,), _np.inf)
+        self._max_step = _np.full((3,), _np.inf)
+        self._cum_limit = _np.full((3,), _np.inf)
+        self.set_Kp(Kp)
+        self.set_Ki(Ki)
+        self.set_Kd(Kd)
+        self.set_limits(i_limit, max_step)
+        self.set_aggregation(aggregation)
+        self._window = max(int(window), 1)
+        self._allocate(0)
+
+    def _allocate(self, n_rois: int):
+        """Allocate the state buffer and views for n_rois XY ROIs."""
+        rows = n_rois + 1
+        W = self._window
+        sizes = [W * rows * 3, rows * 3, rows * 3, rows * 3, self._N_AXIS_ROWS * 3]
+        self._buffer = _np.zeros((sum(sizes),))
+        views = _np.split(self._buffer, _np.cumsum(sizes)[:-1])
+        self._ring = views[0].reshape(W, rows, 3)
+        self._sum = views[1].reshape(rows, 3)
+        self._sum2 = views[2].reshape(rows, 3)
+        self._count = views[3].reshape(rows, 3)
+        axis_state = views[4].reshape(self._N_AXIS_ROWS, 3)
+        self._cum, self._last_e, self._last_times, self._last_out = axis_state
+        self._ring[:] = _np.nan
+        self._error = _np.full((rows, 3), _np.nan)
+        self._n_rois = n_rois
+        self._pos = 0
+
+    def set_Kp(self, Kp: _Union[float, _Tuple[float]]):
+        self._Kp[:] = _np.array(Kp)
+
+    def set_Ki(self, Ki: _Union[float, _Tuple[float]]):
+        self._Ki[:] = _np.array(Ki)
+        self._update_cum_limit()
+
+    def set_Kd(self, Kd: _Union[float, _Tuple[float]]):
+        self._Kd[:] = _np.array(Kd)
+
+    def set_limits(self, i_limit: _Union[float, _Tuple[float]] = _np.inf,
+                   max_step: _Union[float, _Tuple[float]] = _np.inf):
+        """Set anti-windup limit of the integral term and max response, in nm."""
+        self._i_limit[:] = _np.abs(_np.array(i_limit, dtype=float))
+        self._max_step[:] = _np.abs(_np.array(max_step, dtype=float))
+        self._update_cum_limit()
+
+    def _update_cum_limit(self):
+        """Translate the integral term limit into a limit of the integral."""
+        with _np.errstate(invalid='ignore', divide='ignore'):
+            self._cum_limit = _np.where(self._Ki != 0, self._i_limit / _np.abs(self._Ki),
+                                        _np.inf)
+
+    def set_aggregation(self, aggregation: str):
+        """Set how ROIs are combined: 'mean', 'median' or 'weighted'."""
+        if aggregation not in self._AGGREGATIONS:
+            raise ValueError(f"Invalid aggregation: {aggregation}")
+        self._aggregation = aggregation
+
+    def _clear_axes(self, columns: slice):
+        self._ring[:, :, columns] = _np.nan
+        self._sum[:, columns] = 0.
+        self._sum2[:, columns] = 0.
+        self._count[:, columns] = 0.
+        self._cum[columns] = 0.
+        self._last_e[columns] = 0.
+        self._last_times[columns] = 0.
+        self._last_out[columns] = 0.
+
+    def reset_xy(self, n_xy_rois: int):
+        """Initialize all neccesary internal structures."""
+        if n_xy_rois != self._n_rois:
+            z_state = (self._ring[:, -1, 2].copy(), self._sum[-1, 2], self._sum2[-1, 2],
+                       self._count[-1, 2], self._cum[2], self._last_e[2],
+                       self._last_times[2], self._last_out[2])
+            self._allocate(n_xy_rois)
+            (self._ring[:, -1, 2], self._sum[-1, 2], self._sum2[-1, 2],
+             self._count[-1, 2], self._cum[2], self._last_e[2],
+             self._last_times[2], self._last_out[2]) = z_state
+        else:
+            self._clear_axes(slice(0, 2))
+
+    def reset_z(self):
+        """Initialize all neccesary internal structures."""
+        self._clear_axes(slice(2, 3))
+
+    def _push(self, error: _np.ndarray):
+        """Put an error matrix in the ring, updating running sums."""
+        old = self._ring[self._pos]
+        valid = _np.isfinite(old)
+        old = _np.where(valid, old, 0.)
+        self._sum -= old
+        self._sum2 -= old * old
+        self._count -= valid
+        valid = _np.isfinite(error)
+        new = _np.where(valid, error, 0.)
+        self._sum += new
+        self._sum2 += new * new
+        self._count += valid
+        self._ring[self._pos] = error
+        self._pos = (self._pos + 1) % self._window
+        if self._pos == 0 and self._window > 1:  # avoid accumulating rounding errors
+            valid = _np.isfinite(self._ring)
+            data = _np.where(valid, self._ring, 0.)
+            self._sum[:] = data.sum(axis=0)
+            self._sum2[:] = (data * data).sum(axis=0)
+            self._count[:] = valid.sum(axis=0)
+
+    def _aggregate(self) -> _np.ndarray:
+        """Combine smoothed ROIs into one error per axis (NaN if no data)."""
+        rv = _np.empty((3,))
+        with _np.errstate(invalid='ignore', divide='ignore'):
+            means = self._sum / self._count
+            rv[2] = means[-1, 2]
+            if not self._n_rois:
+                rv[:2] = _np.nan
+                return rv
+            xy_means = means[:-1, :2]
+            counts = self._count[:-1, :2]
+            valid = counts > 0
+            if self._aggregation == 'median':
+                if valid.all():
+                    rv[:2] = _np.median(xy_means, axis=0)
+                else:
+                    for c in range(2):
+                        col = xy_means[valid[:, c], c]
+                        rv[c] = _np.median(col) if len(col) else _np.nan
+                return rv
+            if self._aggregation == 'weighted':
+                var = self._sum2[:-1, :2] / counts - xy_means * xy_means
+                weights = 1. / _np.maximum(var, self._MIN_VARIANCE)
+                weights[counts < 2] = 1. / self._MIN_VARIANCE
+            else:
+                weights = _np.ones_like(xy_means)
+            weights[~valid] = 0.
+            rv[:2] = (weights * _np.where(valid, xy_means, 0.)).sum(axis=0) / weights.sum(axis=0)
+        return rv
+
+    def response(self, t: float, xy_shifts: _Optional[_np.ndarray], z_shift: float):
+        """Process a mesaurement of the displacements.
+
+        Any parameter can be NAN, so we have to take it into account.
+
+        If xy_shifts has not been measured, a None will be received.
+
+        Must return a 3-item tuple representing the response in x, y and z
+        """
+        error = self._error
+        error[:] = _np.nan
+        if xy_shifts is not None and len(xy_shifts):
+            if len(xy_shifts) != self._n_rois:
+                self.reset_xy(len(xy_shifts))
+                error = self._error
+                error[:] = _np.nan
+            error[:-1, :2] = xy_shifts
+        error[-1, 2] = z_shift
+        self._push(error)
+        e = self._aggregate()
+        missing = ~_np.isfinite(e)
+        e[missing] = 0.
+        self._last_times[self._last_times <= 0.] = t
+        delta_t = _np.minimum(t - self._last_times, 1.)  # protect against suspended processes
+        cum = self._cum + e * delta_t
+        _np.clip(cum, -self._cum_limit, self._cum_limit, out=cum)
+        out = e * self._Kp + self._Ki * cum
+        if self._Kd.any():
+            with _np.errstate(invalid='ignore', divide='ignore'):
+                out += self._Kd * _np.where(delta_t > 0, (e - self._last_e) / delta_t, 0.)
+        clamped = _np.abs(out) > self._max_step
+        out = _np.clip(out, -self._max_step, self._max_step)
+        # conditional integration: do not wind up while saturated
+        update = ~clamped & ~missing
+        self._cum[update] = cum[update]
+        self._last_e[:] = e
+        self._last_times[:] = t
+        self._last_out[:] = out
+        return -out
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only binary logs
+
+Stabilization data is saved as a stream of fixed size records (a numpy
+structured array) after a small header:
+    - 8 bytes magic (`MAGIC`)
+    - 4 bytes little endian header length
+    - JSON header: {"dtype": <numpy dtype description, as in npy files>,
+      "index_every": n}
+
+Records must be sorted by their 't' field. Every `index_every` records, the
+record number and its time is appended to a sidecar index file (same name plus
+'.idx'), so time ranges can be located without touching the data.
+
+Files are written by a background thread (`LogWriter`) and read by
+memory-mapping them (`LogReader`). A partially written last record is ignored,
+so files can be read while they are being written or after a crash.
+
+@author: azelcer
+"""
+
+import numpy as _np
+import json as _json
+import ast as _ast
+import struct as _struct
+import threading as _th
+import queue as _queue
+import logging as _lgn
+from pathlib import Path as _Path
+from typing import Union as _Union, Optional as _Optional, Tuple as _Tuple
+
+_lgr = _lgn.getLogger(__name__)
+
+MAGIC = b'TKYQLOG1'
+EXTENSION = '.tklog'
+# Default number of records between index entries
+_INDEX_EVERY = 1024
+_INDEX_DTYPE = _np.dtype([('n', '<i8'), ('t', '<f8')])
+
+
+def _index_name(filename: _Union[str, _Path]) -> _Path:
+    filename = _Path(filename)
+    return filename.with_name(filename.name + '.idx')
+
+
+def _dtype_to_str(dtype: _np.dtype) -> str:
+    # Same representation used by npy files
+    return repr(_np.lib.format.dtype_to_descr(dtype))
+
+
+def _dtype_from_str(descr: str) -> _np.dtype:
+    return _np.lib.format.descr_to_dtype(_ast.literal_eval(descr))
+
+
+def _read_header(fd) -> _Tuple[_np.dtype, int, int]:
+    """Read header. Returns dtype, index period and data offset."""
+    if fd.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a takyaq log file")
+    (length,) = _struct.unpack('<I', fd.read(4))
+    header = _json.loads(fd.read(length).decode('utf-8'))
+    return (_dtype_from_str(header['dtype']), header['index_every'],
+            len(MAGIC) + 4 + length)
+
+
+class LogWriter:
+    """Append records to a log from a background thread.
+
+    The record dtype is taken from the first appended array, unless given.
+    """
+
+    def __init__(self, filename: _Union[str, _Path],
+                 dtype: _Optional[_np.dtype] = None,
+                 index_every: int = _INDEX_EVERY):
+        """Open file for writing (truncates it).
+
+        Parameters
+        ----------
+        filename: str or pathlib.Path
+            Log file name
+        dtype: numpy.dtype, optional
+            Record dtype. Must have a 't' field.
+        index_every: int
+            Number of records between index entries
+        """
+        self.filename = _Path(filename)
+        self._fd = open(self.filename, 'wb')
+        self._idx_fd = open(_index_name(self.filename), 'wb')
+        self._dtype = None
+        self._index_every = index_every
+        self._n_records = 0
+        self._queue = _queue.SimpleQueue()
+        if dtype is not None:
+            self._write_header(_np.dtype(dtype))
+        self._thread = _th.Thread(target=self._write_loop, daemon=True,
+                                  name=f"Log writer {self.filename.name}")
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def _write_header(self, dtype: _np.dtype):
+        if 't' not in (dtype.names or ()):
+            raise ValueError("Record dtype must have a 't' field")
+        header = _json.dumps({'dtype': _dtype_to_str(dtype),
+                              'index_every': self._index_every}).encode('utf-8')
+        self._fd.write(MAGIC + _struct.pack('<I', len(header)) + header)
+        self._dtype = dtype
+
+    def append(self, records: _np.ndarray):
+        """Queue records for writing. Does not block.
+
+        The array must not be modified afterwards.
+        """
+        if self._dtype is None:
+            self._write_header(records.dtype)
+        elif records.dtype != self._dtype:
+            raise ValueError(f"Invalid record dtype {records.dtype}, expected {self._dtype}")
+        self._queue.put(records)
+
+    def _write_loop(self):
+        while True:
+            records = self._queue.get()
+            if records is None:
+                break
+            try:
+                self._write(records)
+            except Exception as e:
+                _lgr.error("Error writing log %s: %s (%s)", self.filename, type(e), e)
+
+    def _write(self, records: _np.ndarray):
+        first = self._n_records
+        self._fd.write(_np.ascontiguousarray(records).data)
+        self._n_records += len(records)
+        # index entries for records whose number is a multiple of index_every
+        start = -(-first // self._index_every) * self._index_every
+        entries = _np.arange(start, self._n_records, self._index_every)
+        if len(entries):
+            index = _np.empty((len(entries),), dtype=_INDEX_DTYPE)
+            index['n'] = entries
+            index['t'] = records['t'][entries - first]
+            self._idx_fd.write(index.data)
+            self._idx_fd.flush()
+        self._fd.flush()
+
+    def close(self):
+        """Write pending records and close files."""
+        if self._fd is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._fd.close()
+        self._idx_fd.close()
+        self._fd = self._idx_fd = None
+
+
+class LogReader:
+    """Memory-mapped, read only access to a log."""
+
+    def __init__(self, filename: _Union[str, _Path]):
+        """Map file.
+
+        The number of records is fixed when opened: call `refresh` to see
+        records written later.
+        """
+        self.filename = _Path(filename)
+        with open(self.filename, 'rb') as fd:
+            self.dtype, self._index_every, self._offset = _read_header(fd)
+        self.refresh()
+
+    def refresh(self):
+        """Map all complete records currently in the file."""
+        size = self.filename.stat().st_size - self._offset
+        n = max(size, 0) // self.dtype.itemsize
+        if n:
+            self.records = _np.memmap(self.filename, self.dtype, 'r',
+                                      self._offset, (n,))
+        else:
+            self.records = _np.empty((0,), self.dtype)
+        self._index = self._load_index(n)
+
+    def _load_index(self, n: int) -> _np.ndarray:
+        """Load sidecar index, or rebuild it if missing."""
+        try:
+            raw = _index_name(self.filename).read_bytes()
+            n_entries = len(raw) // _INDEX_DTYPE.itemsize
+            index = _np.frombuffer(raw, _INDEX_DTYPE, n_entries)
+        except FileNotFoundError:
+            entries = _np.arange(0, n, self._index_every)
+            index = _np.empty((len(entries),), dtype=_INDEX_DTYPE)
+            index['n'] = entries
+            index['t'] = self.records['t'][entries]
+        return index[index['n'] < n]
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def time_range(self) -> _Tuple[float, float]:
+        """Return first and last times."""
+        if not len(self.records):
+            return (_np.nan, _np.nan)
+        return (float(self.records['t'][0]), float(self.records['t'][-1]))
+
+    def _find(self, t: float) -> int:
+        """Return the index of the first record with time >= t."""
+        blk = int(_np.searchsorted(self._index['t'], t, 'left'))
+        lo = int(self._index['n'][blk - 1]) if blk > 0 else 0
+        hi = (int(self._index['n'][blk]) + 1 if blk < len(self._index)
+              else len(self.records))
+        return lo + int(_np.searchsorted(self.records['t'][lo:hi], t, 'left'))
+
+    def time_slice(self, t_start: _Optional[float] = None,
+                   t_end: _Optional[float] = None) -> _np.ndarray:
+        """Return records with t_start <= t < t_end (a memory-mapped view).
+
+        None means no limit.
+        """
+        start = 0 if t_start is None else self._find(t_start)
+        end = len(self.records) if t_end is None else self._find(t_end)
+        return self.records[start:end]
+
+
+def is_log(filename: _Union[str, _Path]) -> bool:
+    """Check if a file is a takyaq log."""
+    with open(filename, 'rb') as fd:
+        return fd.read(len(MAGIC)) == MAGIC
+
+
+def load(filename: _Union[str, _Path], t_start: _Optional[float] = None,
+         t_end: _Optional[float] = None) -> _Optional[_np.ndarray]:
+    """Load records from a log, or from a legacy file of appended npy arrays.
+
+    Logs are memory-mapped. Legacy files are loaded fully and then sliced.
+
+    Returns
+    -------
+    numpy structured array, or None if the file is empty.
+    """
+    if is_log(filename):
+        rv = LogReader(filename).time_slice(t_start, t_end)
+        return rv if len(rv) else None
+    data = []
+    with open(filename, 'rb') as fd:
+        try:
+            while True:
+                data.append(_np.load(fd, allow_pickle=True))
+        except EOFError:
+            pass
+    if not data:
+        return None
+    rv = _np.concatenate(data)
+    mask = _np.ones((len(rv),), dtype=bool)
+    if t_start is not None:
+        mask &= rv['t'] >= t_start
+    if t_end is not None:
+        mask &= rv['t'] < t_end
+    return rv[mask]
+
+
+if __name__ == '__main__':
+    import tempfile
+    import time
+    dtype = _np.dtype([('t', _np.float64), ('xy', _np.float64, (10, 2))])
+    n_blocks, block = 200, 5000
+    with tempfile.TemporaryDirectory() as tmpdir:
+        name = _Path(tmpdir) / ('test' + EXTENSION)
+        t0 = time.perf_counter()
+        with LogWriter(name) as writer:
+            for b in range(n_blocks):
+                data = _np.empty((block,), dtype)
+                data['t'] = _np.arange(b * block, (b + 1) * block) * 0.1
+                data['xy'] = _np.random.normal(size=(block, 10, 2))
+                writer.append(data)
+        print(f"Wrote {n_blocks * block} records in {time.perf_counter() - t0:.2f} s")
+        t0 = time.perf_counter()
+        reader = LogReader(name)
+        window = reader.time_slice(50000., 53600.)
+        print(f"{len(window)} records between {window['t'][0]} and {window['t'][-1]}",
+              f"found in {(time.perf_counter() - t0) * 1E3:.2f} ms")
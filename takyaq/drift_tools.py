@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+"""
+Drift analysis tools
+
+NaN aware correlations, power spectral densities, Allan deviations and ROI
+covariances of drift traces. NaN samples (failed fits, disabled tracking) are
+treated as missing. Long traces (memory-mapped logs) are processed in chunks.
+
+Does not depend on Qt, so it can be used from scripts or from the command
+line:
+    python -m takyaq.drift_tools xy_data.tklog z_data.tklog -o stats.npz
+
+@author: azelcer
+"""
+
+import numpy as _np
+import scipy.fft as _fft
+import logging as _lgn
+import warnings as _warnings
+from pathlib import Path as _Path
+from typing import Optional as _Optional, Tuple as _Tuple
+
+_lgr = _lgn.getLogger(__name__)
+
+# Default number of samples processed at once by chunked functions
+_CHUNK = 1 << 16
+
+
+def _lag_sums(a: _np.ndarray, b: _np.ndarray, max_lag: int) -> _np.ndarray:
+    """Return sum_i a[i + l] * b[i] for l in [-max_lag, max_lag].
+
+    a and b are (L, ...) arrays without NaNs, correlated along the first axis.
+    """
+    L = a.shape[0]
+    n = _fft.next_fast_len(L + max_lag)
+    c = _fft.irfft(_fft.rfft(a, n, axis=0) * _np.conj(_fft.rfft(b, n, axis=0)),
+                   n, axis=0)
+    return _np.concatenate((c[n - max_lag:], c[:max_lag + 1]), axis=0)
+
+
+def _masked_sums(a: _np.ndarray, b: _np.ndarray, max_lag: int,
+                 normalized: bool) -> _Tuple[_np.ndarray, _Optional[_np.ndarray]]:
+    """Return lag sums ignoring NaNs and, if normalized, the number of pairs."""
+    mask_a = _np.isfinite(a)
+    mask_b = _np.isfinite(b)
+    corrs = _lag_sums(_np.where(mask_a, a, 0.), _np.where(mask_b, b, 0.), max_lag)
+    counts = None
+    if normalized:
+        counts = _np.rint(_lag_sums(mask_a.astype(float), mask_b.astype(float),
+                                    max_lag))
+    return corrs, counts
+
+
+def _finish(corrs: _np.ndarray, counts: _Optional[_np.ndarray]) -> _np.ndarray:
+    if counts is None:
+        return corrs
+    with _np.errstate(invalid='ignore', divide='ignore'):
+        return _np.where(counts > 0, corrs / counts, _np.nan)
+
+
+def nan_correlate(a: _np.ndarray, b: _np.ndarray, max_lag: _Optional[int] = None,
+                  normalized: bool = False) -> _Tuple[_np.ndarray, _np.ndarray]:
+    """Correlate two traces, ignoring NaNs.
+
+    Without normalization the result is the same as
+    `nansum(a[l:] * b[:-l])` for each offset `l` (negative offsets shift b).
+
+    Parameters
+    ----------
+    a, b : numpy.ndarray
+        (L,) traces of the same length
+    max_lag : int, optional
+        Maximum offset. Defaults to L - 1.
+    normalized : bool, default False
+        If True, divide each sum by the number of valid (non NaN) pairs, so
+        missing samples do not bias the result. Offsets without valid pairs
+        are NaN.
+
+    Returns
+    -------
+    offsets : numpy.ndarray
+        (2 * max_lag + 1,) offsets
+    corrs : numpy.ndarray
+        Correlation for each offset
+    """
+    a = _np.asarray(a, dtype=float)
+    b = _np.asarray(b, dtype=float)
+    if a.shape != b.shape or a.ndim != 1:
+        raise ValueError("inputs must be 1D and have the same length")
+    L = len(a)
+    max_lag = L - 1 if max_lag is None else min(max_lag, L - 1)
+    corrs, counts = _masked_sums(a, b, max_lag, normalized)
+    return _np.arange(-max_lag, max_lag + 1), _finish(corrs, counts)
+
+
+def nan_correlate_batch(a: _np.ndarray, b: _Optional[_np.ndarray] = None,
+                        max_lag: _Optional[int] = None,
+                        normalized: bool = False) -> _Tuple[_np.ndarray, _np.ndarray]:
+    """Correlate many traces at once, ignoring NaNs.
+
+    Parameters
+    ----------
+    a : numpy.ndarray
+        (L, K) array, one trace per column (for example one per ROI)
+    b : numpy.ndarray, optional
+        (L, K) or (L,) array correlated with each column of a. If None,
+        computes the autocorrelation of each column of a.
+    max_lag, normalized:
+        see `nan_correlate`
+
+    Returns
+    -------
+    offsets : numpy.ndarray
+        (2 * max_lag + 1,) offsets
+    corrs : numpy.ndarray
+        (2 * max_lag + 1, K) correlations
+    """
+    a = _np.asarray(a, dtype=float)
+    b = a if b is None else _np.asarray(b, dtype=float)
+    if b.ndim == 1:
+        b = b[:, _np.newaxis]
+    if a.ndim != 2 or b.shape[0] != a.shape[0]:
+        raise ValueError("inputs must be (L, K) arrays with the same length")
+    b = _np.broadcast_to(b, a.shape)
+    L = a.shape[0]
+    max_lag = L - 1 if max_lag is None else min(max_lag, L - 1)
+    corrs, counts = _masked_sums(a, b, max_lag, normalized)
+    return _np.arange(-max_lag, max_lag + 1), _finish(corrs, counts)
+
+
+class StreamingCorrelator:
+    """Accumulate NaN aware correlations of long traces chunk by chunk.
+
+    Only `max_lag` samples of history are kept, so traces can be read from
+    memory-mapped logs without loading them. Chunks may be (n,) or (n, K)
+    arrays, as in `nan_correlate_batch`.
+    """
+
+    def __init__(self, max_lag: int, normalized: bool = False):
+        self.max_lag = max_lag
+        self.normalized = normalized
+        self.reset()
+
+    def reset(self):
+        """Clear accumulated data."""
+        self._tail_a = self._tail_b = None
+        self._corrs = self._counts = None
+        self.n_samples = 0
+
+    def update(self, a: _np.ndarray, b: _Optional[_np.ndarray] = None):
+        """Add the next chunk of data (b defaults to a: autocorrelation)."""
+        a = _np.asarray(a, dtype=float)
+        b = a if b is None else _np.broadcast_to(_np.asarray(b, dtype=float), a.shape)
+        if not len(a):
+            return
+        if self._tail_a is None:
+            self._tail_a = a[:0]
+            self._tail_b = b[:0]
+            shape = (2 * self.max_lag + 1,) + a.shape[1:]
+            self._corrs = _np.zeros(shape)
+            self._counts = _np.zeros(shape) if self.normalized else None
+        ext_a = _np.concatenate((self._tail_a, a))
+        ext_b = _np.concatenate((self._tail_b, b))
+        # New pairs: those from the extended chunk minus those only in the tail
+        corrs, counts = _masked_sums(ext_a, ext_b, self.max_lag, self.normalized)
+        if len(self._tail_a):
+            old_corrs, old_counts = _masked_sums(self._tail_a, self._tail_b,
+                                                 self.max_lag, self.normalized)
+            corrs -= old_corrs
+            if self.normalized:
+                counts -= old_counts
+        self._corrs += corrs
+        if self.normalized:
+            self._counts += counts
+        self._tail_a = ext_a[-self.max_lag:] if self.max_lag else ext_a[:0]
+        self._tail_b = ext_b[-self.max_lag:] if self.max_lag else ext_b[:0]
+        self.n_samples += len(a)
+
+    def result(self) -> _Tuple[_np.ndarray, _np.ndarray]:
+        """Return offsets and correlations of all the data seen so far."""
+        offsets = _np.arange(-self.max_lag, self.max_lag + 1)
+        if self._corrs is None:
+            return offsets, _np.full(offsets.shape, _np.nan)
+        return offsets, _finish(self._corrs, self._counts)
+
+
+def _as_2d(x: _np.ndarray) -> _Tuple[_np.ndarray, bool]:
+    """Return x as an (L, K) array and whether it was 1D. Does not copy."""
+    x = _np.asanyarray(x)
+    if x.ndim == 1:
+        return x[:, _np.newaxis], True
+    return x.reshape(x.shape[0], -1), False
+
+
+def sampling_period(t: _np.ndarray) -> float:
+    """Estimate the sampling period of a (roughly uniform) time vector."""
+    return float(_np.median(_np.diff(t[:_CHUNK])))
+
+
+def nan_welch(x: _np.ndarray, fs: float = 1., nperseg: int = 1024,
+              overlap: float = 0.5, max_nan_fraction: float = 0.1,
+              chunk: int = _CHUNK) -> _Tuple[_np.ndarray, _np.ndarray]:
+    """Estimate the power spectral density with Welch's method, ignoring NaNs.
+
+    Uses a Hann window, constant detrending and one-sided density scaling, as
+    `scipy.signal.welch` defaults. Segments with more than
+    `max_nan_fraction` missing samples are skipped; in the others missing
+    samples are linearly interpolated. Data is read in chunks, so x can be
+    a memory-mapped array.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        (L,) or (L, K) uniformly sampled data
+    fs : float, default 1.
+        Sampling frequency
+    nperseg : int, default 1024
+        Segment length. Shortened to L if needed.
+    overlap : float, default 0.5
+        Fraction of overlap between segments
+    max_nan_fraction : float, default 0.1
+        Maximum fraction of missing samples in a segment
+    chunk : int
+        Approximate number of samples read at once
+
+    Returns
+    -------
+    freqs : numpy.ndarray
+        (nperseg // 2 + 1,) frequencies
+    psd : numpy.ndarray
+        (n_freqs,) or (n_freqs, K) power spectral density. NaN if no segment
+        could be used.
+    """
+    x2, is_1d = _as_2d(x)
+    L, K = x2.shape
+    nperseg = min(nperseg, L)
+    step = max(int(nperseg * (1. - overlap)), 1)
+    window = _np.hanning(nperseg + 1)[:-1]  # periodic Hann, as scipy
+    scale = 1. / (fs * _np.sum(window ** 2))
+    freqs = _fft.rfftfreq(nperseg, 1. / fs)
+    acc = _np.zeros((len(freqs), K))
+    n_segs = _np.zeros((K,))
+    starts = _np.arange(0, L - nperseg + 1, step)
+    segs_per_chunk = max(chunk // step, 1)
+    idx = _np.arange(nperseg)
+    for first in range(0, len(starts), segs_per_chunk):
+        s = starts[first: first + segs_per_chunk]
+        block = _np.array(x2[s[0]: s[-1] + nperseg], dtype=float)
+        segs = block[(s - s[0])[:, _np.newaxis] + idx]  # (n, nperseg, K)
+        bad = ~_np.isfinite(segs)
+        n_bad = bad.sum(axis=1)  # (n, K)
+        usable = n_bad <= max_nan_fraction * nperseg
+        usable &= n_bad < nperseg - 1
+        for si, k in zip(*_np.nonzero(usable & (n_bad > 0))):
+            seg = segs[si, :, k]
+            good = ~bad[si, :, k]
+            seg[~good] = _np.interp(idx[~good], idx[good], seg[good])
+        segs = _np.where(usable[:, _np.newaxis, :], segs, 0.)
+        segs -= segs.mean(axis=1, keepdims=True)
+        spec = _np.abs(_fft.rfft(segs * window[:, _np.newaxis], axis=1)) ** 2
+        acc += spec.sum(axis=0)
+        n_segs += usable.sum(axis=0)
+    with _np.errstate(invalid='ignore', divide='ignore'):
+        psd = acc * scale / n_segs
+    if nperseg % 2:
+        psd[1:] *= 2
+    else:
+        psd[1:-1] *= 2
+    return freqs, psd[:, 0] if is_1d else psd
+
+
+def allan_deviation(x: _np.ndarray, dt: float = 1., taus: _np.ndarray = None,
+                    n_taus: int = 30) -> _Tuple[_np.ndarray, _np.ndarray]:
+    """Overlapping Allan deviation of uniformly sampled data, ignoring NaNs.
+
+    For each averaging length m, the data is averaged over all (overlapping)
+    windows of m samples and the Allan variance is half the mean squared
+    difference of averages m samples apart. Windows with missing samples are
+    discarded.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        (L,) or (L, K) data
+    dt : float, default 1.
+        Sampling period
+    taus : numpy.ndarray, optional
+        Averaging times. Rounded to multiples of dt. Defaults to n_taus
+        log-spaced values between dt and L * dt / 3.
+    n_taus : int, default 30
+        Number of default averaging times
+
+    Returns
+    -------
+    taus : numpy.ndarray
+        Averaging times actually used
+    adev : numpy.ndarray
+        (n_taus,) or (n_taus, K) Allan deviations
+    """
+    x2, is_1d = _as_2d(x)
+    L, K = x2.shape
+    if taus is None:
+        ms = _np.geomspace(1, max(L // 3, 1), n_taus)
+    else:
+        ms = _np.asarray(taus, dtype=float) / dt
+    ms = _np.unique(_np.clip(_np.rint(ms), 1, max(L // 2, 1)).astype(_np.int64))
+    adev = _np.full((len(ms), K), _np.nan)
+    for k in range(K):  # one column at a time keeps memory at O(L)
+        col = _np.array(x2[:, k], dtype=float)
+        good = _np.isfinite(col)
+        csum = _np.concatenate(([0.], _np.cumsum(_np.where(good, col, 0.))))
+        ccount = _np.concatenate(([0], _np.cumsum(good)))
+        for i, m in enumerate(ms):
+            means = (csum[m:] - csum[:-m]) / m
+            full = (ccount[m:] - ccount[:-m]) == m
+            diffs = means[m:] - means[:-m]
+            valid = full[m:] & full[:-m]
+            if valid.any():
+                adev[i, k] = _np.sqrt(0.5 * _np.mean(diffs[valid] ** 2))
+    return ms * dt, adev[:, 0] if is_1d else adev
+
+
+def roi_covariance(x: _np.ndarray, chunk: int = _CHUNK
+                   ) -> _Tuple[_np.ndarray, _np.ndarray]:
+    """Pairwise NaN aware covariance and correlation between traces.
+
+    Each covariance uses only the samples where both traces are valid. Data
+    is read in chunks, so x can be a memory-mapped array.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        (L, K) data, one trace per column (for example, x shift of each ROI)
+    chunk : int
+        Number of samples read at once
+
+    Returns
+    -------
+    cov, corr : numpy.ndarray
+        (K, K) covariance and correlation coefficient matrices
+    """
+    x2, _ = _as_2d(x)
+    L, K = x2.shape
+    n = _np.zeros((K, K))
+    s = _np.zeros((K, K))  # s[i, j]: sum of x_i where both i and j are valid
+    ss = _np.zeros((K, K))
+    s2 = _np.zeros((K, K))  # s2[i, j]: sum of x_i ** 2 where both are valid
+    for start in range(0, L, chunk):
+        block = _np.array(x2[start: start + chunk], dtype=float)
+        m = _np.isfinite(block).astype(float)
+        block = _np.where(m > 0, block, 0.)
+        n += m.T @ m
+        s += block.T @ m
+        s2 += (block ** 2).T @ m
+        ss += block.T @ block
+    with _np.errstate(invalid='ignore', divide='ignore'):
+        cov = (ss - s * s.T / n) / (n - 1)
+        var = s2 - s ** 2 / n  # var[i, j]: (n - 1) * var of x_i on common samples
+        corr = (ss - s * s.T / n) / _np.sqrt(var * var.T)
+    return cov, corr
+
+
+def analyze_log(filename: str, t_start: _Optional[float] = None,
+                t_end: _Optional[float] = None, nperseg: int = 1024) -> dict:
+    """Compute drift statistics of a stabilization log.
+
+    Works with xy logs (field 'xy', one trace per ROI and axis, plus the
+    mean over ROIs) and z logs (field 'z').
+
+    Returns
+    -------
+    dict of numpy arrays, suitable for numpy.savez
+    """
+    from . import datalog as _datalog  # avoid circular imports in the frontends
+    data = _datalog.load(filename, t_start, t_end)
+    if data is None:
+        raise ValueError(f"No data in {filename}")
+    dt = sampling_period(data['t'])
+    rv = {'dt': _np.array(dt), 'n_samples': _np.array(len(data))}
+    if 'xy' in data.dtype.names:
+        xy = data['xy']
+        for axis, name in enumerate('xy'):
+            traces = xy[:, :, axis]
+            rv[f'{name}_std'] = _np.nanstd(traces, axis=0)
+            rv[f'{name}_cov'], rv[f'{name}_corr'] = roi_covariance(traces)
+            with _warnings.catch_warnings():
+                _warnings.simplefilter("ignore")
+                mean = _np.nanmean(traces, axis=1)
+            rv[f'{name}_mean_std'] = _np.nanstd(mean)
+            rv['freqs'], rv[f'{name}_psd'] = nan_welch(mean, 1. / dt, nperseg)
+            rv['taus'], rv[f'{name}_adev'] = allan_deviation(mean, dt)
+    if 'z' in data.dtype.names:
+        rv['z_std'] = _np.nanstd(data['z'])
+        rv['freqs'], rv['z_psd'] = nan_welch(data['z'], 1. / dt, nperseg)
+        rv['taus'], rv['z_adev'] = allan_deviation(data['z'], dt)
+    return rv
+
+
+def main(argv=None):
+    """Command line interface."""
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Drift statistics (PSD, Allan deviation, ROI covariance) "
+                    "of takyaq logs")
+    parser.add_argument('filenames', nargs='+', help="xy and/or z log files")
+    parser.add_argument('--t-start', type=float, default=None,
+                        help="start time (same units as the log)")
+    parser.add_argument('--t-end', type=float, default=None,
+                        help="end time (same units as the log)")
+    parser.add_argument('--nperseg', type=int, default=1024,
+                        help="Welch segment length")
+    parser.add_argument('-o', '--output', default=None,
+                        help="save results to this npz file")
+    args = parser.parse_args(argv)
+    results = {}
+    for filename in args.filenames:
+        rv = analyze_log(filename, args.t_start, args.t_end, args.nperseg)
+        print(f"{filename}: {int(rv['n_samples'])} samples, dt = {float(rv['dt']):.4g}")
+        for name in 'xyz':
+            if f'{name}_adev' not in rv:
+                continue
+            std = rv.get(f'{name}_mean_std', rv.get(f'{name}_std'))
+            adev = rv[f'{name}_adev']
+            best = _np.nanargmin(adev) if _np.isfinite(adev).any() else 0
+            print(f"  {name}: std = {float(std):.3f}, min ADEV = {adev[best]:.3f}"
+                  f" at tau = {rv['taus'][best]:.3g}")
+            if f'{name}_corr' in rv:
+                K = len(rv[f'{name}_corr'])
+                off = rv[f'{name}_corr'][~_np.eye(K, dtype=bool)]
+                if off.size:
+                    print(f"    mean ROI-ROI correlation: {_np.nanmean(off):.3f}")
+        results.update({f"{_Path(filename).stem}_{k}": v for k, v in rv.items()})
+    if args.output:
+        _np.savez(args.output, **results)
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1:
+        sys.exit(main())
+    import time
+    rng = _np.random.default_rng(0)
+    L = 2000
+    a = _np.cumsum(rng.normal(size=L))
+    b = _np.roll(a, 7) + rng.normal(size=L)
+    a[rng.integers(0, L, 100)] = _np.nan
+
+    def slicex(x, n):
+        return x if n == 0 else (x[n:] if n > 0 else x[:n])
+    t0 = time.perf_counter()
+    ref = _np.array([_np.nansum(slicex(a, l) * slicex(b, -l))
+                     for l in range(-L + 1, L)])
+    t1 = time.perf_counter()
+    offsets, corrs = nan_correlate(a, b)
+    t2 = time.perf_counter()
+    print(f"loop: {t1 - t0:.3f} s, FFT: {t2 - t1:.4f} s,",
+          "max rel. error", _np.abs(corrs - ref).max() / _np.abs(ref).max())
+    st = StreamingCorrelator(50, normalized=True)
+    for start in range(0, L, 333):
+        st.update(a[start:start + 333], b[start:start + 333])
+    full = nan_correlate(a, b, 50, normalized=True)[1]
+    print("streaming max error:", _np.nanmax(_np.abs(st.result()[1] - full)))
+    x = rng.normal(size=(100000, 3))
+    from scipy.signal import welch
+    print("PSD max rel. error vs scipy:",
+          _np.abs(nan_welch(x, 10., 512)[1] / welch(x, 10., nperseg=512, axis=0)[1] - 1).max())
+    print("ADEV of white noise (expected 1 / sqrt(m)):",
+          allan_deviation(x[:, 0], taus=[1, 100])[1])
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Batched gaussian fitting
+
+Fits the 5-parameter gaussian model used by the stabilizer (see
+`stabilizer._gaussian2D`) to many ROIs at once, in-process, using a
+vectorized Levenberg-Marquardt algorithm.
+
+@author: azelcer
+"""
+
+import numpy as _np
+import logging as _lgn
+from typing import Tuple as _Tuple
+
+_lgn.basicConfig()
+_lgr = _lgn.getLogger(__name__)
+_lgr.setLevel(_lgn.DEBUG)
+
+# Parameter order: amplitude, x0, y0, sigma, offset
+_N_PARAMS = 5
+# Smallest sigma (in pixels) accepted; the largest one is the ROI size
+_MIN_SIGMA = 0.3
+# Fits ending with sigma this close (relative) to the limits are failed
+_SIGMA_MARGIN = 0.05
+
+
+def _model_and_jacobian(params: _np.ndarray, x: _np.ndarray, y: _np.ndarray):
+    """Evaluate the gaussian model and its jacobian for every ROI.
+
+    Parameters
+    ----------
+    params : numpy.ndarray
+        (N, 5) array of parameters
+    x, y : numpy.ndarray
+        (H, 1) and (1, W) pixel coordinates
+
+    Returns
+    -------
+    model : numpy.ndarray
+        (N, H, W) model values
+    jac : numpy.ndarray
+        (N, 5, H, W) partial derivatives
+    """
+    A, x0, y0, s, off = (params[:, i, _np.newaxis, _np.newaxis]
+                         for i in range(_N_PARAMS))
+    dx = x - x0
+    dy = y - y0
+    r2 = dx**2 + dy**2
+    inv_s2 = 1. / s**2
+    E = _np.exp(-0.5 * r2 * inv_s2)
+    AE = A * E
+    jac = _np.empty((params.shape[0], _N_PARAMS) + E.shape[1:])
+    jac[:, 0] = E
+    jac[:, 1] = AE * dx * inv_s2
+    jac[:, 2] = AE * dy * inv_s2
+    jac[:, 3] = AE * r2 * inv_s2 / s
+    jac[:, 4] = 1.
+    return off + AE, jac
+
+
+def fit_gaussians(data: _np.ndarray, mask: _np.ndarray, x0: _np.ndarray,
+                  y0: _np.ndarray, sigma: _np.ndarray, max_iter: int = 50,
+                  tol: float = 1E-4) -> _np.ndarray:
+    """Fit a gaussian to each image of a stack.
+
+    All data is in PIXEL units.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        (N, H, W) stack of images, padded to a common size
+    mask : numpy.ndarray
+        (N, H, W) boolean array, True for valid (not padding) pixels
+    x0, y0, sigma : numpy.ndarray
+        (N,) initial estimators of the center and spread of each gaussian
+    max_iter : int, default 50
+        Maximum number of iterations
+    tol : float, default 1E-4
+        Convergence threshold for the relative step (in pixels for the
+        center)
+
+    Returns
+    -------
+    numpy.ndarray of shape (N, 3) with x, y and sigma of each gaussian.
+    Values are numpy.nan for the fits that failed: the ones that stalled,
+    did not converge in max_iter iterations or ended with sigma at the
+    accepted limits.
+    """
+    N, H, W = data.shape
+    x = _np.arange(H, dtype=float)[:, _np.newaxis]
+    y = _np.arange(W, dtype=float)[_np.newaxis, :]
+    w = mask.astype(float)
+    bkg = _np.where(mask, data, _np.inf).min(axis=(1, 2))
+    peak = _np.where(mask, data, -_np.inf).max(axis=(1, 2))
+    params = _np.stack([peak - bkg, x0, y0, sigma, bkg], axis=1).astype(float)
+    lam = _np.full((N,), 1E-2)
+    active = _np.ones((N,), dtype=bool)
+    failed = _np.zeros((N,), dtype=bool)
+    s_min, s_max = _MIN_SIGMA, max(H, W)
+
+    model, jac = _model_and_jacobian(params, x, y)
+    res = (data - model) * w
+    cost = _np.einsum('nij,nij->n', res, res)
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        idx = _np.flatnonzero(active)
+        J = jac[idx].reshape(len(idx), _N_PARAMS, -1) * w[idx].reshape(len(idx), 1, -1)
+        JtJ = _np.einsum('npk,nqk->npq', J, J)
+        Jtr = _np.einsum('npk,nk->np', J, res[idx].reshape(len(idx), -1))
+        diag = _np.einsum('npp->np', JtJ)
+        A = JtJ + (lam[idx, _np.newaxis] * diag)[:, :, _np.newaxis] * _np.eye(_N_PARAMS)
+        try:
+            delta = _np.linalg.solve(A, Jtr[..., _np.newaxis])[..., 0]
+        except _np.linalg.LinAlgError:
+            # singular system for some ROI: solve one by one
+            delta = _np.full((len(idx), _N_PARAMS), _np.nan)
+            for k in range(len(idx)):
+                try:
+                    delta[k] = _np.linalg.solve(A[k], Jtr[k])
+                except _np.linalg.LinAlgError:
+                    pass
+        new_params = params[idx] + delta
+        new_model, new_jac = _model_and_jacobian(new_params, x, y)
+        new_res = (data[idx] - new_model) * w[idx]
+        new_cost = _np.einsum('nij,nij->n', new_res, new_res)
+        # Only accept steps that lower the cost and keep the gaussian sensible
+        better = ((new_cost < cost[idx])  # False for NaN
+                  & (_np.abs(new_params[:, 3]) > s_min)
+                  & (_np.abs(new_params[:, 3]) < s_max)
+                  & (new_params[:, 1] > -0.5) & (new_params[:, 1] < H - 0.5)
+                  & (new_params[:, 2] > -0.5) & (new_params[:, 2] < W - 0.5))
+        acc = idx[better]
+        params[acc] = new_params[better]
+        jac[acc] = new_jac[better]
+        res[acc] = new_res[better]
+        cost[acc] = new_cost[better]
+        lam[acc] *= 0.3
+        lam[idx[~better]] *= 10.
+        step = _np.abs(delta[:, 1:4]).max(axis=1)
+        converged = better & (step < tol * _np.maximum(1., _np.abs(params[idx, 3])))
+        stalled = ~_np.isfinite(delta).all(axis=1) | (lam[idx] > 1E10)
+        failed[idx[stalled]] = True
+        active[idx[converged | stalled]] = False
+    rv = params[:, 1:4].copy()
+    rv[:, 2] = _np.abs(rv[:, 2])
+    failed |= (active | ~_np.isfinite(params).all(axis=1)
+               | (rv[:, 2] < s_min * (1. + _SIGMA_MARGIN))
+               | (rv[:, 2] > s_max * (1. - _SIGMA_MARGIN)))
+    rv[failed] = _np.nan
+    return rv
+
+
+class BatchGaussianFitter:
+    """Fits gaussians to a fixed set of ROIs of an image.
+
+    Buffers for the padded ROI stack are allocated once, when created.
+    """
+
+    def __init__(self, rois: _np.ndarray):
+        """Prepare buffers.
+
+        Parameters
+        ----------
+        rois : numpy.ndarray
+            [ [min, max]_x, [min, max]_y] * n_rois, as used by the stabilizer
+        """
+        self._rois = _np.array(rois, dtype=int)
+        sizes = self._rois[:, :, 1] - self._rois[:, :, 0]
+        H, W = sizes.max(axis=0)
+        n = len(self._rois)
+        self._data = _np.zeros((n, H, W))
+        self._mask = _np.zeros((n, H, W), dtype=bool)
+        for i, (h, w) in enumerate(sizes):
+            self._mask[i, :h, :w] = True
+
+    def stack(self, image: _np.ndarray) -> _Tuple[_np.ndarray, _np.ndarray]:
+        """Copy the ROIs of image into the padded stack."""
+        for i, roi in enumerate(self._rois):
+            sub = image[roi[0, 0]: roi[0, 1], roi[1, 0]: roi[1, 1]]
+            self._data[i, :sub.shape[0], :sub.shape[1]] = sub
+        return self._data, self._mask
+
+    def fit(self, image: _np.ndarray, x0: _np.ndarray, y0: _np.ndarray,
+            sigma: _np.ndarray) -> _np.ndarray:
+        """Fit all ROIs of image.
+
+        Parameters
+        ----------
+        image : numpy.ndarray
+            2D array with the image to process
+        x0, y0, sigma : numpy.ndarray
+            initial estimators (inside each ROI, in pixels)
+
+        Returns
+        -------
+        numpy.ndarray of shape (NROIS, 3) with x, y (inside each ROI) and
+        sigma, in pixels. numpy.nan marks failed fits.
+        """
+        data, mask = self.stack(image)
+        return fit_gaussians(data, mask, x0, y0, sigma)
+
+
+if __name__ == '__main__':
+    import time
+    rng = _np.random.default_rng(0)
+    n_rois, size = 16, 20
+    rois = _np.array([[[i * size, (i + 1) * size], [0, size - (i % 3)]]
+                      for i in range(n_rois)])
+    image = rng.poisson(10., (n_rois * size, size)).astype(float)
+    centers = rng.uniform(7, 11, (n_rois, 2))
+    xx, yy = _np.meshgrid(_np.arange(size), _np.arange(size), indexing='ij')
+    for (x, y), roi in zip(centers, rois):
+        image[roi[0, 0]: roi[0, 1], :] += 200 * _np.exp(
+            -((xx - x)**2 + (yy - y)**2) / (2 * 2.5**2))
+    fitter = BatchGaussianFitter(rois)
+    guess = _np.round(centers)
+    t0 = time.perf_counter()
+    locs = fitter.fit(image, guess[:, 0], guess[:, 1], _np.full(n_rois, 3.))
+    print(f"{(time.perf_counter() - t0) * 1E3:.2f} ms for {n_rois} ROIs")
+    print("max error (px):", _np.abs(locs[:, :2] - centers).max())
@@ -19,7 +19,7 @@ import numpy as _np
 import time as _time
 import datetime as _datetime
 import pathlib as _pathlib
-from typing import Optional as _Optional, BinaryIO as _BinaryIO, Tuple as _Tuple
+from typing import Optional as _Optional, Tuple as _Tuple
 from configparser import ConfigParser as _ConfigParser
 import warnings
 from PyQt5.QtCore import pyqtSignal, pyqtSlot, QObject, Qt
@@ -44,6 +44,7 @@ import logging as _lgn
 from ..stabilizer import Stabilizer, PointInfo, ROI, CameraInfo
 
 import takyaq.base_classes as _bc
+from .. import datalog as _datalog
 
 
 _lgr = _lgn.getLogger(__name__)
@@ -65,6 +66,9 @@ _DEFAULT_CONFIG = {
         }
     }
 
+# Minimum time between displayed images, in seconds
+_IMAGE_PERIOD = 0.05
+
 _NPY_Z_DTYPE = _np.dtype([
     ('t', _np.float64),
     ('z', _np.float64),
@@ -77,10 +81,11 @@ class QReader(QObject):
     Implements a method that receives a PointInfo object. This is how the
     stabilizer thread reports the last data.
 
-    In this case (a PyQT application), we emit a signal to the GUI.
+    In this case (a PyQT application), we emit a signal to the GUI. The image
+    might be None (see `Stabilizer.add_callbacks`).
     """
 
-    new_data = pyqtSignal(float, _np.ndarray, float, _np.ndarray)
+    new_data = pyqtSignal(float, object, float, _np.ndarray)
 
     def cb(self, data: PointInfo):
         """Report data."""
@@ -280,8 +285,8 @@ class Frontend(QFrame):
     _save_pos = 0  # shared for xy and z so data alignment is easier
     _save_data: bool = False
     _SAVE_PERIOD = 0.05
-    _xy_fd: _BinaryIO = None
-    _z_fd: _BinaryIO = None
+    _xy_log: _datalog.LogWriter = None
+    _z_log: _datalog.LogWriter = None
     _t_save_data = _np.full((0,), _np.nan)
     _z_save_data = _np.full((0,), _np.nan)
     _xy_save_data = _np.full((0, 0, 2), _np.nan)
@@ -317,7 +322,8 @@ class Frontend(QFrame):
         self.reset_xy_data_buffers(len(self._roilist))
         self.reset_z_data_buffers()
         self._stabilizer = stabilizer
-        self._stabilizer.add_callbacks(self._cbojt.cb, None, None)
+        self._stabilizer.add_callbacks(self._cbojt.cb, None, None,
+                                       image_period=_IMAGE_PERIOD)
         self._t0 = _time.time()
         self._set_delay(True)
         self._config_window = ConfigWindow(self, controller)
@@ -547,44 +553,46 @@ class Frontend(QFrame):
         if check_status == Qt.CheckState.Unchecked:
             if self._save_data:  # in case file open failed
                 self._save_and_reset()
-                self._xy_fd.close()
-                self._xy_fd = None
-                self._z_fd.close()
-                self._z_fd = None
+                self._xy_log.close()
+                self._xy_log = None
+                self._z_log.close()
+                self._z_log = None
                 self._save_data = False
         else:
             base_dir = _pathlib.Path.home() / "takyaq_data"
             base_dir.mkdir(parents=True, exist_ok=True)
             date_str = _datetime.datetime.now().isoformat(
                 timespec='seconds').replace('-', '').replace(':', '-')
-            xy_filename = base_dir / ('xy_data' + date_str + '.npy')
-            z_filename = base_dir / ('z_data' + date_str + '.npy')
+            xy_filename = base_dir / ('xy_data' + date_str + _datalog.EXTENSION)
+            z_filename = base_dir / ('z_data' + date_str + _datalog.EXTENSION)
             try:
-                self._xy_fd = open(xy_filename, 'wb')
-                self._z_fd = open(z_filename, 'wb')
+                self._xy_log = _datalog.LogWriter(xy_filename)
+                self._z_log = _datalog.LogWriter(z_filename, _NPY_Z_DTYPE)
             except Exception as e:
-                if self._xy_fd:
-                    self._xy_fd.close()
-                    self._xy_fd = None
+                if self._xy_log:
+                    self._xy_log.close()
+                    self._xy_log = None
                 _lgr.error("Can not open output files: %s (%s)", type(e), e)
                 self.export_chkbx.setChecked(False)
             self._save_data = True
             self._save_pos = 0
 
     def _save_and_reset(self):
-        if self._xy_tracking_enabled:
-            save_data = _np.array(
-                list(zip(self._t_save_data[:self._save_pos],
-                         self._xy_save_data[:self._save_pos])),
-                dtype=self._npy_xy_dtype)
-            _np.save(self._xy_fd, save_data)
-        if self._z_tracking_enabled:
-            save_data = _np.array(
-                list(zip(self._t_save_data[:self._save_pos],
-                         self._z_save_data[:self._save_pos],
-                         )),
-                dtype=_NPY_Z_DTYPE)
-            _np.save(self._z_fd, save_data)
+        """Queue buffered data to the logs (written in the background)."""
+        n = self._save_pos
+        try:
+            if self._xy_tracking_enabled:
+                save_data = _np.empty((n,), dtype=self._npy_xy_dtype)
+                save_data['t'] = self._t_save_data[:n]
+                save_data['xy'] = self._xy_save_data[:n]
+                self._xy_log.append(save_data)
+            if self._z_tracking_enabled:
+                save_data = _np.empty((n,), dtype=_NPY_Z_DTYPE)
+                save_data['t'] = self._t_save_data[:n]
+                save_data['z'] = self._z_save_data[:n]
+                self._z_log.append(save_data)
+        except ValueError as e:  # number of ROIs changed
+            _lgr.error("Can not save data: %s", e)
         self._save_pos = 0
 
     @pyqtSlot(bool)
@@ -611,7 +619,7 @@ class Frontend(QFrame):
         self._z_ROI.setSize(ROIsize, update=False)
         self._z_ROI.setPos(roi.min_x, roi.min_y)
 
-    @pyqtSlot(float, _np.ndarray, float, _np.ndarray)
+    @pyqtSlot(float, object, float, _np.ndarray)
     def get_data(self, t: float, img: _np.ndarray, z: float, xy_shifts: _np.ndarray):
         """Receive data from the stabilizer and graph it."""
         if self._save_pos >= self._SAVE_PERIOD and self._save_data:
@@ -629,8 +637,9 @@ class Frontend(QFrame):
             self._graph_pos -= 1
 
         # manage image data
-        self.img.setImage(img, autoLevels=self.lastimage is None)
-        self.lastimage = img
+        if img is not None:
+            self.img.setImage(img, autoLevels=self.lastimage is None)
+            self.lastimage = img
         # self._I_data[self._graph_pos] = _np.average(img)
         self._t_save_data[self._save_pos] = self._t_data[self._graph_pos] = t
         t_data = self._t_data[: self._graph_pos + 1] - self._t0
@@ -5,7 +5,7 @@
 import numpy as _np
 import scipy as _sp
 import time as _time
-from typing import Optional as _Optional, BinaryIO as _BinaryIO
+from typing import Optional as _Optional
 
 import warnings
 from PyQt5.QtCore import pyqtSignal, pyqtSlot, QObject, Qt
@@ -25,29 +25,16 @@ from PyQt5.QtWidgets import (
 
 import pyqtgraph as _pg
 
+from .. import datalog as _datalog
+from ..drift_tools import (nan_correlate, nan_welch as _nan_welch,
+                           allan_deviation as _allan_deviation,
+                           sampling_period as _sampling_period)
+
 import logging as _lgn
 
 _lgr = _lgn.getLogger(__name__)
 
 
-def slicex(x, n):
-    if n == 0:
-        return x
-    if n > 0:
-        return x[n:]
-    if n < 0:
-        return x[:n]
-
-
-def nan_correlate(a, b):
-    if (not (len(a) == len(b))):
-        raise IOError("input must have same length")
-    L = len(a)
-    offsets = _np.arange(-L+1, L)
-    corrs = _np.array([_np.nansum(slicex(a, l) * slicex(b, -l)) for l in offsets])
-    return offsets, corrs
-
-
 class Frontend(QFrame):
     """PyQt Frontend for Takyaq.
 
@@ -104,31 +91,19 @@ class Frontend(QFrame):
         self.xmeanCurve.setZValue(roi_len)
         self.ymeanCurve.setZValue(roi_len)
 
-    def _load_data(self):
-        with open(r"C:\Users\Minflux\takyaq_data\xy_data20250130T19-18-08.npy", 'rb') as fd:
-            data = []
-            n_batches = 0
-            try:
-                while True:
-                    data.append(_np.load(fd, allow_pickle=True))
-                    n_batches += 1
-            except EOFError:
-                print(f"Loaded {n_batches} of lenghts {[len(x) for x in data]}")
-            self._data = _np.concatenate(data) if data else None
-            if self._data is not None:
-                self._data['t'] -= self._data['t'][0]
-        with open(r"C:\Users\Minflux\takyaq_data\z_data20250130T19-18-08.npy", 'rb') as fd:
-            data = []
-            n_batches = 0
-            try:
-                while True:
-                    data.append(_np.load(fd, allow_pickle=True))
-                    n_batches += 1
-            except EOFError:
-                print(f"Loaded {n_batches} of lenghts {[len(x) for x in data]}")
-            self._z_data = _np.concatenate(data) if data else None
-            if self._z_data is not None:
-                self._z_data['t'] -= self._z_data['t'][0]
+    def _load_data(self,
+                   xy_filename=r"C:\Users\Minflux\takyaq_data\xy_data20250130T19-18-08.npy",
+                   z_filename=r"C:\Users\Minflux\takyaq_data\z_data20250130T19-18-08.npy",
+                   t_start: _Optional[float] = None, t_end: _Optional[float] = None):
+        """Load data (logs or legacy npy files), optionally a time window."""
+        self._data = _datalog.load(xy_filename, t_start, t_end)
+        if self._data is not None:
+            self._data = _np.array(self._data)  # copy out of the memmap
+            self._data['t'] -= self._data['t'][0]
+        self._z_data = _datalog.load(z_filename, t_start, t_end)
+        if self._z_data is not None:
+            self._z_data = _np.array(self._z_data)
+            self._z_data['t'] -= self._z_data['t'][0]
         if self._data is not None:
             print("cargamos", len(self._data), " puntos xy.")
             print("El numero de ROIs es de", len(self._data[0]['xy']), " puntos.")
@@ -139,6 +114,7 @@ class Frontend(QFrame):
         if self._z_data is not None:
             z_data = self._z_data['z']
             z_t_data = self._z_data['t']# - self._z_data['t'][0]
+            self._plot_noise(self.zpsdplot, self.zadevplot, z_t_data, z_data)
             self.zstd_value.setText(f"{_np.nanstd(z_data):.2f}")
             # update Graphs
             self.zCurve.setData(z_t_data, z_data)
@@ -183,6 +159,18 @@ class Frontend(QFrame):
             dt = t_data[-1] - t_data[-2]
             self.xacplot.setData(x_off* dt, x_corr)
             self.yacplot.setData(y_off * dt, y_corr)
+            self._plot_noise(self.xpsdplot, self.xadevplot, t_data, x_mean)
+            self._plot_noise(self.ypsdplot, self.yadevplot, t_data, y_mean)
+
+    def _plot_noise(self, psd_curve, adev_curve, t: _np.ndarray, data: _np.ndarray):
+        """Plot PSD and Allan deviation of a trace."""
+        if len(data) < 4:
+            return
+        dt = _sampling_period(t)
+        freqs, psd = _nan_welch(data, 1. / dt, 1024)
+        psd_curve.setData(freqs[1:], psd[1:])
+        taus, adev = _allan_deviation(data, dt)
+        adev_curve.setData(taus, adev)
 
     def setup_gui(self):
         """Create and lay out all GUI objects."""
@@ -200,6 +188,26 @@ class Frontend(QFrame):
         self.xyzGraph = _pg.GraphicsLayoutWidget()
         # self.xyzGraph.xPlot = self.xyzGraph.addPlot(row=0, col=0)
 
+        # Noise: power spectral density and Allan deviation
+        self.noiseGraph = _pg.GraphicsLayoutWidget()
+        self.noiseGraph.setAntialiasing(True)
+        self.noiseGraph.psdPlot = self.noiseGraph.addPlot(row=0, col=0)
+        self.noiseGraph.psdPlot.setLogMode(x=True, y=True)
+        self.noiseGraph.psdPlot.setLabels(bottom=("Frequency", "Hz"),
+                                          left=("PSD", "nm²/Hz"))
+        self.noiseGraph.psdPlot.showGrid(x=True, y=True)
+        self.xpsdplot = self.noiseGraph.psdPlot.plot(pen='r')
+        self.ypsdplot = self.noiseGraph.psdPlot.plot(pen='g')
+        self.zpsdplot = self.noiseGraph.psdPlot.plot(pen='y')
+        self.noiseGraph.adevPlot = self.noiseGraph.addPlot(row=0, col=1)
+        self.noiseGraph.adevPlot.setLogMode(x=True, y=True)
+        self.noiseGraph.adevPlot.setLabels(bottom=("\u03C4", "s"),
+                                           left=("Allan deviation", "nm"))
+        self.noiseGraph.adevPlot.showGrid(x=True, y=True)
+        self.xadevplot = self.noiseGraph.adevPlot.plot(pen='r', symbol='o', symbolSize=4)
+        self.yadevplot = self.noiseGraph.adevPlot.plot(pen='g', symbol='o', symbolSize=4)
+        self.zadevplot = self.noiseGraph.adevPlot.plot(pen='y', symbol='o', symbolSize=4)
+
         # Data saving
         datagb = QGroupBox("Data")
         data_layout = QHBoxLayout()
@@ -282,6 +290,7 @@ class Frontend(QFrame):
         grid.addWidget(self.statWidget, 0, 2)
         grid.addWidget(self.xyzGraph, 1, 0)
         grid.addWidget(self.xyPoint, 1, 1, 1, 2)  # agrego 1,2 al final
+        grid.addWidget(self.noiseGraph, 2, 0, 1, 3)
 
     def closeEvent(self, *args, **kwargs):
         """Shut down stabilizer on exit."""
@@ -44,7 +44,7 @@ class PointInfo:
     """Holds data for a single point in timeline."""
 
     time: float
-    image: _np.ndarray
+    image: _Union[_np.ndarray, None]  # None if not included in this report
     z_shift: _Union[float, None]
     xy_shifts: _Union[_np.ndarray, None]
 
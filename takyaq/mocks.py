@@ -40,6 +40,11 @@ class MockCamera(BaseCamera):
 
     Moreover, it adds random noise to the position of the marks and a
     background noise.
+
+    Marks are rendered only within +-4 sigma of their centers. The background
+    is copied from a random offset of a precomputed bank of poisson noise.
+    Images are returned from a ring of `ring_size` reusable buffers: an image
+    is overwritten `ring_size` calls later.
     """
 
     max_x = 1200
@@ -63,12 +68,14 @@ class MockCamera(BaseCamera):
     _X_PERIOD = 4
     _Y_PERIOD = _np.e*4
     _Z_PERIOD = _np.pi*4
-    _shifts = _np.zeros((3,), dtype=_np.float64)
-    grid = _np.array(_np.meshgrid(_np.arange(max_x), _np.arange(max_y), indexing="ij"))
+    _BKGD = 3.  # mean background counts
+    _AMPLITUDE = 100.
+    _NOISE_OFFSETS = 1 << 16  # number of different background realizations
     # f = True  # Camera fail first call flag
 
     def __init__(self, nmpp_x, nmpp_y, nmpp_z, sigma, z_ang: float, noise_level=3,
-                 drift_amplitude=3):
+                 drift_amplitude=3, shape=None, n_marks=None, ring_size=8,
+                 seed=None):
         """Init Mock camera.
 
         Parameters
@@ -87,6 +94,16 @@ class MockCamera(BaseCamera):
             Random shifts of XYZ positions in nm. The default is 3.
         drift_amplitude : float, optional
             Amplitude of the periodic shift in nm. The default is 3.
+        shape : tuple of int, optional
+            Image shape (X, Y). The default is (max_x, max_y).
+        n_marks : int, optional
+            Number of XY fiducial marks, laid out on a regular grid. The
+            default uses the marks in `centers`. The Z reflection is always
+            the last item of `self.centers`.
+        ring_size : int, optional
+            Number of output buffers. The default is 8.
+        seed : int, optional
+            Random generator seed.
         """
         self._nl = noise_level
         self._drift = drift_amplitude
@@ -96,6 +113,55 @@ class MockCamera(BaseCamera):
         self._z_ang = z_ang
         self._rot_vec = _np.array((_np.cos(self._z_ang), _np.sin(self._z_ang),))
         self.sigma = sigma
+        self._shifts = _np.zeros((3,), dtype=_np.float64)
+        if shape is not None:
+            self.max_x, self.max_y = shape
+        if n_marks is not None:
+            self.centers = self._grid_centers(n_marks)
+        self._rng = _np.random.default_rng(seed)
+        n_pixels = self.max_x * self.max_y
+        self._noise = self._rng.poisson(
+            self._BKGD, n_pixels + self._NOISE_OFFSETS).astype(_np.uint16)
+        self._ring = _np.empty((ring_size, self.max_x, self.max_y), dtype=_np.uint16)
+        self._ring_idx = 0
+        self._xy_centers = _np.array(self.centers[:-1], dtype=float).reshape(-1, 2)
+        self._z_center = _np.array(self.centers[-1], dtype=float)
+
+    def _grid_centers(self, n_marks: int):
+        """Lay out n_marks on a grid, plus a Z mark near the bottom right corner."""
+        # leave the last 20% of the frame for the Z reflection
+        n_cols = int(_np.ceil(_np.sqrt(n_marks * self.max_y / self.max_x)))
+        n_rows = int(_np.ceil(n_marks / n_cols))
+        xs = _np.linspace(0, 0.75 * self.max_x, n_rows + 2)[1:-1]
+        ys = _np.linspace(0, self.max_y, n_cols + 2)[1:-1]
+        xy = [(int(x), int(y)) for x in xs for y in ys][:n_marks]
+        return tuple(xy) + ((int(0.9 * self.max_x), int(0.9 * self.max_y)),)
+
+    def _render(self, image: _np.ndarray, positions: _np.ndarray, sigma_px: float):
+        """Add gaussian marks to image, only within +-4 sigma of each center.
+
+        positions is a (n, 2) array. Gaussians are separable, so each patch
+        is the outer product of two 1D profiles.
+        """
+        half = max(int(sigma_px * 4), 1)
+        offsets = _np.arange(-half, half + 1)
+        corners = positions.astype(int) - half
+        a = 1.0 / (2 * sigma_px**2)
+        # (n, 2 * half + 1) profiles along each axis, all marks at once
+        px = corners[:, 0:1] + half + offsets
+        py = corners[:, 1:2] + half + offsets
+        gx = self._AMPLITUDE * _np.exp(-a * (px - positions[:, 0:1]) ** 2)
+        gy = _np.exp(-a * (py - positions[:, 1:2]) ** 2)
+        for (cx, cy), vx, vy in zip(corners, gx, gy):
+            x0 = max(cx, 0)
+            x1 = min(cx + 2 * half + 1, self.max_x)
+            y0 = max(cy, 0)
+            y1 = min(cy + 2 * half + 1, self.max_y)
+            if x0 >= x1 or y0 >= y1:
+                continue
+            patch = _np.outer(vx[x0 - cx: x1 - cx], vy[y0 - cy: y1 - cy])
+            patch += 0.5  # round
+            image[x0:x1, y0:y1] += patch.astype(image.dtype)
 
     def get_image(self):
         """Return a faked image."""
@@ -103,50 +169,28 @@ class MockCamera(BaseCamera):
         #     if _np.random.random_sample() > 0.9:  # falla una de cada 10
         #         raise ValueError("error en camara")
         # self.f = False
-        rv = _np.random.poisson(
-            3,
-            (
-                self.max_x,
-                self.max_y,
-            ),
-        ).astype(_np.float64)
+        rv = self._ring[self._ring_idx]
+        self._ring_idx = (self._ring_idx + 1) % len(self._ring)
+        offset = self._rng.integers(self._NOISE_OFFSETS)
+        rv.ravel()[:] = self._noise[offset: offset + rv.size]
         t = _time.monotonic()
-        # limit gaussian creation to +-4 sigma from center for speed
-        slice_size = int(self.sigma / self._nmpp_x * 4)  # in pixels
-        for x0, y0 in self.centers[:-1]:
-            x0 += self._shifts[0] / self._nmpp_x
-            y0 += self._shifts[1] / self._nmpp_y
-            x0 += (
-                (_np.random.random_sample() - 0.5) * self._nl
-                + _np.sin(t / self._X_PERIOD * 2 * _np.pi) * self._drift
-            ) / self._nmpp_x
-            y0 += (
-                (_np.random.random_sample() - 0.5) * self._nl
-                + _np.sin(t / self._Y_PERIOD * 2 * _np.pi) * self._drift
-            ) / self._nmpp_y
-            cx = int(x0)
-            cy = int(y0)
-            slicex = slice(max(cx - slice_size, 0), min(cx + slice_size, self.max_x))
-            slicey = slice(max(cy - slice_size, 0), min(cy + slice_size, self.max_y))
-            rv[slicex, slicey] += gaussian2D(
-                self.grid[:, slicex, slicey], 100, x0, y0, self.sigma / self._nmpp_x, 0
-            )
+        n = len(self._xy_centers)
+        drift = _np.array((_np.sin(t / self._X_PERIOD * 2 * _np.pi) * self._drift,
+                           _np.sin(t / self._Y_PERIOD * 2 * _np.pi) * self._drift))
+        noise = (self._rng.random((n, 2)) - 0.5) * self._nl
+        nmpp = _np.array((self._nmpp_x, self._nmpp_y))
+        positions = self._xy_centers + (self._shifts[:2] + drift + noise) / nmpp
+        sigma_px = self.sigma / self._nmpp_x
 
         # Z mocking: triangular wave
         r = self._shifts[2] + self._drift * (2 * abs(2 * (
             t / self._Z_PERIOD - _np.floor(t / self._Z_PERIOD + 0.5)))-1)
         r *= self._rot_vec / self._nmpp_z
-        r += (_np.random.random_sample((2,)) - 0.5) * self._nl
-        r += _np.array(self.centers[-1])
-
-        cx = int(r[0])
-        cy = int(r[1])
-        slicex = slice(max(cx - slice_size, 0), min(cx + slice_size, self.max_x))
-        slicey = slice(max(cy - slice_size, 0), min(cy + slice_size, self.max_y))
-        rv[slicex, slicey] += gaussian2D(  # use X coordinate nmpp, since it maps OK
-            self.grid[:, slicex, slicey], 100, r[0], r[1], self.sigma / self._nmpp_x, 0
-        )
-        return rv.astype(_np.uint16)
+        r += (self._rng.random((2,)) - 0.5) * self._nl
+        r += self._z_center
+        # use X coordinate nmpp for Z, since it maps OK
+        self._render(rv, _np.vstack((positions, r)), sigma_px)
+        return rv
 
     def shift(self, dx: float, dy: float, dz: float):
         """Shift origin of coordinates.
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Replay of recorded frames
+
+`ReplayCamera` streams a recorded stack of frames (npy or TIFF files, memory
+mapped when possible) to the stabilizer, so fitting and controllers can be
+tested without the microscope. `RecordingPiezo` is a piezo that only records
+the requested positions.
+
+@author: azelcer
+"""
+
+import numpy as _np
+import threading as _th
+import logging as _lgn
+from pathlib import Path as _Path
+from typing import Union as _Union, Tuple as _Tuple, List as _List
+
+from .base_classes import BaseCamera, BasePiezo
+
+_lgr = _lgn.getLogger(__name__)
+
+
+def load_stack(filename: _Union[str, _Path]) -> _np.ndarray:
+    """Load a (n_frames, X, Y) stack, memory mapped when possible.
+
+    Supports .npy and TIFF files. TIFF support requires `tifffile`.
+    """
+    filename = _Path(filename)
+    if filename.suffix.lower() == '.npy':
+        stack = _np.load(filename, mmap_mode='r')
+    elif filename.suffix.lower() in ('.tif', '.tiff'):
+        import tifffile
+        try:
+            stack = tifffile.memmap(filename, mode='r')
+        except ValueError:  # compressed or not contiguous
+            _lgr.info("Can not memory map %s: loading it", filename)
+            stack = tifffile.imread(filename)
+    else:
+        raise ValueError(f"Unsupported file type: {filename.suffix}")
+    if stack.ndim == 2:
+        stack = stack[_np.newaxis]
+    if stack.ndim != 3:
+        raise ValueError(f"Invalid stack shape {stack.shape}")
+    return stack
+
+
+class ReplayCamera(BaseCamera):
+    """Camera that returns recorded frames, one per call.
+
+    Frames are returned as read-only views when the source is memory mapped.
+    """
+
+    def __init__(self, source: _Union[str, _Path, _np.ndarray], loop: bool = True):
+        """Init camera.
+
+        Parameters
+        ----------
+        source: str, pathlib.Path or numpy.ndarray
+            File name (see `load_stack`) or (n_frames, X, Y) array
+        loop: bool, default True
+            Start over when all frames have been returned. If False, raise
+            `StopIteration` instead.
+        """
+        if isinstance(source, _np.ndarray):
+            self._frames = source if source.ndim == 3 else source[_np.newaxis]
+        else:
+            self._frames = load_stack(source)
+        self._loop = loop
+        self._idx = 0
+        self._lock = _th.Lock()
+        self.n_served = 0
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    @property
+    def shape(self) -> _Tuple[int, int]:
+        """Frame shape."""
+        return self._frames.shape[1:]
+
+    @property
+    def exhausted(self) -> bool:
+        """True if every frame has been returned and loop is False."""
+        return not self._loop and self._idx >= len(self._frames)
+
+    def rewind(self):
+        """Start again from the first frame."""
+        with self._lock:
+            self._idx = 0
+
+    def get_image(self) -> _np.ndarray:
+        """Return next frame."""
+        with self._lock:
+            if self._idx >= len(self._frames):
+                if not self._loop:
+                    raise StopIteration("No more frames")
+                self._idx = 0
+            rv = self._frames[self._idx]
+            self._idx += 1
+            self.n_served += 1
+        return rv
+
+
+class RecordingPiezo(BasePiezo):
+    """Piezo that records every requested position and does nothing else."""
+
+    def __init__(self, position: _Tuple[float, float, float] = (0., 0., 0.)):
+        self._pos = _np.array(position, dtype=float)
+        self.history: _List[_Tuple[float, float, float]] = []
+
+    def get_position(self) -> _Tuple[float, float, float]:
+        return tuple(self._pos)
+
+    def set_position_xy(self, x: float, y: float):
+        self._pos[:2] = x, y
+        self.history.append(tuple(self._pos))
+
+    def set_position_z(self, z: float):
+        self._pos[2] = z
+        self.history.append(tuple(self._pos))
+
+    def moves(self) -> _np.ndarray:
+        """Return the (n, 3) array of positions requested so far."""
+        return _np.array(self.history).reshape(-1, 3)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous reporting
+
+Fans out `PointInfo` objects to subscribers without blocking the publisher.
+Each subscriber is served by its own thread through a small bounded queue: if
+a subscriber can not keep up, the oldest pending reports are dropped.
+
+Each subscriber can decimate its reports:
+    - `min_period`: reports arriving sooner than this are dropped.
+    - `image_period`: the image is sent at most once per period. In other
+      reports the `image` field is None.
+
+Images are copied when (and only when) they are forwarded, so publishers can
+pass buffers that the camera reuses.
+
+@author: azelcer
+"""
+
+import threading as _th
+import logging as _lgn
+import time as _time
+from collections import deque as _deque
+from dataclasses import replace as _replace
+from typing import List as _List
+
+from .info_types import PointInfo, report_callback_type
+
+_lgr = _lgn.getLogger(__name__)
+
+# Default number of reports waiting for each subscriber
+_QUEUE_SIZE = 8
+
+
+class _Subscriber:
+    """Delivers reports to a single callback from its own thread."""
+
+    def __init__(self, callback: report_callback_type, min_period: float,
+                 image_period: float, queue_size: int):
+        self.callback = callback
+        self.min_period = min_period
+        self.image_period = image_period
+        self.dropped = 0
+        self._queue = _deque(maxlen=queue_size)
+        self._event = _th.Event()
+        self._stop = False
+        self._last_t = -float('inf')
+        self._last_image_t = -float('inf')
+        self._thread = _th.Thread(target=self._run, daemon=True,
+                                  name=f"Report subscriber {callback!r}")
+        self._thread.start()
+
+    def offer(self, data: PointInfo, get_image=None):
+        """Queue data, applying decimation. Never blocks.
+
+        If the image is forwarded, it is replaced by `get_image()` if given.
+        """
+        now = _time.monotonic()
+        if now - self._last_t < self.min_period:
+            return
+        self._last_t = now
+        if data.image is not None:
+            if now - self._last_image_t < self.image_period:
+                data = _replace(data, image=None)
+            else:
+                self._last_image_t = now
+                if get_image is not None:
+                    data = _replace(data, image=get_image())
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped += 1
+        self._queue.append(data)
+        self._event.set()
+
+    def close(self, timeout: float = 1.):
+        """Stop the delivery thread."""
+        self._stop = True
+        self._event.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop:
+            self._event.wait()
+            self._event.clear()
+            while self._queue and not self._stop:
+                try:
+                    data = self._queue.popleft()
+                except IndexError:
+                    break
+                try:
+                    self.callback(data)
+                except Exception as e:
+                    _lgr.warning("Exception reporting to callback: %s(%s)",
+                                 type(e), e)
+
+
+class ReportPublisher:
+    """Publish reports to subscribers asynchronously."""
+
+    def __init__(self):
+        self._subscribers: _List[_Subscriber] = []
+        self._closed = False
+
+    def subscribe(self, callback: report_callback_type, min_period: float = 0.,
+                  image_period: float = 0., queue_size: int = _QUEUE_SIZE):
+        """Add a subscriber.
+
+        Parameters
+        ----------
+        callback: takyaq.info_types.report_callback_type
+            Function to call. It is called from a thread owned by the
+            publisher. It might receive reports with `image` set to None.
+        min_period: float, default 0.
+            Minimum time between reports, in seconds.
+        image_period: float, default 0.
+            Minimum time between reports that include the image, in seconds.
+        queue_size: int
+            Maximum number of pending reports.
+        """
+        self._subscribers.append(
+            _Subscriber(callback, min_period, image_period, queue_size))
+
+    def unsubscribe(self, callback: report_callback_type) -> bool:
+        """Remove a subscriber. Returns False if not subscribed."""
+        for sub in self._subscribers:
+            if sub.callback == callback:
+                self._subscribers.remove(sub)
+                sub.close()
+                return True
+        return False
+
+    def publish(self, data: PointInfo):
+        """Send data to every subscriber. Never blocks.
+
+        The image is copied at most once, and only if a subscriber takes it.
+        Does nothing after `close`.
+        """
+        if self._closed:
+            return
+        image_copy = []
+
+        def get_image():
+            if not image_copy:
+                image_copy.append(data.image.copy())
+            return image_copy[0]
+
+        for sub in self._subscribers:
+            sub.offer(data, get_image)
+
+    def dropped(self) -> _List[int]:
+        """Number of reports dropped by each subscriber because of overruns."""
+        return [sub.dropped for sub in self._subscribers]
+
+    def close(self):
+        """Stop all delivery threads.
+
+        Drop counts are kept, so `dropped` can be queried afterwards.
+        """
+        self._closed = True
+        for sub in self._subscribers:
+            sub.close()
@@ -13,17 +13,30 @@ import time as _time
 import os as _os
 from typing import Optional as _Optional, List as _List, Tuple as _Tuple
 from concurrent.futures import ProcessPoolExecutor as _PPE
+from multiprocessing import shared_memory as _shm
 import warnings as _warnings
+from collections import deque as _deque
 from typing import Union as _Union
 from .info_types import (ROI, PointInfo, CameraInfo, StabilizationType,
                          report_callback_type, init_callback_type,
                          end_callback_type)
 from . import base_classes as _bc
+from .fitting import BatchGaussianFitter as _BatchGaussianFitter
+from .reporting import ReportPublisher as _ReportPublisher
+from .clocks import SystemClock as _SystemClock
+from . import z_estimators as _z_estimators
 
 _lgn.basicConfig()
 _lgr = _lgn.getLogger(__name__)
 _lgr.setLevel(_lgn.DEBUG)
 
+# Number of frame slots in the shared memory ring used in 'pool' fit mode
+_N_FRAME_SLOTS = 4
+# Number of durations kept for each pipeline stage timing stats
+_N_STAGE_TIMES = 200
+# Shared memory frame rings attached by this (worker) process, by name
+_attached_rings = {}
+
 
 def _gaussian2D(grid, amplitude, x0, y0, sigma, offset, ravel=True):
     """Generate a 2D gaussian.
@@ -107,6 +120,39 @@ def _gaussian_fit(
     return popt[1:4]
 
 
+def _attach_ring(name: str, shape: _Tuple[int, ...], dtype: str) -> _np.ndarray:
+    """Attach (once) to a shared memory frame ring and return it as an array."""
+    if name not in _attached_rings:
+        for old_shm, _ in _attached_rings.values():
+            old_shm.close()
+        _attached_rings.clear()
+        shm = _shm.SharedMemory(name=name)
+        _attached_rings[name] = (shm, _np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    return _attached_rings[name][1]
+
+
+def _shared_gaussian_fit(
+    ring_info: _Tuple[str, _Tuple[int, ...], str], slot: int, roi: _np.ndarray,
+    x_max: float, y_max: float, sigma: float
+) -> _Tuple[float, float, float]:
+    """Fit a gaussian to a ROI of a frame in a shared memory ring.
+
+    Parameters
+    ----------
+    ring_info: tuple
+        Name, shape and dtype of the ring
+    slot: int
+        Ring slot holding the frame
+    roi: numpy.ndarray
+        [[min, max]_x, [min, max]_y] of the ROI
+    x_max, y_max, sigma: float
+        Initial estimators, see `_gaussian_fit`
+    """
+    frames = _attach_ring(*ring_info)
+    data = frames[slot, roi[0, 0]: roi[0, 1], roi[1, 0]: roi[1, 1]]
+    return _gaussian_fit(data, x_max, y_max, sigma)
+
+
 class Stabilizer(_th.Thread):
     """Wraps a stabilization thread.
 
@@ -115,9 +161,17 @@ class Stabilizer(_th.Thread):
 
     Functions that *do* belong to the public interface communicate with the
     running thread relying on the GIL (like setting a value) or in events.
+
+    The loop runs as a pipeline of three stages:
+        - An acquisition thread that keeps only the newest frame in a slot.
+          Frames that are not processed in time are dropped.
+        - Processing (fitting, reporting and controller response) in this
+          thread.
+        - An actuation thread that applies the accumulated piezo moves.
+    See `get_stats` for per stage timing statistics.
     """
 
-    _report_cb = _List[_Optional[report_callback_type]]
+    _publisher: _ReportPublisher = None
     _init_cb = _List[_Optional[init_callback_type]]
     _end_cb = _List[_Optional[end_callback_type]]
 
@@ -138,6 +192,13 @@ class Stabilizer(_th.Thread):
     _z_shift: _np.float64 = _np.nan
     _xy_shifts: _np.ndarray = _np.full((1, 2, ), _np.nan)
     _running_thread: _th.Thread = None
+    _fit_mode: str = 'batch'  # see set_fit_mode
+    _fitter: _BatchGaussianFitter = None
+    _executor: _PPE = None
+    _ring: _shm.SharedMemory = None
+    _ring_info = None  # (name, shape, dtype) of the shared memory ring
+    _frames: _np.ndarray = None
+    _slot: int = 0
 
     def __init__(
         self,
@@ -146,6 +207,7 @@ class Stabilizer(_th.Thread):
         camera_info: CameraInfo,
         corrector: _bc.BaseController,
         *args,
+        clock=None,
         **kwargs,
     ):
         """Init stabilization thread.
@@ -165,6 +227,11 @@ class Stabilizer(_th.Thread):
         callback: Callable
             Callable to report measured shifts. Will receive a `PointInfo`
             object as the only parameter
+        clock: optional
+            Object with `time`, `monotonic` and `sleep` methods (see
+            `takyaq.clocks`), used for timestamps and loop pacing. Defaults to
+            the system clock. Pass a `VirtualClock` to replay data as fast as
+            possible.
         """
         super().__init__(*args, **kwargs)
 
@@ -174,6 +241,7 @@ class Stabilizer(_th.Thread):
                 "The camera object does not expose a 'get_image' method"
             )
         self._camera = camera
+        self._clock = clock if clock is not None else _SystemClock()
         self._nmpp_xy = camera_info.nm_ppx_xy
         self._nmpp_z = camera_info.nm_ppx_z
         self._rot_vec = _np.array(
@@ -182,6 +250,8 @@ class Stabilizer(_th.Thread):
                 _np.sin(camera_info.angle),
             )
         )
+        self._z_estimator = _z_estimators.CentroidEstimator()
+        self._z_estimator.set_axis(self._rot_vec)
 
         if not callable(getattr(piezo, "set_position_xy", None)):
             raise ValueError(
@@ -212,8 +282,23 @@ class Stabilizer(_th.Thread):
         self._move_event = _th.Event()
         self._moveto_pos = _np.zeros((3,))
 
+        # Pipeline: newest frame slot and pending relative moves
+        self._frame_slot = _deque(maxlen=1)
+        self._frame_event = _th.Event()
+        self._frame_taken_event = _th.Event()
+        self._piezo_lock = _th.Lock()
+        self._release_lock = _th.Lock()
+        self._pending_move = _np.zeros((3,))
+        self._move_pending_event = _th.Event()
+        self._move_applied_event = _th.Event()
+        self._move_applied_event.set()
+        self._last_move_time = 0.
+        self._dropped_frames = 0
+        self._stage_times = {name: _deque(maxlen=_N_STAGE_TIMES)
+                             for name in ('acquisition', 'processing', 'actuation')}
+
         self._rsp = corrector
-        self._report_cb = []
+        self._publisher = _ReportPublisher()
         self._init_cb = []
         self._end_cb = []
         self._last_params = {}
@@ -246,20 +331,30 @@ class Stabilizer(_th.Thread):
     def add_callbacks(self, report_cb: _Optional[report_callback_type],
                       init_cb: _Optional[init_callback_type],
                       end_cb: _Optional[end_callback_type],
+                      report_period: float = 0.,
+                      image_period: float = 0.,
                       ):
         """Add callbacks functions.
 
         report_cb: takyaq.info_types.report_callback_type | None
             Function to be called to report a new stabilization cycle. This
-            function is called from an internal thread.
+            function is called asynchronously from an internal thread, that
+            is not the stabilization loop. If it can not keep up, older
+            reports are dropped. `image` is None for reports decimated by
+            `image_period`.
         init_cb: takyaq.info_types.init_callback_type | None
             Function to be called before starting the stabilization.
         end_cb: takyaq.info_types.end_callback_type | None
             Function to be called after stopping the stabilization.
+        report_period: float, default 0.
+            Minimum time between reports, in seconds.
+        image_period: float, default 0.
+            Minimum time between reports that include the image, in seconds.
 
-        Any parameter can be None. In this case that CB is not called
+        Any callback can be None. In this case that CB is not called
         """
-        self._report_cb.append(report_cb)
+        if report_cb:
+            self._publisher.subscribe(report_cb, report_period, image_period)
         self._init_cb.append(init_cb)
         self._end_cb.append(end_cb)
 
@@ -286,6 +381,97 @@ class Stabilizer(_th.Thread):
         self._period = period
         _lgr.debug("New period set: %s", period)
 
+    def set_fit_mode(self, mode: str) -> bool:
+        """Select how XY ROIs are fitted.
+
+        Can not be used while the loop is running.
+
+        Parameters
+        ----------
+        mode: str
+            'batch' fits all ROIs at once in-process (default). 'pool' fits
+            each ROI using `scipy.optimize.curve_fit` in a process pool.
+            Frames are shared with the pool using a shared memory ring, so
+            only ROI limits and results are passed around.
+
+        Return
+        ------
+        True if successful, False otherwise
+        """
+        if mode not in ('batch', 'pool'):
+            _lgr.warning("Invalid fit mode: %s", mode)
+            return False
+        if not self._stop_event.is_set():
+            _lgr.warning("Trying to change fit mode while the loop is running")
+            return False
+        self._fit_mode = mode
+        return True
+
+    def set_z_estimator(self, estimator: _Union[str, _z_estimators.ZEstimator],
+                        **kwargs) -> bool:
+        """Select the algorithm used to locate the Z reflection.
+
+        Can not be used while Z tracking is active.
+
+        Parameters
+        ----------
+        estimator: str or z_estimators.ZEstimator
+            An estimator instance or the name of one ('centroid', 'gaussian'
+            or 'xcorr', see `z_estimators.create`).
+        kwargs:
+            Parameters passed to the estimator when created by name.
+
+        Return
+        ------
+        True if successful, False otherwise
+        """
+        if self._z_tracking:
+            _lgr.warning("Trying to change Z estimator while tracking")
+            return False
+        if isinstance(estimator, str):
+            try:
+                estimator = _z_estimators.create(estimator, **kwargs)
+            except (ValueError, TypeError) as e:
+                _lgr.warning("Invalid Z estimator: %s", e)
+                return False
+        estimator.set_axis(self._rot_vec)
+        self._z_estimator = estimator
+        return True
+
+    def reset_stats(self, n_times: _Optional[int] = _N_STAGE_TIMES):
+        """Clear pipeline statistics.
+
+        Parameters
+        ----------
+        n_times: int or None
+            Number of durations kept for each stage. None keeps all of them.
+        """
+        self._dropped_frames = 0
+        self._stage_times = {name: _deque(maxlen=n_times) for name in self._stage_times}
+
+    def get_stage_times(self) -> dict:
+        """Return the kept durations (in s) of each pipeline stage, as arrays."""
+        return {name: _np.array(times) for name, times in self._stage_times.items()}
+
+    def get_stats(self) -> dict:
+        """Return pipeline statistics.
+
+        Returns
+        -------
+        dict with the number of dropped frames under 'dropped_frames', the
+        number of reports dropped by slow callbacks under 'dropped_reports' and, for
+        each stage ('acquisition', 'processing', 'actuation') and for the Z
+        spot estimation ('z_estimation'), a tuple with the mean and max
+        duration in seconds of the last iterations.
+        """
+        rv = {'dropped_frames': self._dropped_frames,
+              'dropped_reports': sum(self._publisher.dropped()),
+              'z_estimation': self._z_estimator.stats()}
+        for name, times in self._stage_times.items():
+            data = _np.array(times)
+            rv[name] = (data.mean(), data.max()) if len(data) else (_np.nan, _np.nan)
+        return rv
+
     def set_xy_rois(self, rois: _List[ROI]) -> bool:
         """Set ROIs for xy stabilization.
 
@@ -308,6 +494,7 @@ class Stabilizer(_th.Thread):
             [[[_.min_x, _.max_x], [_.min_y, _.max_y]] for _ in rois],
             dtype=_np.uint16,  # int type to use as indexes
         )
+        self._fitter = _BatchGaussianFitter(self._xy_rois)
         return True
 
     def set_z_roi(self, roi: ROI) -> bool:
@@ -539,18 +726,27 @@ class Stabilizer(_th.Thread):
         if not self._stop_event.is_set():
             _lgr.warning("Trying to start already running loop")
             return False
-        self._executor = _PPE()
-        # prime pool for responsiveness (a _must_ on windows).
-        nproc = _os.cpu_count()
-        params = [
-            [_np.eye(3)] * nproc,
-            [1.0] * nproc,
-            [1.0] * nproc,
-            [1.0] * nproc,
-        ]
-        with _warnings.catch_warnings():
-            _warnings.simplefilter("ignore")
-            _ = tuple(self._executor.map(_gaussian_fit, *params))
+        if self._fit_mode == 'pool':
+            self._executor = _PPE()
+            try:
+                self._last_image = self._camera.get_image()
+            except Exception as e:
+                _lgr.error("Could not acquire image: %s (%s)", type(e), e)
+            self._allocate_ring(self._last_image)
+            # prime pool for responsiveness (a _must_ on windows). Workers
+            # also attach to the frame ring.
+            nproc = _os.cpu_count()
+            params = [
+                [self._ring_info] * nproc,
+                [0] * nproc,
+                [_np.array([[0, 3], [0, 3]])] * nproc,
+                [1.0] * nproc,
+                [1.0] * nproc,
+                [1.0] * nproc,
+            ]
+            with _warnings.catch_warnings():
+                _warnings.simplefilter("ignore")
+                _ = tuple(self._executor.map(_shared_gaussian_fit, *params))
         self._stop_event.clear()
         self.run = self._old_run
         self._old_start()
@@ -560,15 +756,63 @@ class Stabilizer(_th.Thread):
     def stop_loop(self):
         """Stop tracking and stabilization loop and release resources.
 
-        Must be called from another thread to avoid deadlocks.
+        Must be called from another thread to avoid deadlocks. Resources are
+        also released if the loop had already ended (e.g. on an error).
         """
-        if self._stop_event.is_set():
+        already_stopped = self._stop_event.is_set()
+        if already_stopped:
             _lgr.warning("Trying to stop already finished loop")
-            return False
         self._stop_event.set()
-        self.join()
-        self._executor.shutdown()
+        if self.ident is not None:  # started
+            self.join()
+        self._release_resources()
         _lgr.debug("Loop ended")
+        return not already_stopped
+
+    def _release_resources(self):
+        """Shut down the process pool, free the frame ring and stop reporting.
+
+        Idempotent.
+        """
+        with self._release_lock:
+            self._publisher.close()
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+            self._release_ring()
+
+    def _allocate_ring(self, image: _np.ndarray):
+        """Allocate the shared memory frame ring, sized from image."""
+        self._release_ring()
+        shape = (_N_FRAME_SLOTS,) + image.shape
+        nbytes = int(_np.prod(shape)) * image.dtype.itemsize
+        self._ring = _shm.SharedMemory(create=True, size=max(nbytes, 1))
+        self._frames = _np.ndarray(shape, dtype=image.dtype, buffer=self._ring.buf)
+        self._ring_info = (self._ring.name, shape, image.dtype.str)
+        self._slot = 0
+
+    def _release_ring(self):
+        """Free the shared memory frame ring."""
+        if self._ring is None:
+            return
+        self._frames = None
+        self._ring_info = None
+        try:
+            self._ring.close()
+            self._ring.unlink()
+        except Exception as e:
+            _lgr.warning("Error %s releasing shared memory: %s", type(e), e)
+        self._ring = None
+
+    def _share_frame(self, image: _np.ndarray) -> int:
+        """Copy image into the next ring slot and return the slot."""
+        if (self._frames is None or image.shape != self._frames.shape[1:]
+                or image.dtype != self._frames.dtype):
+            _lgr.info("Image format changed: reallocating frame ring")
+            self._allocate_ring(image)
+        self._slot = (self._slot + 1) % _N_FRAME_SLOTS
+        self._frames[self._slot] = image
+        return self._slot
 
     def _donotcall(self, *args, **kwargs):
         """Advice against running forbidden functions."""
@@ -588,16 +832,19 @@ class Stabilizer(_th.Thread):
         ------
             numpy.ndarray of shape (NROIS, 2) with x,y center in nm
         """
-        trimmeds = [
-            image[roi[0, 0]: roi[0, 1], roi[1, 0]: roi[1, 1]]
-            for roi in self._xy_rois
-        ]
         x = self._last_params["x"]
         y = self._last_params["y"]
         s = self._last_params["s"]
-        locs = _np.array(
-            tuple(self._executor.map(_gaussian_fit, trimmeds, x, y, s))
-        )
+        if self._fit_mode == 'batch':
+            locs = self._fitter.fit(image, x, y, s)
+        else:
+            n_rois = len(self._xy_rois)
+            slot = self._share_frame(image)
+            locs = _np.array(
+                tuple(self._executor.map(
+                    _shared_gaussian_fit, [self._ring_info] * n_rois,
+                    [slot] * n_rois, self._xy_rois, x, y, s))
+            )
         self._last_params["x"] = locs[:, 0]
         nanloc = _np.isnan(locs[:, 0])  # if x is nan, y also is nan
         self._last_params["x"][nanloc] = x[nanloc]
@@ -637,26 +884,124 @@ class Stabilizer(_th.Thread):
             _lgr.error("Trying to locate z position without a ROI")
             return _np.full((2,), _np.nan)
         roi = image[slice(*self._z_roi[0]), slice(*self._z_roi[1])]
-        roi = _np.array(roi)
-        # roi[roi < 25] = 0
-        return _np.array(_sp.ndimage.center_of_mass(roi))
+        return self._z_estimator(roi)
 
     def _move_relative_xy(self, dx: float, dy: float):
-        """Perform a relative movement in xy."""
-        self._pos[0] += dx
-        self._pos[1] += dy
-        try:
-            self._piezo.set_position_xy(*self._pos[:2])
-        except Exception as e:
-            _lgr.error("Error %s (%s) moving the stage", type(e), e)
+        """Perform a relative movement in xy, synchronously."""
+        with self._piezo_lock:
+            self._pos[0] += dx
+            self._pos[1] += dy
+            try:
+                self._piezo.set_position_xy(*self._pos[:2])
+            except Exception as e:
+                _lgr.error("Error %s (%s) moving the stage", type(e), e)
 
     def _move_relative_z(self, dz: float):
-        """Perform a relative movement in Z."""
-        self._pos[2] += dz
-        try:
-            self._piezo.set_position_z(self._pos[2])
-        except Exception as e:
-            _lgr.error("Error %s (%s) moving the stage", type(e), e)
+        """Perform a relative movement in Z, synchronously."""
+        with self._piezo_lock:
+            self._pos[2] += dz
+            try:
+                self._piezo.set_position_z(self._pos[2])
+            except Exception as e:
+                _lgr.error("Error %s (%s) moving the stage", type(e), e)
+
+    def _queue_move(self, dx: float, dy: float, dz: float):
+        """Add a relative movement to be performed by the actuation thread."""
+        with self._piezo_lock:
+            self._pending_move += (dx, dy, dz)
+            self._move_applied_event.clear()
+        self._move_pending_event.set()
+
+    def _actuation_loop(self):
+        """Apply pending movements (actuation thread)."""
+        while not self._stop_event.is_set():
+            if not self._move_pending_event.wait(0.1):
+                continue
+            self._move_pending_event.clear()
+            t0 = _time.monotonic()
+            with self._piezo_lock:
+                delta = _np.copy(self._pending_move)
+                self._pending_move[:] = 0.
+                self._pos += delta
+                try:
+                    if delta[0] or delta[1]:
+                        self._piezo.set_position_xy(*self._pos[:2])
+                    if delta[2]:
+                        self._piezo.set_position_z(self._pos[2])
+                except Exception as e:
+                    _lgr.error("Error %s (%s) moving the stage", type(e), e)
+                self._last_move_time = _time.monotonic()
+                self._move_applied_event.set()
+            self._stage_times['actuation'].append(_time.monotonic() - t0)
+        self._move_applied_event.set()
+
+    def _acquisition_loop(self):
+        """Keep the newest frame in the frame slot (acquisition thread).
+
+        Slot items are (acquisition start time (monotonic), timestamp, image).
+        image is None if acquisition failed.
+        """
+        while not self._stop_event.is_set():
+            t0 = _time.monotonic()
+            ct0 = self._clock.monotonic()
+            try:
+                image = self._camera.get_image()
+            except Exception as e:
+                _lgr.error("Could not acquire image: %s (%s)", type(e), e)
+                image = None
+            t = self._clock.time()
+            self._stage_times['acquisition'].append(_time.monotonic() - t0)
+            if not getattr(self._clock, 'realtime', True):  # simulated time: never drop frames
+                while self._frame_slot and not self._stop_event.is_set():
+                    self._frame_taken_event.wait(0.1)
+                    self._frame_taken_event.clear()
+                if self._stop_event.is_set():
+                    break
+            if self._frame_slot:  # previous frame was never processed
+                self._dropped_frames += 1
+            self._frame_slot.append((t0, t, image))
+            self._frame_event.set()
+            delay = self._period - (self._clock.monotonic() - ct0)
+            self._clock.sleep(max(delay, 0.001))  # be nice to other threads
+
+    def _next_frame(self, newer_than: float = None, timeout: float = 2.):
+        """Wait for a frame from the acquisition thread.
+
+        Parameters
+        ----------
+        newer_than: float, optional
+            Skip frames whose acquisition started before this time (monotonic)
+        timeout: float, default 2.
+            Max. waiting time in seconds
+
+        Returns
+        -------
+        (acquisition start, timestamp, image) or None if no frame arrived.
+        """
+        deadline = _time.monotonic() + timeout
+        while not self._stop_event.is_set():
+            remaining = deadline - _time.monotonic()
+            if remaining <= 0:
+                break
+            if not self._frame_event.wait(min(remaining, 0.1)):
+                continue
+            self._frame_event.clear()
+            try:
+                frame = self._frame_slot.popleft()
+            except IndexError:
+                continue
+            self._frame_taken_event.set()
+            if newer_than is not None and frame[0] < newer_than:
+                continue
+            return frame
+        return None
+
+    def _fresh_image(self) -> _np.ndarray:
+        """Return an image acquired after this call."""
+        frame = self._next_frame(_time.monotonic())
+        if frame is None or frame[2] is None:
+            raise RuntimeError("Could not acquire image")
+        return frame[2]
 
     def _report(
         self,
@@ -665,18 +1010,14 @@ class Stabilizer(_th.Thread):
         xy_shifts: _Union[_np.ndarray, None],
         z_shift: float,
     ):
-        """Send data to provided callback."""
+        """Publish data to callbacks. Does not block.
+
+        The publisher copies the image if it is forwarded, as cameras may
+        reuse their buffers.
+        """
         if xy_shifts is None:
             xy_shifts = _np.empty((0,))
-        rv = PointInfo(t, image, z_shift, xy_shifts)
-        for cb in self._report_cb:
-            try:
-                if cb:
-                    cb(rv)
-            except Exception as e:
-                _lgr.warning(
-                    "Exception reporting to callback: %s(%s)", type(e), e
-                )
+        self._publisher.publish(PointInfo(t, image, z_shift, xy_shifts))
 
     def _calibrate_xy(
         self, length: float, initial_xy_positions: _np.ndarray, points: int = 20
@@ -714,18 +1055,18 @@ class Stabilizer(_th.Thread):
             rel_vec[c_idx] = -length / 2.0
             self._move_relative_xy(*rel_vec)
             rel_vec[c_idx] = step
-            image = self._camera.get_image()
+            self._last_image = self._fresh_image()
             self._initialize_last_params()  # we made a LARGE shift
             for idx, s in enumerate(shifts):
-                image = self._camera.get_image()
+                image = self._fresh_image()
                 xy_shifts = self._locate_xy_centers(image)
                 self._report(
-                    _time.time(), image, xy_shifts - initial_xy_positions, 0
+                    self._clock.time(), image, xy_shifts - initial_xy_positions, 0
                 )
                 x = _np.nanmean(xy_shifts[:, c_idx])
                 response[idx] = x / self._nmpp_xy
                 self._move_relative_xy(*rel_vec)
-                _time.sleep(0.10)
+                self._clock.sleep(0.10)
             # TODO: better reporting
             for x, y in zip(shifts, response):
                 print(f"{x}, {y}")
@@ -735,8 +1076,9 @@ class Stabilizer(_th.Thread):
             print("slope = ", 1 / vec)
         except Exception as e:
             _lgr.warning("Exception calibrating x: %s(%s)", type(e), e)
-        self._pos[:] = oldpos
-        self._piezo.set_position_xy(*self._pos[:2])
+        with self._piezo_lock:
+            self._pos[:] = oldpos
+            self._piezo.set_position_xy(*self._pos[:2])
         return True
 
     def _calibrate_z(
@@ -777,9 +1119,8 @@ class Stabilizer(_th.Thread):
             rel_mov = -length / 2.0
             self._move_relative_z(rel_mov)
             rel_mov = step
-            image = self._camera.get_image()
             for idx, s in enumerate(shifts):
-                image = self._camera.get_image()
+                image = self._fresh_image()
                 # roi = image[slice(*self._z_roi[0]), slice(*self._z_roi[1])]
                 # c = _np.array(_sp.ndimage.center_of_mass(roi))
                 z_position = self._locate_z_center(image)
@@ -789,10 +1130,10 @@ class Stabilizer(_th.Thread):
                     if self._xy_rois is None
                     else self._locate_xy_centers(image) - initial_xy_positions
                 )
-                self._report(_time.time(), image, xy_data, _np.nan)
+                self._report(self._clock.time(), image, xy_data, _np.nan)
                 response[idx] = c
                 self._move_relative_z(rel_mov)
-                _time.sleep(0.10)
+                self._clock.sleep(0.10)
             # TODO: better reporting
             print("z, x, y")
             for z, xy in zip(shifts, response):
@@ -810,28 +1151,50 @@ class Stabilizer(_th.Thread):
             print("Z nanometer per pixel= ", 1. / px_per_nm)
         except Exception as e:
             _lgr.warning("Exception calibrating z: %s(%s)", type(e), e)
-        self._pos[:] = oldpos
-        self._piezo.set_position_z(self._pos[2])
+        with self._piezo_lock:
+            self._pos[:] = oldpos
+            self._piezo.set_position_z(self._pos[2])
         return True
 
     def run(self):
-        """Run main stabilization loop."""
+        """Run main stabilization loop (processing stage)."""
         if callable(getattr(self._piezo, 'init', None)):
             self._piezo.init()
         self._running_thread = _th.current_thread()
         initial_xy_positions = None
         self._initial_z_position = None
         self._pos[:] = self._piezo.get_position()
+        self._frame_slot.clear()
+        self._dropped_frames = 0
+        stages = [
+            _th.Thread(target=self._acquisition_loop, name="Stabilizer acquisition",
+                       daemon=True),
+            _th.Thread(target=self._actuation_loop, name="Stabilizer actuation",
+                       daemon=True),
+        ]
+        for stage in stages:
+            stage.start()
+        try:
+            self._processing_loop(initial_xy_positions)
+        finally:
+            self._stop_event.set()
+            for stage in stages:
+                stage.join()
+            self._release_resources()
+        _lgr.debug("Ending loop.")
+
+    def _processing_loop(self, initial_xy_positions):
+        """Process frames until stopped."""
         while not self._stop_event.is_set():
-            lt = _time.monotonic()
-            DELAY = self._period
             z_shift = 0.0
             xy_shifts = None
             # Check external events
             if self._calibrate_event.is_set():
                 _lgr.debug("Calibration event received")
                 try:
-                    self._pos[:] = self._piezo.get_position()
+                    self._move_applied_event.wait(1.)
+                    with self._piezo_lock:
+                        self._pos[:] = self._piezo.get_position()
                     if self._calib_idx >= 0 and self._calib_idx < 2:
                         if self._xy_tracking:
                             self._calibrate_xy(100.0, initial_xy_positions)
@@ -848,38 +1211,52 @@ class Stabilizer(_th.Thread):
                     _lgr.error("Excepci{on durante la calibraci{on")
                 self._calibrate_event.clear()
             if self._move_event.is_set():
-                self._piezo.set_position_xy(*self._moveto_pos[:2])
-                self._piezo.set_position_z(self._moveto_pos[2])
-                self._pos[:] = self._moveto_pos
+                self._move_applied_event.wait(1.)
+                with self._piezo_lock:
+                    self._piezo.set_position_xy(*self._moveto_pos[:2])
+                    self._piezo.set_position_z(self._moveto_pos[2])
+                    self._pos[:] = self._moveto_pos
+                    self._last_move_time = _time.monotonic()
                 self._move_event.clear()
             # Tracking and stabilization starts here
-            try:
-                image = self._camera.get_image()
-                t = _time.time()
-                self._last_image = image
-            except Exception as e:
-                _lgr.error("Could not acquire image: %s (%s)", type(e), e)
+            newer_than = None
+            if self._z_stabilization or self._xy_stabilization:
+                # Do not correct twice for the same shift: wait for a frame
+                # acquired after the last correction was applied
+                self._move_applied_event.wait(1.)
+                newer_than = self._last_move_time
+            frame = self._next_frame(newer_than)
+            if frame is None:
+                continue
+            _, t, image = frame
+            lt = _time.monotonic()
+            if image is None:
                 image = _np.diag(_np.full(max(*self._last_image.shape), 255))
-                t = _time.time()
                 self._report(
                     t,
                     image,
+                    None if initial_xy_positions is None else
                     _np.full_like(initial_xy_positions, _np.nan),
                     _np.nan,
                 )
-                _time.sleep(self._period)
                 continue
+            self._last_image = image
             # Process start tracking commands
             if not self._xy_track_event.is_set():
                 _lgr.info("Setting xy initial positions")
-                self._pos[:2] = self._piezo.get_position()[:2]
+                self._move_applied_event.wait(1.)
+                with self._piezo_lock:
+                    self._pos[:2] = self._piezo.get_position()[:2]
                 self._initialize_last_params()
                 initial_xy_positions = self._locate_xy_centers(image)
                 self._xy_track_event.set()
                 self._xy_tracking = True
             if not self._z_track_event.is_set():
-                self._pos[2] = self._piezo.get_position()[2]
+                self._move_applied_event.wait(1.)
+                with self._piezo_lock:
+                    self._pos[2] = self._piezo.get_position()[2]
                 _lgr.info("Setting z initial positions")
+                self._z_estimator.reset()
                 self._initial_z_position = self._locate_z_center(image)
                 self._z_track_event.set()
                 self._z_tracking = True
@@ -913,11 +1290,5 @@ class Stabilizer(_th.Thread):
                     z_resp = 0.0
                 if not self._xy_stabilization:
                     x_resp = y_resp = 0.0
-                if self._z_stabilization:
-                    self._move_relative_z(z_resp)
-                if self._xy_stabilization:
-                    self._move_relative_xy(x_resp, y_resp)
-            nt = _time.monotonic()
-            delay = DELAY - (nt - lt)
-            _time.sleep(max(delay, 0.001))  # be nice to other threads
-        _lgr.debug("Ending loop.")
+                self._queue_move(x_resp, y_resp, z_resp)
+            self._stage_times['processing'].append(_time.monotonic() - lt)
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+Z spot estimators
+
+Estimators locate the reflection used for Z stabilization inside the Z ROI.
+They are called with the ROI (a view of the image) and return the (x, y)
+position of the spot in ROI pixels, so they are interchangeable for the
+stabilizer. Only the component along the reflection axis (see `set_axis`)
+is used to infer the Z shift.
+
+Buffers are allocated when the ROI shape changes and reused afterwards. The
+duration of the last estimates is kept (see `ZEstimator.stats`).
+
+@author: azelcer
+"""
+
+import numpy as _np
+import scipy as _sp
+import time as _time
+import logging as _lgn
+import warnings as _warnings
+from collections import deque as _deque
+from typing import Optional as _Optional, Tuple as _Tuple
+
+_lgr = _lgn.getLogger(__name__)
+
+# Number of durations kept
+_N_TIMES = 200
+
+
+class ZEstimator:
+    """Base class for Z spot estimators."""
+
+    def __init__(self):
+        self._shape = None
+        self._rot_vec = _np.array((1., 0.))
+        self.durations = _deque(maxlen=_N_TIMES)
+        self.last_duration = _np.nan
+
+    def set_axis(self, rot_vec: _np.ndarray):
+        """Set the unit vector along which the spot moves with Z."""
+        self._rot_vec = _np.array(rot_vec, dtype=float)
+        self._shape = None  # force recomputation of buffers
+
+    def reset(self):
+        """Forget any reference. Called when Z tracking starts."""
+        ...
+
+    def _prepare(self, shape: _Tuple[int, int]):
+        """Allocate buffers for a new ROI shape."""
+        self._buffer = _np.empty(shape)
+        self._x = _np.arange(shape[0], dtype=float)
+        self._y = _np.arange(shape[1], dtype=float)
+
+    def _estimate(self, roi: _np.ndarray) -> _np.ndarray:
+        raise NotImplementedError
+
+    def __call__(self, roi: _np.ndarray) -> _np.ndarray:
+        """Return (x, y) position of the spot in ROI pixels. NaN if failed."""
+        t0 = _time.perf_counter()
+        if roi.shape != self._shape:
+            self._prepare(roi.shape)
+            self._shape = roi.shape
+        try:
+            rv = self._estimate(roi)
+        except Exception as e:
+            _lgr.warning("Error estimating Z position: %s (%s)", type(e), e)
+            rv = _np.full((2,), _np.nan)
+        self.last_duration = _time.perf_counter() - t0
+        self.durations.append(self.last_duration)
+        return rv
+
+    def stats(self) -> _Tuple[float, float]:
+        """Return mean and max duration (in s) of the last estimates."""
+        if not self.durations:
+            return (_np.nan, _np.nan)
+        data = _np.array(self.durations)
+        return (data.mean(), data.max())
+
+    def _subtract_background(self, roi: _np.ndarray, background: _Optional[float],
+                             threshold: float) -> _np.ndarray:
+        """Copy roi into the buffer, removing background and dim pixels."""
+        buf = self._buffer
+        _np.copyto(buf, roi, casting='unsafe')
+        if background is None:
+            bkg = 0.
+        elif background == 'min':
+            bkg = buf.min()
+        elif background == 'median':
+            bkg = _np.median(buf)
+        else:
+            bkg = float(background)
+        if bkg:
+            buf -= bkg
+        if threshold > 0:
+            cut = threshold * buf.max()
+            buf[buf < cut] = 0.
+        elif bkg:
+            _np.maximum(buf, 0., out=buf)
+        return buf
+
+    def _centroid(self, buf: _np.ndarray) -> _np.ndarray:
+        """Center of mass of the buffer."""
+        total = buf.sum()
+        if total <= 0:
+            return _np.full((2,), _np.nan)
+        return _np.array((self._x @ buf.sum(axis=1), buf.sum(axis=0) @ self._y)) / total
+
+
+class CentroidEstimator(ZEstimator):
+    """Center of mass, optionally thresholded and windowed.
+
+    With the default parameters it is equivalent to
+    `scipy.ndimage.center_of_mass`.
+    """
+
+    def __init__(self, background=None, threshold: float = 0.,
+                 window: _Optional[float] = None):
+        """Init estimator.
+
+        Parameters
+        ----------
+        background: None, 'min', 'median' or float
+            Background level subtracted before computing the centroid.
+        threshold: float, default 0.
+            After background subtraction, ignore pixels below this fraction
+            of the maximum.
+        window: float, optional
+            If set, the centroid is recomputed using only the pixels within
+            this distance (in pixels) from the first estimate.
+        """
+        super().__init__()
+        self.background = background
+        self.threshold = threshold
+        self.window = window
+
+    def _prepare(self, shape):
+        super()._prepare(shape)
+        self._weights = _np.empty(shape)
+
+    def _estimate(self, roi: _np.ndarray) -> _np.ndarray:
+        buf = self._subtract_background(roi, self.background, self.threshold)
+        rv = self._centroid(buf)
+        if self.window is not None and _np.all(_np.isfinite(rv)):
+            dx2 = (self._x - rv[0]) ** 2
+            dy2 = (self._y - rv[1]) ** 2
+            mask = _np.add.outer(dx2, dy2) <= self.window ** 2
+            _np.multiply(buf, mask, out=self._weights)
+            rv = self._centroid(self._weights)
+        return rv
+
+
+def _gaussian1D(x, amplitude, x0, sigma, offset):
+    return offset + amplitude * _np.exp(-(x - x0) ** 2 / (2 * sigma ** 2))
+
+
+def _gaussian1D_jac(x, amplitude, x0, sigma, offset):
+    d = x - x0
+    g = _np.exp(-d ** 2 / (2 * sigma ** 2))
+    ag = amplitude * g
+    return _np.stack((g, ag * d / sigma ** 2, ag * d ** 2 / sigma ** 3,
+                      _np.ones_like(x)), axis=1)
+
+
+class _ProfileEstimator(ZEstimator):
+    """Base for estimators working on the profile along the reflection axis.
+
+    Pixels are binned (1 px bins) by their coordinate along the axis, relative
+    to the ROI center, splitting each pixel linearly between the two nearest
+    bins so the profile is smooth for any axis angle. Bin indexes and weights
+    are computed once per ROI shape.
+    """
+
+    def __init__(self, background='median'):
+        super().__init__()
+        self.background = background
+
+    def _prepare(self, shape):
+        super()._prepare(shape)
+        self._center = (_np.array(shape, dtype=float) - 1) / 2
+        dx = self._x - self._center[0]
+        dy = self._y - self._center[1]
+        along = _np.add.outer(dx * self._rot_vec[0], dy * self._rot_vec[1])
+        self._across = _np.add.outer(-dx * self._rot_vec[1], dy * self._rot_vec[0])
+        self._t_min = _np.floor(along.min())
+        f = (along - self._t_min).ravel()
+        self._bins = _np.floor(f).astype(_np.intp)
+        self._w_next = f - self._bins
+        self._n_bins = int(self._bins.max()) + 2
+        self._t = self._t_min + _np.arange(self._n_bins)
+        self._profile = _np.empty((self._n_bins,))
+        self._weighted = _np.empty(f.shape)
+
+    def _profile_of(self, roi: _np.ndarray) -> _np.ndarray:
+        """Background subtracted intensity, summed across the axis."""
+        buf = self._subtract_background(roi, self.background, 0.).ravel()
+        _np.multiply(buf, self._w_next, out=self._weighted)
+        self._profile[:] = _np.bincount(self._bins, buf, self._n_bins)
+        self._profile -= _np.bincount(self._bins, self._weighted, self._n_bins)
+        self._profile[1:] += _np.bincount(self._bins, self._weighted, self._n_bins)[:-1]
+        return self._profile
+
+    def _across_position(self) -> float:
+        """Centroid across the axis of the (background subtracted) buffer."""
+        total = self._buffer.sum()
+        return (self._buffer * self._across).sum() / total if total > 0 else 0.
+
+    def _to_xy(self, t: float, s: float) -> _np.ndarray:
+        """Convert coordinates along and across the axis to ROI pixels."""
+        perp = _np.array((-self._rot_vec[1], self._rot_vec[0]))
+        return self._center + t * self._rot_vec + s * perp
+
+
+class GaussianProfileEstimator(_ProfileEstimator):
+    """1D gaussian fit of the intensity profile along the reflection axis.
+
+    Only the bins within `width` sigmas of the profile maximum are fitted.
+    """
+
+    def __init__(self, background='median', sigma: float = 3., width: float = 4.):
+        """Init estimator.
+
+        Parameters
+        ----------
+        background: None, 'min', 'median' or float
+            Background level subtracted before building the profile.
+        sigma: float, default 3.
+            Initial spot size, in pixels.
+        width: float, default 4.
+            Half width of the fitted region, in units of sigma.
+        """
+        super().__init__(background)
+        self.sigma = sigma
+        self.width = width
+        self._last = None
+
+    def reset(self):
+        self._last = None
+
+    def _estimate(self, roi: _np.ndarray) -> _np.ndarray:
+        profile = self._profile_of(roi)
+        peak = int(_np.argmax(profile))
+        if self._last is None or not _np.all(_np.isfinite(self._last)):
+            p0 = (profile[peak] - profile.min(), self._t[peak], self.sigma, profile.min())
+        else:
+            p0 = self._last
+        half = max(int(_np.ceil(self.width * abs(p0[2]))), 3)
+        sl = slice(max(peak - half, 0), peak + half + 1)
+        t = self._t[sl]
+        with _warnings.catch_warnings():
+            _warnings.simplefilter("ignore")
+            popt, _ = _sp.optimize.curve_fit(_gaussian1D, t, profile[sl], p0=p0,
+                                             jac=_gaussian1D_jac, maxfev=200)
+        if not (t[0] <= popt[1] <= t[-1]):
+            self._last = None
+            return _np.full((2,), _np.nan)
+        self._last = popt
+        return self._to_xy(popt[1], self._across_position())
+
+
+class CrossCorrelationEstimator(_ProfileEstimator):
+    """Shift of the profile along the reflection axis against a reference.
+
+    The reference profile is taken on the first call after `reset`, and its
+    position with a centroid. The result is the reference position moved by
+    the (sub-pixel, by parabolic interpolation) shift that maximizes the
+    cross-correlation.
+    """
+
+    def __init__(self, background='median'):
+        """Init estimator.
+
+        Parameters
+        ----------
+        background: None, 'min', 'median' or float
+            Background level subtracted before building the profile.
+        """
+        super().__init__(background)
+        self._reference = None
+
+    def reset(self):
+        self._reference = None
+
+    def set_axis(self, rot_vec: _np.ndarray):
+        super().set_axis(rot_vec)
+        self._reference = None
+
+    def _prepare(self, shape):
+        super()._prepare(shape)
+        self._reference = None
+
+    def _estimate(self, roi: _np.ndarray) -> _np.ndarray:
+        profile = self._profile_of(roi)
+        if self._reference is None:
+            total = profile.sum()
+            if total <= 0:
+                return _np.full((2,), _np.nan)
+            self._reference = profile - profile.mean()
+            self._ref_t = (self._t @ profile) / total
+            self._ref_xy = self._to_xy(self._ref_t, self._across_position())
+            return self._ref_xy.copy()
+        corr = _np.correlate(profile - profile.mean(), self._reference, 'full')
+        k = int(_np.argmax(corr))
+        shift = float(k - (self._n_bins - 1))
+        if 0 < k < len(corr) - 1:
+            denom = corr[k - 1] - 2 * corr[k] + corr[k + 1]
+            if denom < 0:
+                shift += 0.5 * (corr[k - 1] - corr[k + 1]) / denom
+        return self._ref_xy + shift * self._rot_vec
+
+
+_ESTIMATORS = {
+    'centroid': CentroidEstimator,
+    'gaussian': GaussianProfileEstimator,
+    'xcorr': CrossCorrelationEstimator,
+}
+
+
+def create(name: str, **kwargs) -> ZEstimator:
+    """Create an estimator by name: 'centroid', 'gaussian' or 'xcorr'."""
+    try:
+        return _ESTIMATORS[name](**kwargs)
+    except KeyError:
+        raise ValueError(f"Unknown Z estimator: {name}") from None
+
+
+if __name__ == '__main__':
+    rng = _np.random.default_rng(0)
+    angle = _np.pi / 4
+    rot_vec = _np.array((_np.cos(angle), _np.sin(angle)))
+    xx, yy = _np.meshgrid(_np.arange(40), _np.arange(40), indexing='ij')
+    estimators = {name: create(name) for name in _ESTIMATORS}
+    estimators['centroid (thr.)'] = CentroidEstimator('median', 0.2, 8)
+    for e in estimators.values():
+        e.set_axis(rot_vec)
+    shifts = _np.linspace(-4, 4, 21)
+    errors = {name: [] for name in estimators}
+    for s in shifts:
+        c = _np.array((19.5, 19.5)) + s * rot_vec
+        img = rng.poisson(20 + 200 * _np.exp(-((xx - c[0])**2 + (yy - c[1])**2) / 18.))
+        for name, e in estimators.items():
+            pos = e(img)
+            errors[name].append((pos - c) @ rot_vec if name != 'xcorr' else pos @ rot_vec)
+    for name, e in estimators.items():
+        err = _np.array(errors[name])
+        if name == 'xcorr':  # relative to the reference
+            err = err - err[0] - (shifts - shifts[0])
+        print(f"{name}: rms error {_np.sqrt(_np.mean(err ** 2)):.3f} px, "
+              f"{e.stats()[0] * 1E6:.0f} us per estimate")
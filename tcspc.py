@@ -23,6 +23,8 @@ from PyQt5.QtWidgets import QGroupBox
 import tools.viewbox_tools as viewbox_tools
 import drivers.picoharp as picoharp
 import PicoHarp.Read_PTU as Read_PTU
+from tools.analysis import MinFluxLocator
+from tools.gating import GateTable
 import drivers.ADwin as ADwin
 import scan
 
@@ -33,10 +35,18 @@ import tools.colormaps as cmaps
 import qdarkstyle
 import ctypes
 
+GLOB_RES = 5e-8  # sync period in s, corresponds to sync @20 MHz, New NKT white laser
+LIVE_MIN_PHOTONS = 400  # photons accumulated for each live localization
+LIVE_N_BINS = 250  # bins of the live microTime histogram
+LIVE_MAX_SAMPLES = 2000  # points of the live time trace and localizations
+LIVE_UPDATE_EVERY = 10  # blocks received between plot updates
+
 class Frontend(QtGui.QFrame):
     
     paramSignal = pyqtSignal(list)
     measureSignal = pyqtSignal()
+    # live analysis: (gate windows in ps or None, PSF or None, SBR, px in nm)
+    liveParamSignal = pyqtSignal(object, object, float, float)
         
     def __init__(self, *args, **kwargs):
 
@@ -45,7 +55,9 @@ class Frontend(QtGui.QFrame):
         # initial directory
 
         self.initialDir = r'C:\Data'
+        self._PSF = None
         self.setup_gui()
+        self._init_live_data()
         
     def start_measurement(self):
         
@@ -82,6 +94,48 @@ class Frontend(QtGui.QFrame):
         paramlist = [name, res, tacq, folder, offset]
         
         self.paramSignal.emit(paramlist)
+
+    def load_PSF(self):
+        """Choose the PSF (EBP) file used for live localization (npy)."""
+        try:
+            root = Tk()
+            root.withdraw()
+            psffile = filedialog.askopenfilename(
+                parent=root, title='Select PSF file',
+                initialdir=self.initialDir, filetypes=(("numpy", "*.npy"),))
+            root.destroy()
+        except OSError:
+            return
+        if psffile:
+            try:
+                self._PSF = np.load(psffile, allow_pickle=False)
+            except (OSError, ValueError) as e:
+                print(datetime.now(), '[tcspc] error loading PSF', e)
+                return
+            print(datetime.now(), '[tcspc] PSF with shape {} loaded'.format(self._PSF.shape))
+            self.emit_live_param()
+
+    def emit_live_param(self):
+        """Send the live analysis parameters to the backend.
+
+        Gates are written as start-stop pairs in ns after the sync, separated
+        by commas (i.e. '0-12.5, 12.5-25'). If empty, the backend splits the
+        sync period into one gate per PSF.
+        """
+        try:
+            windows = [tuple(int(float(t) * 1e3) for t in w.split('-'))
+                       for w in self.gatesEdit.text().split(',') if w.strip()]
+            if any(len(w) != 2 for w in windows):
+                raise ValueError('gates must be start-stop pairs')
+            SBR = float(self.SBREdit.text())
+            px_nm = float(self.pxSizeEdit.text())
+        except ValueError as e:
+            print(datetime.now(), '[tcspc] invalid live analysis parameters:', e)
+            return
+        if self._PSF is not None and windows and len(windows) != len(self._PSF):
+            print(datetime.now(), '[tcspc] the number of gates and PSFs differ')
+            return
+        self.liveParamSignal.emit(windows or None, self._PSF, SBR, px_nm)
         
     @pyqtSlot(float, float)
     def get_backend_parameters(self, cts0, cts1):
@@ -123,11 +177,45 @@ class Frontend(QtGui.QFrame):
         
         self.histPlot.clear()
         self.tracePlot.clear()
-    
+        self.posPlot.clear()
+        self._init_live_data()
+
+    def _init_live_data(self):
+        """Reset the data shown while measuring."""
+        self._live_hist = np.zeros((LIVE_N_BINS,))
+        self._live_rate = np.full((LIVE_MAX_SAMPLES,), np.nan)
+        self._live_pos = np.full((LIVE_MAX_SAMPLES, 2), np.nan)
+        self._live_idx = 0
+        self._live_curves = None
+
+    @pyqtSlot(object, object, object, object)
+    def get_live_data(self, microtimes, period_length, bins, new_pos):
+        """Receive a block of decoded data from the backend and graph."""
+        counts, edges = np.histogram(microtimes, bins=LIVE_N_BINS,
+                                     range=(0, GLOB_RES * 1e12))
+        self._live_hist += counts
+        i = self._live_idx % LIVE_MAX_SAMPLES
+        if period_length > 0:
+            self._live_rate[i] = len(microtimes) / period_length * 1e9  # kHz
+        self._live_pos[i] = new_pos
+        self._live_idx += 1
+        if self._live_idx % LIVE_UPDATE_EVERY:
+            return
+        if self._live_curves is None:
+            self._live_curves = (
+                self.histPlot.plot(), self.tracePlot.plot(),
+                self.posPlot.plot(pen=None, symbol='o', symbolSize=4))
+        hist_curve, trace_curve, pos_curve = self._live_curves
+        hist_curve.setData(edges[:-1] / 1e3, self._live_hist)
+        trace_curve.setData(self._live_rate)
+        valid = np.isfinite(self._live_pos[:, 0])
+        pos_curve.setData(self._live_pos[valid, 0], self._live_pos[valid, 1])
+
     def make_connection(self, backend):
         
         backend.ctRatesSignal.connect(self.get_backend_parameters)
         backend.plotDataSignal.connect(self.plot_data)
+        backend.newDataSignal.connect(self.get_live_data)
         
     def  setup_gui(self):
         
@@ -150,6 +238,11 @@ class Frontend(QtGui.QFrame):
         self.fileWidget = QGroupBox('Save options')
         self.fileWidget.setFixedHeight(130)
         self.fileWidget.setFixedWidth(230)
+
+        # live analysis widget
+
+        self.liveWidget = QGroupBox('Live analysis')
+        self.liveWidget.setFixedWidth(230)
         
         # Prepare button
         
@@ -192,6 +285,18 @@ class Frontend(QtGui.QFrame):
         self.channel1Value.setReadOnly(True)
         
         self.filenameEdit = QtGui.QLineEdit('filename')
+
+        # live analysis parameters
+
+        self.gatesLabel = QtGui.QLabel('Gates [ns]')
+        self.gatesEdit = QtGui.QLineEdit('')
+        self.gatesEdit.setToolTip('start-stop pairs separated by commas. '
+                                  'Leave empty to use one gate per PSF')
+        self.SBRLabel = QtGui.QLabel('SBR')
+        self.SBREdit = QtGui.QLineEdit('8')
+        self.pxSizeLabel = QtGui.QLabel('PSF pixel size [nm]')
+        self.pxSizeEdit = QtGui.QLineEdit('1')
+        self.browsePSFButton = QtGui.QPushButton('PSF')
         
         # microTime histogram and timetrace
         
@@ -202,6 +307,10 @@ class Frontend(QtGui.QFrame):
         self.tracePlot = self.dataWidget.addPlot(row=2, col=0, title="Time trace")
         self.tracePlot.setLabels(bottom=('ms'),
                                 left=('counts'))
+
+        self.posPlot = self.dataWidget.addPlot(row=3, col=0, title="Live localizations")
+        self.posPlot.setLabels(bottom=('x', 'nm'), left=('y', 'nm'))
+        self.posPlot.setAspectLocked(True)
         
         # folder
         
@@ -228,6 +337,10 @@ class Frontend(QtGui.QFrame):
         self.measureButton.clicked.connect(self.start_measurement)
         self.browseFolderButton.clicked.connect(self.load_folder)
         self.clearButton.clicked.connect(self.clear_data)    
+        self.browsePSFButton.clicked.connect(self.load_PSF)
+        self.gatesEdit.editingFinished.connect(self.emit_live_param)
+        self.SBREdit.editingFinished.connect(self.emit_live_param)
+        self.pxSizeEdit.editingFinished.connect(self.emit_live_param)
         
         self.acqtimeEdit.textChanged.connect(self.emit_param)
         self.offsetEdit.textChanged.connect(self.emit_param)
@@ -239,7 +352,8 @@ class Frontend(QtGui.QFrame):
         self.setLayout(grid)
         grid.addWidget(self.paramWidget, 0, 0)
         grid.addWidget(self.fileWidget, 1, 0)
-        grid.addWidget(self.dataWidget, 0, 1, 2, 2)
+        grid.addWidget(self.liveWidget, 2, 0)
+        grid.addWidget(self.dataWidget, 0, 1, 3, 2)
         
         # param Widget layout
         
@@ -271,6 +385,17 @@ class Frontend(QtGui.QFrame):
         file_subgrid.addWidget(self.folderEdit, 2, 0, 1, 2)
         file_subgrid.addWidget(self.browseFolderButton, 3, 0)
 
+        live_subgrid = QtGui.QGridLayout()
+        self.liveWidget.setLayout(live_subgrid)
+
+        live_subgrid.addWidget(self.gatesLabel, 0, 0)
+        live_subgrid.addWidget(self.gatesEdit, 0, 1)
+        live_subgrid.addWidget(self.SBRLabel, 1, 0)
+        live_subgrid.addWidget(self.SBREdit, 1, 1)
+        live_subgrid.addWidget(self.pxSizeLabel, 2, 0)
+        live_subgrid.addWidget(self.pxSizeEdit, 2, 1)
+        live_subgrid.addWidget(self.browsePSFButton, 3, 0)
+
     def closeEvent(self, *args, **kwargs):
         
         workerThread.exit()
@@ -284,12 +409,29 @@ class Backend(QtCore.QObject):
     plotDataSignal = pyqtSignal(np.ndarray, np.ndarray)
     
     tcspcDoneSignal = pyqtSignal()
+    # emitted from the PicoHarp writer thread when the acquisition finishes
+    phDoneSignal = pyqtSignal()
+    # live data: (micro-times in ps, block length in ps, bins, position)
+    newDataSignal = pyqtSignal(object, object, object, object)
     
     def __init__(self, ph_device, *args, **kwargs): 
         
         super().__init__(*args, **kwargs)
           
         self.ph = ph_device         
+        self.minflux_measure = False
+        self.phDoneSignal.connect(self.measurement_done)
+        
+        self.decoder = Read_PTU.PT3StreamDecoder()
+        self.gates = None
+        self.locator = None
+        self.SBR = None
+        # used to configure live analysis on each prepare_minflux
+        self.live_windows = None
+        self.live_PSF = None
+        self.live_SBR = 8.
+        self.live_px_nm = 1.
+        self._NOPLACE = np.full((2,), np.nan)
         
         self.tcspcTimer = QtCore.QTimer()
         #TODO check timer value
@@ -330,6 +472,11 @@ class Backend(QtCore.QObject):
         print(datetime.now(), '[tcspc] Acquisition time = {} ms'.format(self.ph.tacq))
         print(datetime.now(), '[tcspc] Offset = {} ps'.format(self.ph.offset))
 
+        self.timeRes_ps = self.ph.resolution
+        self.decoder.reset()
+        self._last_sync = 0
+        self._accumulated_data = None
+
         print(datetime.now(), '[tcspc] Picoharp 300 prepared for TTTR measurement')
         
         self.tcspcTimer.start(500)
@@ -347,14 +494,14 @@ class Backend(QtCore.QObject):
         
         print(datetime.now(), '[tcspc] starting the PH measurement took {} s'.format(t1-t0))
         
-        self.ph.startTTTR(self.currentfname)
+        self.setup_live_analysis(self.live_gates(), self.live_PSF,
+                                 self.live_SBR, self.live_px_nm)
+        self.minflux_measure = False
+        self.ph.startTTTR_async(self.currentfname,
+                                done_callback=self.phDoneSignal.emit,
+                                data_callback=self.process_records)
         np.savetxt(self.currentfname + '.txt', [])
         
-        while self.ph.measure_state != 'done':
-            pass
-        
-        self.export_data()
-        
 #        self.ph.lib.PH_ClearHistMem(ctypes.c_int(0), 
 #                                  ctypes.c_int(0))
                 
@@ -375,6 +522,9 @@ class Backend(QtCore.QObject):
                                   ctypes.c_int(2)) # TO DO: fix this in a clean way (1 = 8 ps, 2 = 16 ps resolution)
         self.ph.lib.PH_SetSyncOffset(ctypes.c_int(0), ctypes.c_int(3000))
 
+        self.setup_live_analysis(self.live_gates(), self.live_PSF,
+                                 self.live_SBR, self.live_px_nm)
+
         t1 = time.time()
         
         print(datetime.now(), '[tcspc] preparing the PH measurement took {} s'.format(t1-t0))
@@ -382,36 +532,121 @@ class Backend(QtCore.QObject):
     @pyqtSlot(str)
     def measure_minflux(self, ignore_variable):
 
-        self.ph.startTTTR(self.currentfname)
+        self.minflux_measure = True
+        self.ph.startTTTR_async(self.currentfname,
+                                done_callback=self.phDoneSignal.emit,
+                                data_callback=self.process_records)
         
         print(datetime.now(), '[tcspc] minflux measurement started')
-                
-        while self.ph.measure_state != 'done':
-            pass
-        
-        self.tcspcDoneSignal.emit()
+
+    @pyqtSlot(object, object, float, float)
+    def set_live_parameters(self, windows, PSF=None, SBR=8., px_nm=1.):
+        """Set gates and PSF used by the following MINFLUX measurements.
+
+        Parameters
+        ----------
+        windows : sequence
+            One (start, stop) pair per gate, in ps after the sync (the same
+            convention as the relative times of the exported data). If None,
+            the sync period is split evenly into one gate per PSF, or there
+            is no live binning without PSF.
+        PSF : numpy.ndarray, optional
+            (K, size, size) EBP. If None, there is no live localization.
+        SBR : float
+            Signal to background ratio
+        px_nm : float
+            PSF pixel size in nm
+        """
+        self.live_windows = windows
+        self.live_PSF = PSF
+        self.live_SBR = SBR
+        self.live_px_nm = px_nm
+        print(datetime.now(), '[tcspc] live analysis: {} gates, PSF {}'.format(
+            'default' if windows is None else len(windows),
+            None if PSF is None else np.shape(PSF)))
+
+    def live_gates(self):
+        """Return the gate table set by `set_live_parameters`, or None."""
+        windows = self.live_windows
+        period = int(GLOB_RES * 1e12)
+        if windows is None and self.live_PSF is not None:
+            edges = np.linspace(0, period, len(self.live_PSF) + 1).astype(int)
+            windows = list(zip(edges[:-1], edges[1:]))
+        if windows is None:
+            return None
+        return GateTable.from_windows(windows, period)
+
+    def setup_live_analysis(self, gates=None, PSF=None, SBR=8., px_nm=1.):
+        """Set gates (a tools.gating.GateTable) and PSF for live localization.
+
+        Micro-times are the PicoHarp dtimes in ps, that are relative to the
+        sync and not offset, so gate tables must be built with
+        `GateTable.from_windows` (and no offset) on that time base. Tables
+        from `GateTable.from_delays` use the Swabian convention (offset, folded
+        time differences to the next pulse) and are rejected. Micro-times are
+        folded into the table period and binned using its first row. Without
+        gates, bins are empty. Without PSF, positions are NaN.
+        """
+        if gates is not None and gates.offset:
+            raise ValueError("PicoHarp micro-times are relative to the sync: "
+                             "gate tables must have no offset")
+        self.gates = gates
+        self.SBR = SBR
+        self.locator = None
+        if gates is not None and PSF is not None:
+            self.locator = MinFluxLocator(PSF, SBR, px_nm)
+
+    def process_records(self, records):
+        """Decode and bin a block of TTTR records (from the writer thread)."""
+        _, dtime, truensync, _ = self.decoder.decode(records)
+        if not len(truensync):
+            return
+        microtimes = dtime.astype(np.int64) * self.timeRes_ps
+        period_length = (int(truensync[-1]) - self._last_sync) * GLOB_RES * 1e12
+        self._last_sync = int(truensync[-1])
+        new_pos = self._NOPLACE
+        bins = np.zeros((0,), np.int64)
+        if self.gates is not None:
+            bins = self.gates.bin(microtimes % self.gates.period)
+            if self.locator is not None:
+                if self._accumulated_data is None:
+                    self._accumulated_data = np.zeros_like(bins)
+                self._accumulated_data += bins
+                if self._accumulated_data.sum() >= LIVE_MIN_PHOTONS:
+                    new_pos = self.locator(self._accumulated_data, self.SBR)[1]
+                    self._accumulated_data[:] = 0
+        self.newDataSignal.emit(microtimes, period_length, bins, new_pos)
+
+    @pyqtSlot()
+    def measurement_done(self):
+        
+        if self.minflux_measure:
+            self.tcspcDoneSignal.emit()
         self.export_data()
         
     def stop_measure(self):
         
-        # TO DO: make this function, not so easy because the while loop in the driver
-        # HINT: maybe use a timer loop to be able to access variables within the loop
         self.tcspcTimer.stop()
+        self.ph.stop_async()
 
-        print(datetime.now(), '[tcspc] stop measure function (empty)')
+        print(datetime.now(), '[tcspc] stop measure requested')
 
     def export_data(self):
         
-        inputfile = open(self.currentfname, "rb") # TO DO: fix file selection
-        print(datetime.now(), '[tcspc] opened {} file'.format(self.currentfname))
-        
         numRecords = self.ph.numRecords # number of records
-        globRes = 5e-8  # in ns, corresponds to sync @20 MHz, New NKT white laser
+        globRes = GLOB_RES
         timeRes = self.ph.resolution * 1e-12 # time resolution in s
 
-        relTime, absTime = Read_PTU.readPT3(inputfile, numRecords)
-
-        inputfile.close()
+        if self.decoder.numRecords == numRecords:
+            # already decoded while measuring
+            relTime, absTime, _, _ = self.decoder.arrays()
+        else:
+            inputfile = open(self.currentfname, "rb") # TO DO: fix file selection
+            print(datetime.now(), '[tcspc] opened {} file'.format(self.currentfname))
+            relTime, absTime, _, _ = Read_PTU.readPT3_fast(inputfile, numRecords)
+            inputfile.close()
+        relTime = relTime.astype(np.float64)
+        absTime = absTime.astype(np.float64)
         
         print('max and min relTime', np.max(relTime), np.min(relTime))
         relTime = relTime * timeRes # in real time units (s)
@@ -453,8 +688,10 @@ class Backend(QtCore.QObject):
         frontend.measureSignal.connect(self.measure)
         frontend.prepareButton.clicked.connect(self.prepare_ph)
         frontend.stopButton.clicked.connect(self.stop_measure)
+        frontend.liveParamSignal.connect(self.set_live_parameters)
 
         frontend.emit_param() # TO DO: change such that backend has parameters defined from the start
+        frontend.emit_live_param()
 
     def stop(self):
   
@@ -12,8 +12,12 @@ import numpy as _np
 import imageio as _iio
 import logging as _lgn
 import configparser as _cp
+import math as _math
 import numba as _nb
-from typing import Tuple
+import scipy.ndimage as _ndi
+import threading as _th
+from concurrent.futures import ThreadPoolExecutor as _TPE
+from typing import Tuple, Optional as _Optional, Sequence as _Sequence
 
 # _lgn.basicConfig(level=_lgn.DEBUG)
 _lgr = _lgn.getLogger(__name__)
@@ -81,6 +85,181 @@ def centers_minflux(L: float, k: int = 4):
     ebp[1:][::-1, 1] = _np.cos(angles) * L / 2
     return ebp
 
+def zoom_shift_sum(frames: _np.ndarray, zoom: float, shifts: _np.ndarray,
+                   groups: _Sequence[int], n_groups: int,
+                   output_shape: _Optional[Tuple[int, int]] = None,
+                   n_threads: int = 1, order: int = 3) -> _np.ndarray:
+    """Zoom and shift frames, summing the results by group.
+
+    Each frame is resampled once with `scipy.ndimage.affine_transform`, which
+    is equivalent to `scipy.ndimage.zoom` followed by `scipy.ndimage.shift`
+    but interpolates only once. Results are accumulated straight into the
+    group sums, so memory use does not depend on the number of frames.
+
+    Parameters
+    ----------
+    frames : numpy.ndarray
+        (n_frames, X, Y) array of images
+    zoom : float
+        Zoom factor (e.g. original pixel size over final pixel size)
+    shifts : numpy.ndarray
+        (n_frames, 2) shifts applied after zooming, in final pixels
+    groups : sequence of int
+        Group of each frame (e.g. the donut index). Frames in a negative group
+        are skipped.
+    n_groups : int
+        Number of groups
+    output_shape : tuple of int, optional
+        Shape of the zoomed frames. Defaults to the one given by
+        `scipy.ndimage.zoom`.
+    n_threads : int, default 1
+        Number of threads. scipy.ndimage releases the GIL, so frames are
+        resampled in parallel.
+    order : int, default 3
+        Spline interpolation order
+
+    Returns
+    -------
+    numpy.ndarray
+        (n_groups, *output_shape) array with the sum of the frames of each group
+    """
+    in_shape = _np.array(frames.shape[1:])
+    zoomed_shape = _np.round(in_shape * zoom).astype(int)
+    if output_shape is None:
+        output_shape = tuple(zoomed_shape)
+    # same coordinate mapping as ndimage.zoom (grid_mode=False)
+    scale = (in_shape - 1) / _np.maximum(zoomed_shape - 1, 1)
+    shifts = _np.asarray(shifts, dtype=float)
+    sums = _np.zeros((n_groups, *output_shape))
+    locks = [_th.Lock() for _ in range(n_groups)]
+    todo = [i for i, g in enumerate(groups) if 0 <= g < n_groups]
+
+    def process(chunk):
+        out = _np.empty(output_shape)
+        for i in chunk:
+            _ndi.affine_transform(frames[i].astype(_np.float64, copy=False), scale,
+                                  -shifts[i] * scale, output_shape, out, order)
+            with locks[groups[i]]:
+                sums[groups[i]] += out
+
+    n_threads = max(1, min(int(n_threads), len(todo)))
+    if n_threads == 1:
+        process(todo)
+    else:
+        with _TPE(n_threads) as executor:
+            list(executor.map(process, [todo[t::n_threads] for t in range(n_threads)]))
+    return sums
+
+
+def _translation_matrix(delta: float, degree: int) -> _np.ndarray:
+    """Matrix T such that sum_i c_i (u + delta)**i = sum_m (T.T @ c)_m u**m."""
+    i = _np.arange(degree + 1)
+    binom = _np.array([[_comb(a, b) for b in i] for a in i], dtype=float)
+    power = _np.clip(i[:, None] - i[None, :], 0, None)
+    return _np.where(i[:, None] >= i[None, :], binom * delta ** power, 0.)
+
+
+def _comb(n: int, k: int) -> int:
+    return _math.comb(n, k) if k <= n else 0
+
+
+class PolyPSFFitter:
+    """Least squares fit of 2D polynomials, as used for experimental PSFs.
+
+    The model is ``sum c[i, j] (x - x0)**i (y - y0)**j`` with i, j up to
+    `degree` (see `numpy.polynomial.polynomial.polyval2d`). The coefficients
+    enter linearly and, since translating such a polynomial gives another one
+    of the same degrees, the center (x0, y0) only sets the expansion point and
+    does not change the fitted surface. So the fit is solved in closed form
+    once, with a design matrix cached for the grid, and the coefficients are
+    then re-expanded around each requested center.
+
+    Coordinates are centered and scaled to [-1, 1] to keep the design matrix
+    well conditioned.
+
+    Use
+    ---
+    >>> fitter = PolyPSFFitter(x, y)
+    >>> coeffs = fitter.fit(images, centers)  # (K, degree+1, degree+1)
+    >>> fitted = fitter.evaluate(coeffs[0], centers[0])
+    """
+
+    def __init__(self, x: _np.ndarray, y: _np.ndarray, degree: int = 4,
+                 step: int = 1):
+        """Build and factor the design matrix.
+
+        Parameters
+        ----------
+        x, y : numpy.ndarray
+            Coordinates of every pixel (same shape as the fitted images)
+        degree : int, default 4
+            Maximum power of each coordinate
+        step : int, default 1
+            Fit only every `step` pixels along each axis. Faster, at the
+            expense of ignoring data.
+        """
+        self.degree = degree
+        self.shape = _np.shape(x)
+        self.step = max(int(step), 1)
+        self._x = _np.asarray(x, dtype=float)
+        self._y = _np.asarray(y, dtype=float)
+        self._center = _np.array((self._x.mean(), self._y.mean()))
+        self._scale = _np.array((_np.ptp(self._x), _np.ptp(self._y))) / 2
+        self._scale[self._scale == 0] = 1.
+        sl = (slice(None, None, self.step),) * len(self.shape)
+        self._sl = sl
+        self._design = self._design_matrix(self._x[sl], self._y[sl])
+        self._q, self._r = _np.linalg.qr(self._design)
+
+    def _design_matrix(self, x, y):
+        """Columns u**i v**j in scaled coordinates, ordered as c.ravel()."""
+        u = ((x - self._center[0]) / self._scale[0]).ravel()
+        v = ((y - self._center[1]) / self._scale[1]).ravel()
+        powers = _np.arange(self.degree + 1)
+        pu = u[:, None] ** powers
+        pv = v[:, None] ** powers
+        return (pu[:, :, None] * pv[:, None, :]).reshape(len(u), -1)
+
+    def fit(self, images: _np.ndarray, centers: _np.ndarray) -> _np.ndarray:
+        """Fit images.
+
+        Parameters
+        ----------
+        images : numpy.ndarray
+            (K, *shape) array of images, or a single image
+        centers : numpy.ndarray
+            (K, 2) array with the expansion point (x0, y0) of each fit
+
+        Returns
+        -------
+        numpy.ndarray
+            (K, degree + 1, degree + 1) array of coefficients for
+            `polyval2d(x - x0, y - y0, c)`
+        """
+        images = _np.asarray(images, dtype=float)
+        single = images.ndim == len(self.shape)
+        if single:
+            images = images[_np.newaxis]
+        rhs = images[(slice(None),) + self._sl].reshape(len(images), -1).T
+        scaled = _np.linalg.solve(self._r, self._q.T @ rhs).T
+        D = self.degree + 1
+        rv = _np.empty((len(images), D, D))
+        for k, (c, center) in enumerate(zip(scaled.reshape(-1, D, D),
+                                            _np.reshape(centers, (-1, 2)))):
+            # unscale, then move the expansion point to the requested center
+            c = c / _np.outer(self._scale[0] ** _np.arange(D),
+                              self._scale[1] ** _np.arange(D))
+            tx = _translation_matrix(center[0] - self._center[0], self.degree)
+            ty = _translation_matrix(center[1] - self._center[1], self.degree)
+            rv[k] = tx.T @ c @ ty
+        return rv[0] if single else rv
+
+    def evaluate(self, coeffs: _np.ndarray, center) -> _np.ndarray:
+        """Evaluate a fitted polynomial on the full grid."""
+        return _np.polynomial.polynomial.polyval2d(
+            self._x - center[0], self._y - center[1], coeffs)
+
+
 def preprare_grid_forfit(side_x, side_y):
     x_axis = _np.arange(0, side_x, 1)
     y_axis = _np.arange(0, side_y, 1)
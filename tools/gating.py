@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Gate tables for real time binning of TCSPC data.
+
+A gate table maps (detector, micro-time) to an exposure (gate) index using a
+precomputed lookup table, so binning a photon costs the same whatever the
+number of gates is.
+
+@author: azelcer
+"""
+
+import numpy as _np
+import numba as _nb
+import logging as _lgn
+from dataclasses import dataclass as _dataclass
+from typing import Sequence as _Sequence, Tuple as _Tuple
+
+_lgr = _lgn.getLogger(__name__)
+
+# Offset (in ps) used by the original hard coded 4 gates binning
+LEGACY_OFFSET = 4290
+# Value in the lookup table for discarded micro-times
+NO_GATE = -1
+
+
+@_dataclass
+class GateTable:
+    """Lookup table from micro-time to gate index.
+
+    The micro-time of a photon is `(td + offset) % period`, where `td` is the
+    time from the photon to the next laser pulse (both in ps). The gate of a
+    photon detected on `channels[c]` is `lut[c, micro-time // resolution]`, or
+    NO_GATE if it must be discarded.
+    """
+
+    period: int  # ps
+    resolution: int  # ps per lookup table bin
+    offset: int  # ps
+    channels: _Tuple[int, ...]  # detector channels
+    lut: _np.ndarray  # (n_channels, n_bins) int8
+    n_gates: int
+
+    @property
+    def n_bins(self) -> int:
+        """Number of bins of the lookup table."""
+        return self.lut.shape[1]
+
+    def bin_edges(self) -> _np.ndarray:
+        """Return the micro-time (in ps) at the start of each lookup table bin."""
+        return _np.arange(self.n_bins, dtype=_np.int64) * self.resolution
+
+    def gate_of(self, microtimes: _np.ndarray, channel_index: int = 0) -> _np.ndarray:
+        """Return the gate of each micro-time, for one detector."""
+        idx = _np.asarray(microtimes, dtype=_np.int64) // self.resolution
+        return self.lut[channel_index, _np.clip(idx, 0, self.n_bins - 1)]
+
+    def bin(self, microtimes: _np.ndarray, channels: _np.ndarray = None) -> _np.ndarray:
+        """Count photons per gate.
+
+        Parameters
+        ----------
+        microtimes : numpy.ndarray
+            Folded micro-times in ps
+        channels : numpy.ndarray, optional
+            Detector channel of each photon. If None, all photons are binned
+            using the first detector row.
+
+        Returns
+        -------
+        (n_gates,) array of counts
+        """
+        if channels is None:
+            gates = self.gate_of(microtimes)
+            return _np.bincount(gates[gates >= 0], minlength=self.n_gates)
+        rv = _np.zeros((self.n_gates,), dtype=_np.int64)
+        for c, channel in enumerate(self.channels):
+            gates = self.gate_of(microtimes[channels == channel], c)
+            rv += _np.bincount(gates[gates >= 0], minlength=self.n_gates)
+        return rv
+
+    @classmethod
+    def from_windows(cls, windows, period: int,
+                     channels: _Sequence[int] = (0,), resolution: int = 1,
+                     offset: int = 0):
+        """Build a table from gate windows.
+
+        Parameters
+        ----------
+        windows : sequence
+            One (start, stop) pair of micro-times in ps per gate, or one such
+            sequence per channel. Windows may wrap around the period
+            (start > stop). Micro-times outside every window are discarded.
+            If windows overlap, the last gate wins.
+        period : int
+            Laser period in ps
+        channels : sequence of int
+            Detector channels
+        resolution : int, default 1
+            Lookup table resolution in ps
+        offset : int, default 0
+            Offset in ps added to time differences before folding
+        """
+        channels = tuple(int(c) for c in channels)
+        windows = list(windows)
+        if windows and _np.ndim(windows[0]) == 1:
+            windows = [windows] * len(channels)
+        if len(windows) != len(channels):
+            raise ValueError("Need one set of windows per channel")
+        n_gates = len(windows[0])
+        if any(len(w) != n_gates for w in windows):
+            raise ValueError("All channels must have the same number of gates")
+        if n_gates > _np.iinfo(_np.int8).max:
+            raise ValueError(f"Too many gates: {n_gates}")
+        n_bins = -(-int(period) // int(resolution))
+        starts = _np.arange(n_bins, dtype=_np.int64) * resolution
+        lut = _np.full((len(channels), n_bins), NO_GATE, dtype=_np.int8)
+        for c, channel_windows in enumerate(windows):
+            for gate, (start, stop) in enumerate(channel_windows):
+                start %= period
+                stop %= period
+                if start <= stop:
+                    mask = (starts >= start) & (starts < stop)
+                else:
+                    mask = (starts >= start) | (starts < stop)
+                lut[c, mask] = gate
+        return cls(int(period), int(resolution), int(offset), channels, lut, n_gates)
+
+    @classmethod
+    def from_delays(cls, delays: _Sequence[int], period: int,
+                    channels: _Sequence[int] = (0,), resolution: int = 1,
+                    offset: int = LEGACY_OFFSET):
+        """Build a table equivalent to the original shutter delays binning.
+
+        Gate k covers micro-times in (period - delays[k+1], period - delays[k]],
+        the first gate also takes everything above period - delays[1]. No
+        micro-time is discarded.
+
+        Parameters
+        ----------
+        delays : sequence of int
+            Shutter delays in ps. Must be sorted.
+        period : int
+            Laser period in ps
+        channels : sequence of int
+            Detector channels
+        resolution : int, default 1
+            Lookup table resolution in ps. Use 1 to reproduce the original
+            binning exactly.
+        offset : int, default LEGACY_OFFSET
+            Offset in ps added to time differences before folding
+        """
+        if sorted(delays) != list(delays):
+            raise ValueError("Delays are not sorted")
+        shutter_delays = int(period) - _np.array(delays, dtype=_np.int64)
+        n_bins = -(-int(period) // int(resolution))
+        starts = _np.arange(n_bins, dtype=_np.int64) * resolution
+        row = _np.zeros((n_bins,), dtype=_np.int8)
+        for gate in range(1, len(shutter_delays)):
+            row[starts <= shutter_delays[gate]] = gate
+        lut = _np.repeat(row[_np.newaxis], len(channels), axis=0)
+        return cls(int(period), int(resolution), int(offset),
+                   tuple(int(c) for c in channels), lut, len(shutter_delays))
+
+
+# Explicit signature, so the kernel is compiled at import and not on the first
+# data block. Tag fields are strided views of a structured array ('A' layout).
+@_nb.njit(_nb.types.UniTuple(_nb.int64, 2)(
+    _nb.int64[:], _nb.int32[:], _nb.uint8[:], _nb.int64, _nb.int64[:],
+    _nb.int8[:, :], _nb.int64, _nb.int64, _nb.int64, _nb.int64[:],
+    _nb.int64[:], _nb.int64[:], _nb.int64[:, :], _nb.int64),
+    nogil=True)
+def gate_tags(times: _np.ndarray, channels: _np.ndarray, types: _np.ndarray,
+              laser_channel: int, apd_channels: _np.ndarray, lut: _np.ndarray,
+              period: int, offset: int, resolution: int,
+              last_timestamps: _np.ndarray, data: _np.ndarray,
+              bins: _np.ndarray, histogram: _np.ndarray,
+              hist_resolution: int) -> _Tuple[int, int]:
+    """Gate and bin a block of time tags in a single pass.
+
+    Each photon is paired with the next laser tag. Its time difference is
+    saved in data, its gate is looked up in lut and counted in bins, and its
+    micro-time is accumulated in the histogram row of its detector.
+
+    Parameters
+    ----------
+    times, channels, types : numpy.ndarray
+        Time tags (ps), channels and types (0 = TimeTag, anything else is an
+        error or overflow)
+    laser_channel : int
+        Laser (sync) channel
+    apd_channels : numpy.ndarray
+        Detector channels, in lookup table row order
+    lut : numpy.ndarray
+        (n_channels, n_bins) gate lookup table (see GateTable)
+    period, offset, resolution : int
+        Laser period, micro-time offset and lookup table resolution, in ps
+    last_timestamps : numpy.ndarray
+        (n_channels,) last unpaired photon time of each detector, 0 if none.
+        Updated in place, so state is kept between blocks.
+    data : numpy.ndarray
+        Output time differences
+    bins : numpy.ndarray
+        (n_gates,) output counts per gate. Not cleared.
+    histogram : numpy.ndarray
+        (n_channels, n_hist) micro-time histogram. Not cleared.
+    hist_resolution : int
+        Histogram resolution in ps
+
+    Returns
+    -------
+    Number of time differences saved and number of errors.
+    """
+    n_apds = apd_channels.size
+    n_lut = lut.shape[1]
+    n_hist = histogram.shape[1]
+    n_errors = 0
+    last_pos = 0
+    for i in range(times.size):
+        # type can be: 0 - TimeTag, 1- Error, 2 - OverflowBegin, 3 -
+        # OverflowEnd, 4 - MissedEvents
+        if types[i] != 0:
+            last_timestamps[:] = 0
+            n_errors += 1
+            continue
+        chan = channels[i]
+        if chan == laser_channel:
+            for c in range(n_apds):
+                if last_timestamps[c] == 0:
+                    continue
+                td = times[i] - last_timestamps[c]
+                last_timestamps[c] = 0
+                if last_pos < data.size:
+                    data[last_pos] = td
+                    last_pos += 1
+                else:
+                    n_errors += 1
+                mt = (td + offset) % period
+                idx = mt // resolution
+                if idx < n_lut:
+                    gate = lut[c, idx]
+                    if gate >= 0:
+                        bins[gate] += 1
+                h = mt // hist_resolution
+                if h < n_hist:
+                    histogram[c, h] += 1
+        else:
+            for c in range(n_apds):
+                if chan == apd_channels[c]:
+                    last_timestamps[c] = times[i]
+                    break
+    return last_pos, n_errors
+
+
+# Used offline, on whatever integer types the file reader returns
+@_nb.njit(nogil=True)
+def delay_tags(times: _np.ndarray, channels: _np.ndarray, types: _np.ndarray,
+               laser_channel: int, apd_channels: _np.ndarray,
+               marker_channel: int, period: int,
+               last_timestamps: _np.ndarray,
+               records: _np.ndarray) -> _Tuple[int, int]:
+    """Convert a block of time tags into per photon records.
+
+    Photons are paired with the next laser tag as in `gate_tags`. Each photon
+    gives a record (detector channel, laser tag time, micro-time), where the
+    micro-time is `(period - td) % period`. Marker tags give a record
+    (marker_channel, time, 0). Records are sorted by time.
+
+    Parameters
+    ----------
+    times, channels, types : numpy.ndarray
+        Time tags (ps), channels and types (0 = TimeTag, anything else is an
+        error or overflow)
+    laser_channel : int
+        Laser (sync) channel
+    apd_channels : numpy.ndarray
+        Detector channels
+    marker_channel : int
+        Marker (pixel) channel
+    period : int
+        Laser period, in ps
+    last_timestamps : numpy.ndarray
+        (n_channels,) last unpaired photon time of each detector, 0 if none.
+        Updated in place, so state is kept between blocks.
+    records : numpy.ndarray
+        (times.size, 3) int64 output records. Every record uses up at least
+        one tag, so they always fit.
+
+    Returns
+    -------
+    Number of records saved and number of errors (including tags from
+    unknown channels).
+    """
+    n_apds = apd_channels.size
+    n_errors = 0
+    last_pos = 0
+    for i in range(times.size):
+        if types[i] != 0:
+            last_timestamps[:] = 0
+            n_errors += 1
+            continue
+        chan = channels[i]
+        if chan == laser_channel:
+            for c in range(n_apds):
+                if last_timestamps[c] == 0:
+                    continue
+                td = times[i] - last_timestamps[c]
+                last_timestamps[c] = 0
+                records[last_pos, 0] = apd_channels[c]
+                records[last_pos, 1] = times[i]
+                records[last_pos, 2] = (period - td) % period
+                last_pos += 1
+        elif chan == marker_channel:
+            records[last_pos, 0] = marker_channel
+            records[last_pos, 1] = times[i]
+            records[last_pos, 2] = 0
+            last_pos += 1
+        else:
+            for c in range(n_apds):
+                if chan == apd_channels[c]:
+                    last_timestamps[c] = times[i]
+                    break
+            else:
+                n_errors += 1
+    return last_pos, n_errors
+
+
+if __name__ == '__main__':
+    period = 50000
+    delays = [0, 2000, 12000, 25000]
+    table = GateTable.from_delays(delays, period, (4,))
+    # Original binning
+    td = _np.random.randint(0, period, 100000)
+    mt = (td + LEGACY_OFFSET) % period
+    sd = period - _np.array(delays)
+    legacy = _np.where(mt <= sd[3], 3, _np.where(mt <= sd[2], 2,
+                       _np.where(mt <= sd[1], 1, 0)))
+    print("Same as legacy binning:", _np.all(table.gate_of(mt) == legacy))
+    # 8 gates, 2 detectors
+    windows = [(k * 6000, k * 6000 + 5000) for k in range(8)]
+    table = GateTable.from_windows(windows, period, (4, 5), resolution=10)
+    n = 200000
+    times = _np.empty((2 * n,), dtype=_np.int64)
+    times[1::2] = _np.arange(1, n + 1) * period
+    times[0::2] = times[1::2] - _np.random.randint(1, period, n)
+    channels = _np.empty((2 * n,), dtype=_np.int32)
+    channels[0::2] = _np.random.choice([4, 5], n)
+    channels[1::2] = 1
+    types = _np.zeros((2 * n,), dtype=_np.uint8)
+    data = _np.empty((n,), dtype=_np.int64)
+    bins = _np.zeros((table.n_gates,), dtype=_np.int64)
+    histogram = _np.zeros((2, period // 100), dtype=_np.int64)
+    last = _np.zeros((2,), dtype=_np.int64)
+    print(gate_tags(times, channels, types, 1,
+                    _np.array(table.channels, dtype=_np.int64), table.lut,
+                    table.period, table.offset, table.resolution, last, data,
+                    bins, histogram, 100), bins)
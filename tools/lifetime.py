@@ -0,0 +1,652 @@
+# -*- coding: utf-8 -*-
+"""
+Lifetime and trace segmentation fits
+
+Maximum likelihood fits of binned photon data, assuming Poisson counts:
+    - `fit_decay`: mono or bi-exponential decays convolved with a gaussian
+      IRF, fitted to a (usually logarithmically binned) TCSPC histogram.
+    - `window_lifetimes`: lifetime of many time windows at once, with the IRF
+      and background fraction known (e.g. from a global `fit_decay`).
+    - `fit_ipt` and `segmentation_threshold`: two-state (ON/OFF) model of
+      the inter-photon times, and the threshold that best separates ON from
+      OFF bins of a time trace.
+
+Models are integrated over each bin, so any binning can be used. Times are
+in the units of the data (usually ns for microtimes and s for macro-times).
+
+@author: azelcer
+"""
+
+import numpy as _np
+import logging as _lgn
+from dataclasses import dataclass as _dataclass, field as _field
+from typing import Optional as _Optional, Tuple as _Tuple, Dict as _Dict
+from scipy import optimize as _opt
+from scipy import special as _special
+from scipy import stats as _stats
+
+from tools.analysis import window_bounds, window_labels
+
+_lgr = _lgn.getLogger(__name__)
+
+_SQRT_2PI = _np.sqrt(2 * _np.pi)
+_MIN_SIGMA = 1E-4
+_MIN_TAU = 1E-4
+# Parameters of each decay model, in order
+_DECAY_PARAMS = {
+    'mono': ('amplitude', 'tau', 't0', 'sigma', 'background'),
+    'bi': ('amplitude1', 'tau1', 'amplitude2', 'tau2', 't0', 'sigma', 'background'),
+}
+# Extra parameters when fitting tails of previous pulses
+_TAIL_PARAMS = {
+    'mono': ('tail',),
+    'bi': ('tail1', 'tail2'),
+}
+
+
+def _param_names(model: str, tail: bool) -> tuple:
+    return _DECAY_PARAMS[model] + (_TAIL_PARAMS[model] if tail else ())
+
+
+def log_bins(t_start: float, t_stop: float, n_bins: int = 64,
+             first_width: _Optional[float] = None) -> _np.ndarray:
+    """Return bin edges whose width grows geometrically from `t_start`.
+
+    Parameters
+    ----------
+    t_start, t_stop : float
+        Limits of the histogram
+    n_bins : int, default 64
+        Number of bins
+    first_width : float, optional
+        Width of the first bin. Defaults to 1/1000 of the range.
+
+    Returns
+    -------
+    numpy.ndarray
+        (n_bins + 1,) array of edges
+    """
+    span = t_stop - t_start
+    if first_width is None:
+        first_width = span / 1000
+    offsets = _np.geomspace(first_width, span, n_bins)
+    return t_start + _np.concatenate(([0.], offsets))
+
+
+def _emg_cdf(edges: _np.ndarray, tau, t0, sigma, derivatives: bool = False):
+    """CDF of an exponential decay convolved with a gaussian IRF.
+
+    Parameters broadcast against `edges`. If `derivatives` is True, also
+    return the derivatives with respect to tau, t0 and sigma.
+    """
+    x = edges - t0
+    z = x / sigma
+    w = z - sigma / tau
+    # exp(-x/tau + sigma**2 / (2 tau**2)) * Phi(w), computed in log space
+    E = _np.exp(-x / tau + 0.5 * (sigma / tau) ** 2 + _special.log_ndtr(w))
+    F = _special.ndtr(z) - E
+    if not derivatives:
+        return F
+    phi = _np.exp(-0.5 * z ** 2) / _SQRT_2PI
+    d_tau = -(E * (x / tau ** 2 - sigma ** 2 / tau ** 3) + phi * sigma / tau ** 2)
+    d_t0 = -E / tau
+    d_sigma = phi / tau - E * sigma / tau ** 2
+    return F, d_tau, d_t0, d_sigma
+
+
+def _tail_cdf(edges: _np.ndarray, tau, derivative: bool = False):
+    """Integral of exp(-(t - edges[0]) / tau) from edges[0] (and d/dtau)."""
+    x = edges - edges[..., :1]
+    e = _np.exp(-x / tau)
+    G = tau * (1 - e)
+    if not derivative:
+        return G
+    return G, (1 - e) - e * x / tau
+
+
+def _decay_model(params: _np.ndarray, edges: _np.ndarray, model: str,
+                 jacobian: bool = False, tail: bool = False):
+    """Expected counts per bin (and their jacobian).
+
+    If `tail`, each component also has an exponential decay already running
+    at the start of the range (the tail of previous excitation pulses), whose
+    rate at edges[0] is the tail parameter.
+    """
+    widths = _np.diff(edges)
+    n_comp = 1 if model == 'mono' else 2
+    amplitudes, taus = params[0:2 * n_comp:2], params[1:2 * n_comp:2]
+    t0, sigma, bkg = params[2 * n_comp: 2 * n_comp + 3]
+    mu = bkg * widths
+    jac = _np.zeros((len(widths), len(params))) if jacobian else None
+    if jacobian:
+        jac[:, 2 * n_comp + 2] = widths
+    for c, (amplitude, tau) in enumerate(zip(amplitudes, taus)):
+        if jacobian:
+            F, d_tau, d_t0, d_sigma = _emg_cdf(edges, tau, t0, sigma, True)
+            jac[:, 2 * c] = _np.diff(F)
+            jac[:, 2 * c + 1] = amplitude * _np.diff(d_tau)
+            jac[:, 2 * n_comp] += amplitude * _np.diff(d_t0)
+            jac[:, 2 * n_comp + 1] += amplitude * _np.diff(d_sigma)
+        else:
+            F = _emg_cdf(edges, tau, t0, sigma)
+        mu = mu + amplitude * _np.diff(F)
+        if tail:
+            rate = params[2 * n_comp + 3 + c]
+            if jacobian:
+                G, dG = _tail_cdf(edges, tau, True)
+                jac[:, 2 * n_comp + 3 + c] = _np.diff(G)
+                jac[:, 2 * c + 1] += rate * _np.diff(dG)
+            else:
+                G = _tail_cdf(edges, tau)
+            mu = mu + rate * _np.diff(G)
+    return mu, jac
+
+
+@_dataclass
+class DecayFit:
+    """Result of `fit_decay`."""
+
+    model: str
+    params: _Dict[str, float]
+    errors: _Dict[str, float]
+    edges: _np.ndarray
+    counts: _np.ndarray
+    nll: float
+    success: bool
+    fixed: tuple = _field(default_factory=tuple)
+    tail: bool = False
+
+    def expected(self, edges: _Optional[_np.ndarray] = None) -> _np.ndarray:
+        """Expected counts in each bin (by default, the fitted bins)."""
+        edges = self.edges if edges is None else edges
+        values = _np.array([self.params[p] for p in _param_names(self.model, self.tail)])
+        return _decay_model(values, edges, self.model, tail=self.tail)[0]
+
+    @property
+    def tail_fraction(self) -> float:
+        """Fraction of the counts in the fitted range due to previous pulses."""
+        if not self.tail or self.model != 'mono':
+            return 0.
+        tail = self.params['tail'] * _tail_cdf(self.edges[[0, -1]], self.params['tau'])[-1]
+        return tail / max(self.expected().sum(), 1E-300)
+
+    @property
+    def background_fraction(self) -> float:
+        """Fraction of the counts in the fitted range due to background."""
+        bkg = self.params['background'] * (self.edges[-1] - self.edges[0])
+        return bkg / max(self.expected().sum(), 1E-300)
+
+    @property
+    def mean_tau(self) -> float:
+        """Lifetime (amplitude weighted mean lifetime for 'bi')."""
+        if self.model == 'mono':
+            return self.params['tau']
+        a1, a2 = self.params['amplitude1'], self.params['amplitude2']
+        return (a1 * self.params['tau1'] + a2 * self.params['tau2']) / (a1 + a2)
+
+
+def fit_decay(counts: _np.ndarray, edges: _np.ndarray, model: str = 'mono',
+              p0: _Optional[dict] = None, fixed: _Optional[dict] = None,
+              tail: bool = False) -> DecayFit:
+    """Poisson MLE fit of a decay histogram.
+
+    The model is a sum of exponential decays starting at t0 convolved with
+    a gaussian IRF of width sigma, plus a constant background (counts per
+    unit time). See `_DECAY_PARAMS` for parameter names.
+
+    With interleaved excitation (several pulses per period) the decays of
+    previous pulses are still running at the start of the fitted range. They
+    add an exponential with the same lifetime, fitted if `tail` is True (see
+    `_TAIL_PARAMS`).
+
+    Parameters
+    ----------
+    counts : numpy.ndarray
+        (B,) histogram
+    edges : numpy.ndarray
+        (B + 1,) bin edges (see `log_bins`)
+    model : str, default 'mono'
+        'mono' or 'bi'
+    p0 : dict, optional
+        Initial values of some parameters. Others are estimated from data.
+    fixed : dict, optional
+        Parameters kept at a given value (e.g. a measured IRF width)
+    tail : bool, default False
+        Fit the tail of previous pulses
+
+    Returns
+    -------
+    DecayFit
+        Parameters, their standard errors (from the Fisher information; 0 for
+        fixed ones) and the negative log-likelihood.
+    """
+    if model not in _DECAY_PARAMS:
+        raise ValueError(f"Unknown model: {model}")
+    names = _param_names(model, tail)
+    counts = _np.asarray(counts, dtype=float)
+    edges = _np.asarray(edges, dtype=float)
+    fixed = dict(fixed or {})
+    guess = _guess_decay(counts, edges, model)
+    for name in _TAIL_PARAMS[model]:
+        guess[name] = counts[0] / (edges[1] - edges[0]) / len(_TAIL_PARAMS[model])
+    guess.update(p0 or {})
+    guess.update(fixed)
+    span = edges[-1] - edges[0]
+    bounds = {'t0': (edges[0] - span, edges[-1]), 'sigma': (_MIN_SIGMA, span),
+              'background': (0., None), 'tail': (0., None), 'tail1': (0., None),
+              'tail2': (0., None)}
+    lower, upper = [], []
+    for name in names:
+        if name in fixed:
+            lower.append(fixed[name])
+            upper.append(fixed[name])
+        elif name.startswith('tau'):
+            lower.append(_MIN_TAU)
+            upper.append(100 * span)
+        elif name.startswith('amplitude'):
+            lower.append(0.)
+            upper.append(None)
+        else:
+            lower.append(bounds[name][0])
+            upper.append(bounds[name][1])
+    x0 = _np.array([guess[n] for n in names], dtype=float)
+    x0 = _np.clip(x0, [-_np.inf if b is None else b for b in lower],
+                  [_np.inf if b is None else b for b in upper])
+    # optimize in units of the initial values, so all steps are comparable
+    scale = _np.where(_np.abs(x0) > 0, _np.abs(x0), 1.)
+
+    def nll_and_grad(y):
+        params = y * scale
+        mu, jac = _decay_model(params, edges, model, True, tail)
+        mu = _np.maximum(mu, 1E-300)
+        nll = _np.sum(mu - counts * _np.log(mu))
+        grad = (1. - counts / mu) @ jac
+        return nll, grad * scale
+
+    scaled_bounds = [(None if lo is None else lo / s, None if hi is None else hi / s)
+                     for lo, hi, s in zip(lower, upper, scale)]
+    result = _opt.minimize(nll_and_grad, x0 / scale, jac=True, method='L-BFGS-B',
+                           bounds=scaled_bounds)
+    params = result.x * scale
+    errors = _fisher_errors(params, edges, model, [n in fixed for n in names], tail)
+    if not result.success:
+        _lgr.warning("Decay fit did not converge: %s", result.message)
+    return DecayFit(model, dict(zip(names, params)), dict(zip(names, errors)),
+                    edges, counts, float(result.fun), bool(result.success),
+                    tuple(fixed), tail)
+
+
+def _guess_decay(counts: _np.ndarray, edges: _np.ndarray, model: str) -> dict:
+    """Rough initial values for `fit_decay`.
+
+    The peak is located with the rate estimated over a fixed number of
+    photons, since with logarithmic bins the first bins are too narrow for
+    their rates to be meaningful.
+    """
+    total = counts.sum()
+    cum = _np.concatenate(([0.], _np.cumsum(counts)))
+    span = edges[-1] - edges[0]
+    if total < 10:
+        t0, tau, bkg = edges[0], span / 4, 0.
+    else:
+        n_pool = max(total / 20, 5.)
+        levels = _np.linspace(n_pool / 2, total - n_pool / 2, 200)
+        t_lo = _np.interp(levels - n_pool / 2, cum, edges)
+        t_hi = _np.interp(levels + n_pool / 2, cum, edges)
+        rates = n_pool / _np.maximum(t_hi - t_lo, 1E-300)
+        peak = int(_np.argmax(rates))
+        t0 = float(_np.interp(levels[peak], cum, edges))
+        bkg = float(rates.min()) / 2
+        n_after = total - _np.interp(t0, edges, cum)
+        tau = max(n_after / rates[peak], span / 100)
+    sigma = max(span / 50, _MIN_SIGMA)
+    signal = max(total - bkg * span, 1.)
+    if model == 'mono':
+        return {'amplitude': signal, 'tau': tau, 't0': t0, 'sigma': sigma,
+                'background': bkg}
+    return {'amplitude1': signal / 2, 'tau1': tau / 3, 'amplitude2': signal / 2,
+            'tau2': 2 * tau, 't0': t0, 'sigma': sigma, 'background': bkg}
+
+
+def _fisher_errors(params, edges, model, fixed, tail=False) -> _np.ndarray:
+    """Standard errors from the inverse Fisher information J^T diag(1/mu) J."""
+    mu, jac = _decay_model(params, edges, model, True, tail)
+    free = ~_np.array(fixed, dtype=bool)
+    errors = _np.zeros(len(params))
+    j = jac[:, free]
+    info = j.T @ (j / _np.maximum(mu, 1E-300)[:, None])
+    try:
+        errors[free] = _np.sqrt(_np.abs(_np.diag(_np.linalg.inv(info))))
+    except _np.linalg.LinAlgError:
+        errors[free] = _np.nan
+    return errors
+
+
+def window_histograms(times: _np.ndarray, microtimes: _np.ndarray,
+                      starts: _np.ndarray, stops: _np.ndarray,
+                      edges: _np.ndarray) -> _np.ndarray:
+    """Histogram the microtimes of the photons in each time window.
+
+    Parameters
+    ----------
+    times : numpy.ndarray
+        Sorted macro-times
+    microtimes : numpy.ndarray
+        Microtimes of the photons
+    starts, stops : numpy.ndarray
+        (W,) window limits (exclusive, see `tools.analysis.window_bounds`)
+    edges : numpy.ndarray
+        (B + 1,) microtime bin edges
+
+    Returns
+    -------
+    numpy.ndarray
+        (W, B) array of counts
+    """
+    lo, hi = window_bounds(times, _np.asarray(starts, dtype=float),
+                           _np.asarray(stops, dtype=float))
+    W, B = len(lo), len(edges) - 1
+    hist = _np.zeros((W, B), dtype=_np.int64)
+    if not W:
+        return hist
+    if _np.all(lo[1:] >= hi[:-1]):
+        segments = [window_labels(lo, hi)]
+    else:
+        segments = [(_np.full((h - l,), w), _np.arange(l, h))
+                    for w, (l, h) in enumerate(zip(lo, hi))]
+    for labels, idx in segments:
+        b = _np.searchsorted(edges, microtimes[idx], 'right') - 1
+        valid = (b >= 0) & (b < B)
+        hist += _np.bincount(labels[valid] * B + b[valid],
+                             minlength=W * B).reshape(W, B)
+    return hist
+
+
+def _normalized(c, dc=None):
+    """Normalize rows of c (and the derivative dc accordingly)."""
+    C = c.sum(axis=1, keepdims=True)
+    if dc is None:
+        return c / C
+    return c / C, (dc * C - c * dc.sum(axis=1, keepdims=True)) / C ** 2
+
+
+def _window_shapes(taus: _np.ndarray, edges: _np.ndarray, t0: float,
+                   sigma: float, bkg_fraction: float, tail_fraction: float = 0.,
+                   derivative: bool = False):
+    """Normalized bin probabilities (and d/dtau) for each lifetime in `taus`."""
+    taus = taus[:, None]
+    uniform = _np.diff(edges) / (edges[-1] - edges[0])
+    decay_fraction = 1 - bkg_fraction - tail_fraction
+    if derivative:
+        F, d_tau, _, _ = _emg_cdf(edges, taus, t0, sigma, True)
+        c, dc = _normalized(_np.maximum(_np.diff(F, axis=1), 1E-300),
+                            _np.diff(d_tau, axis=1))
+        dm = decay_fraction * dc
+    else:
+        c = _normalized(_np.maximum(_np.diff(_emg_cdf(edges, taus, t0, sigma), axis=1),
+                                    1E-300))
+    m = decay_fraction * c + bkg_fraction * uniform
+    if tail_fraction:
+        if derivative:
+            G, dG = _tail_cdf(edges, taus, True)
+            g, dg = _normalized(_np.diff(G, axis=1), _np.diff(dG, axis=1))
+            dm = dm + tail_fraction * dg
+        else:
+            g = _normalized(_np.diff(_tail_cdf(edges, taus), axis=1))
+        m = m + tail_fraction * g
+    if not derivative:
+        return m
+    return m, dm
+
+
+def window_lifetimes(counts: _np.ndarray, edges: _np.ndarray, t0: float,
+                     sigma: float, bkg_fraction: float = 0.,
+                     tail_fraction: float = 0., tau_range: _Tuple[float, float] = (0.05, 20.),
+                     n_grid: int = 200, n_iter: int = 20
+                     ) -> _Tuple[_np.ndarray, _np.ndarray]:
+    """Lifetime of many windows at once, by Poisson MLE.
+
+    The IRF (t0, sigma) and the background and tail (see `fit_decay`)
+    fractions are shared. The amplitude
+    of each window is profiled out (its MLE is the number of photons), so
+    only the lifetime is fitted: first on a logarithmic grid of lifetimes
+    (a single matrix product for all windows), then refined by bisection of
+    the analytical derivative of the log-likelihood, for all windows at once.
+
+    Parameters
+    ----------
+    counts : numpy.ndarray
+        (W, B) histograms (see `window_histograms`)
+    edges : numpy.ndarray
+        (B + 1,) bin edges
+    t0, sigma : float
+        IRF position and width, e.g. from `fit_decay`
+    bkg_fraction : float, default 0.
+        Fraction of the photons due to uniform background
+    tail_fraction : float, default 0.
+        Fraction of the photons due to previous pulses, e.g.
+        `DecayFit.tail_fraction`
+    tau_range : tuple of float, default (0.05, 20.)
+        Range of lifetimes searched
+    n_grid : int, default 200
+        Number of lifetimes in the initial grid
+    n_iter : int, default 20
+        Bisection iterations
+
+    Returns
+    -------
+    taus, errors : numpy.ndarray
+        (W,) lifetimes and their standard errors (from the Fisher
+        information). NaN for windows without photons.
+    """
+    counts = _np.atleast_2d(_np.asarray(counts, dtype=float))
+    edges = _np.asarray(edges, dtype=float)
+    grid = _np.geomspace(*tau_range, n_grid)
+    log_m = _np.log(_window_shapes(grid, edges, t0, sigma, bkg_fraction,
+                                   tail_fraction))
+    best = _np.argmax(counts @ log_m.T, axis=1)
+    lo = grid[_np.maximum(best - 1, 0)]
+    hi = grid[_np.minimum(best + 1, n_grid - 1)]
+    for _ in range(n_iter):
+        mid = _np.sqrt(lo * hi)
+        m, dm = _window_shapes(mid, edges, t0, sigma, bkg_fraction,
+                               tail_fraction, True)
+        grad = _np.sum(counts * dm / m, axis=1)  # d logL / d tau
+        rising = grad > 0
+        lo = _np.where(rising, mid, lo)
+        hi = _np.where(rising, hi, mid)
+    taus = _np.sqrt(lo * hi)
+    m, dm = _window_shapes(taus, edges, t0, sigma, bkg_fraction,
+                           tail_fraction, True)
+    n = counts.sum(axis=1)
+    info = n * _np.sum(dm ** 2 / m, axis=1)
+    with _np.errstate(divide='ignore', invalid='ignore'):
+        errors = 1. / _np.sqrt(info)
+    empty = n == 0
+    taus[empty] = _np.nan
+    errors[empty] = _np.nan
+    return taus, errors
+
+
+@_dataclass
+class IPTFit:
+    """Two-state fit of the inter-photon times (see `fit_ipt`)."""
+
+    rate_on: float  # photon rate in ON state
+    rate_off: float  # photon rate in OFF state (background)
+    weight_on: float  # fraction of inter-photon times in ON state
+    edges: _np.ndarray
+    counts: _np.ndarray
+    nll: float
+
+    def expected(self) -> _np.ndarray:
+        """Expected counts in each bin of the fitted histogram."""
+        y = _np.array((_special.logit(self.weight_on), _np.log(self.rate_on),
+                       _np.log(self.rate_off)))
+        return self.counts.sum() * _ipt_probabilities(y, self.edges)
+
+    @property
+    def time_fraction_on(self) -> float:
+        """Fraction of the time spent in ON state."""
+        t_on = self.weight_on / self.rate_on
+        t_off = (1 - self.weight_on) / self.rate_off
+        return t_on / (t_on + t_off)
+
+
+def _ipt_probabilities(y: _np.ndarray, edges: _np.ndarray, jacobian: bool = False):
+    """Bin probabilities of a bi-exponential mixture, normalized in range.
+
+    `y` holds logit(weight) and the logs of both rates.
+    """
+    w = _special.expit(y[0])
+    k = _np.exp(y[1:3])
+    a, b = edges[:-1], edges[1:]
+    ea = _np.exp(-k[:, None] * a)
+    eb = _np.exp(-k[:, None] * b)
+    D = ea - eb
+    P = w * D[0] + (1 - w) * D[1]
+    S = P.sum()
+    p = _np.maximum(P / S, 1E-300)
+    if not jacobian:
+        return p
+    dP = _np.empty((3, len(P)))
+    dP[0] = w * (1 - w) * (D[0] - D[1])
+    dD = (-a * ea + b * eb) * k[:, None]  # d/dlog(k)
+    dP[1] = w * dD[0]
+    dP[2] = (1 - w) * dD[1]
+    dp = (dP * S - P * dP.sum(axis=1, keepdims=True)) / S ** 2
+    return p, dp
+
+
+def fit_ipt(times: _np.ndarray, n_bins: int = 100) -> IPTFit:
+    """Fit the inter-photon time distribution with two exponentials.
+
+    The distribution of the times between consecutive photons is fitted
+    (multinomial MLE on a logarithmically binned histogram) with a mixture
+    of two exponentials, whose rates are the photon rates in the ON and OFF
+    (background) states.
+
+    Parameters
+    ----------
+    times : numpy.ndarray
+        Sorted macro-times of the photons
+    n_bins : int, default 100
+        Number of logarithmic bins
+
+    Returns
+    -------
+    IPTFit
+    """
+    ipt = _np.diff(times)
+    ipt = ipt[ipt > 0]
+    if len(ipt) < 10:
+        raise ValueError("Not enough photons")
+    edges = _np.geomspace(ipt.min(), ipt.max() * (1 + 1E-9), n_bins + 1)
+    counts = _np.histogram(ipt, edges)[0].astype(float)
+    mean = ipt.mean()
+    y0 = _np.array((0., _np.log(4 / mean), _np.log(0.25 / mean)))
+
+    def nll_and_grad(y):
+        p, dp = _ipt_probabilities(y, edges, True)
+        return -counts @ _np.log(p), -(dp / p) @ counts
+
+    result = _opt.minimize(nll_and_grad, y0, jac=True, method='L-BFGS-B')
+    w = float(_special.expit(result.x[0]))
+    k1, k2 = _np.exp(result.x[1:3])
+    if k1 < k2:
+        k1, k2, w = k2, k1, 1 - w
+    return IPTFit(float(k1), float(k2), w, edges, counts, float(result.fun))
+
+
+def segmentation_threshold(times: _np.ndarray, bin_widths: _Optional[_np.ndarray] = None,
+                           max_error: float = 1E-6, fit: _Optional[IPTFit] = None
+                           ) -> _Tuple[int, float, float]:
+    """Choose bin width and threshold to split a time trace in ON and OFF.
+
+    A bin of the trace is ON if it holds more than `threshold` photons. With
+    the rates and time fractions from `fit_ipt`, the fraction of wrongly
+    classified bins is computed (Poisson counts) for every threshold. The
+    shortest bin width for which it is below `max_error` is chosen, or the
+    one with the smallest error if none is good enough.
+
+    Parameters
+    ----------
+    times : numpy.ndarray
+        Sorted macro-times of the photons
+    bin_widths : numpy.ndarray, optional
+        Candidate bin widths. Defaults to 50 widths between 2 and 200 ON
+        inter-photon times.
+    max_error : float, default 1E-6
+        Acceptable fraction of wrongly classified bins
+    fit : IPTFit, optional
+        Use this fit instead of fitting `times`
+
+    Returns
+    -------
+    threshold : int
+    bin_width : float
+    error : float
+        Expected fraction of wrongly classified bins
+    """
+    if fit is None:
+        fit = fit_ipt(times)
+    if bin_widths is None:
+        bin_widths = _np.geomspace(2, 200, 50) / fit.rate_on
+    f_on = fit.time_fraction_on
+    best = None
+    for bw in _np.sort(bin_widths):
+        n = _np.arange(int(_np.ceil(fit.rate_on * bw * 2)) + 10)
+        error = (f_on * _stats.poisson.cdf(n, fit.rate_on * bw)
+                 + (1 - f_on) * _stats.poisson.sf(n, fit.rate_off * bw))
+        T = int(_np.argmin(error))
+        if best is None or error[T] < best[2]:
+            best = (T, float(bw), float(error[T]))
+        if error[T] <= max_error:
+            return T, float(bw), float(error[T])
+    _lgr.info("No bin width gives an error below %s", max_error)
+    return best
+
+
+if __name__ == '__main__':
+    import time as _time
+    rng = _np.random.default_rng(0)
+    # Decay: tau 3.5 ns, IRF at 2 ns (sigma 0.15 ns), 2% background
+    true = {'amplitude': 2E5, 'tau': 3.5, 't0': 2., 'sigma': 0.15, 'background': 0.}
+    edges = log_bins(1., 12.5, 64, 0.02)
+    n_bkg = int(0.02 * true['amplitude'])
+    photons = _np.concatenate((
+        true['t0'] + rng.normal(0, true['sigma'], int(true['amplitude']))
+        + rng.exponential(true['tau'], int(true['amplitude'])),
+        rng.uniform(edges[0], edges[-1], n_bkg)))
+    counts = _np.histogram(photons, edges)[0]
+    t = _time.perf_counter()
+    result = fit_decay(counts, edges)
+    print(f"mono fit ({(_time.perf_counter() - t) * 1E3:.0f} ms):",
+          {k: f"{v:.4g} +- {result.errors[k]:.2g}" for k, v in result.params.items()})
+    bi = fit_decay(counts, edges, 'bi')
+    print(f"bi fit: mean tau {bi.mean_tau:.3f}, nll {bi.nll:.1f} (mono: {result.nll:.1f})")
+    # Windows of 200 photons each
+    W, n_ph = 5000, 200
+    taus = rng.uniform(2., 5., W)
+    hist = _np.array([_np.histogram(
+        true['t0'] + rng.normal(0, true['sigma'], n_ph) + rng.exponential(tau, n_ph),
+        edges)[0] for tau in taus])
+    t = _time.perf_counter()
+    est, err = window_lifetimes(hist, edges, result.params['t0'],
+                                result.params['sigma'], result.background_fraction)
+    print(f"{W} windows in {(_time.perf_counter() - t) * 1E3:.0f} ms: "
+          f"mean bias {_np.mean(est - taus):.3f} ns, "
+          f"pull std {_np.std((est - taus) / err):.2f}")
+    # Blinking trace: ON 20 kHz, OFF 500 Hz
+    segments = []
+    t_now = 0.
+    for i in range(200):
+        rate, length = (2E4, rng.exponential(0.05)) if i % 2 else (500., rng.exponential(0.1))
+        n = rng.poisson(rate * length)
+        segments.append(t_now + _np.sort(rng.uniform(0, length, n)))
+        t_now += length
+    trace = _np.concatenate(segments)
+    ipt = fit_ipt(trace)
+    print(f"IPT fit: on {ipt.rate_on:.0f} Hz, off {ipt.rate_off:.0f} Hz, "
+          f"ON time fraction {ipt.time_fraction_on:.2f}")
+    print("threshold, bin width, error:", segmentation_threshold(trace, fit=ipt))
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Content addressed cache for PSF fits
+
+Fitting the experimental PSFs (interpolation, drift correction and polynomial
+fit) takes minutes. The results are stored in .npz files named after a hash of
+everything the fit depends on (PSF data, drift data and parameters), so they
+are invalidated automatically when any input changes.
+
+Use
+---
+>>> key = make_key(psf=array_digest(psf), drift=file_digest(drift_file), px=1.)
+>>> cache = PSFCache.for_file(psf_file)
+>>> data = cache.load(key)
+>>> if data is None:
+...     data = {'PSF': fit(psf)}
+...     cache.store(key, **data)
+
+@author: azelcer
+"""
+
+import os as _os
+import json as _json
+import hashlib as _hashlib
+import tempfile as _tempfile
+import logging as _lgn
+import numpy as _np
+from typing import Optional as _Optional, Dict as _Dict
+
+_lgr = _lgn.getLogger(__name__)
+
+# Bump when the fitting procedure or the stored fields change
+_FORMAT_VERSION = 3
+_CACHE_DIRNAME = '.psf_cache'
+_CHUNK_SIZE = 1 << 20
+
+
+def file_digest(filename: str) -> str:
+    """Return the SHA-256 hex digest of a file contents."""
+    h = _hashlib.sha256()
+    with open(filename, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def array_digest(array: _np.ndarray) -> str:
+    """Return the SHA-256 hex digest of an array (data, shape and dtype)."""
+    array = _np.ascontiguousarray(array)
+    h = _hashlib.sha256(f"{array.dtype.str}{array.shape}".encode())
+    h.update(array.data)
+    return h.hexdigest()
+
+
+def make_key(**parts) -> str:
+    """Build a cache key from digests and (JSON serializable) parameters."""
+    parts['_version'] = _FORMAT_VERSION
+    text = _json.dumps(parts, sort_keys=True, default=float)
+    return _hashlib.sha256(text.encode()).hexdigest()
+
+
+class PSFCache:
+    """Directory of cached PSF fits, one .npz file per key."""
+
+    def __init__(self, directory: str):
+        """Init cache.
+
+        Parameters
+        ----------
+        directory: str
+            Where the cached fits are stored. Created on first store.
+        """
+        self.directory = directory
+
+    @classmethod
+    def for_file(cls, filename: str) -> 'PSFCache':
+        """Return the cache kept next to a data file."""
+        return cls(_os.path.join(_os.path.dirname(_os.path.abspath(filename)),
+                                 _CACHE_DIRNAME))
+
+    def path(self, key: str) -> str:
+        """Return the file name used for a key."""
+        return _os.path.join(self.directory, key + '.npz')
+
+    def __contains__(self, key: str) -> bool:
+        return _os.path.isfile(self.path(key))
+
+    def load(self, key: str) -> _Optional[_Dict[str, _np.ndarray]]:
+        """Return the arrays stored for a key, or None if not cached.
+
+        Unreadable entries are removed.
+        """
+        filename = self.path(key)
+        if not _os.path.isfile(filename):
+            return None
+        try:
+            with _np.load(filename, allow_pickle=False) as data:
+                return {name: data[name] for name in data.files}
+        except Exception as e:
+            _lgr.warning("Removing invalid PSF cache entry %s: %s", filename, e)
+            try:
+                _os.remove(filename)
+            except OSError:
+                pass
+            return None
+
+    def store(self, key: str, **arrays):
+        """Store arrays for a key.
+
+        The file is written under a temporary name and then renamed, so
+        readers never see a partial entry. Errors are logged, not raised.
+        """
+        tmp_name = None
+        try:
+            _os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_name = _tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            with _os.fdopen(fd, 'wb') as f:
+                _np.savez(f, **arrays)
+            _os.replace(tmp_name, self.path(key))
+        except OSError as e:
+            _lgr.warning("Can not store PSF cache entry: %s", e)
+            if tmp_name is not None and _os.path.exists(tmp_name):
+                _os.remove(tmp_name)
+
+    def clear(self):
+        """Remove every cached entry."""
+        if not _os.path.isdir(self.directory):
+            return
+        for name in _os.listdir(self.directory):
+            if name.endswith(('.npz', '.tmp')):
+                _os.remove(_os.path.join(self.directory, name))
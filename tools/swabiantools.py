@@ -5,7 +5,11 @@ from typing import Union, List, Tuple
 from enum import Enum
 from dataclasses import dataclass as _dataclass
 import pathlib as _pathlib
-from numba import njit
+import configparser as _configparser
+import logging as _lgn
+from tools.gating import delay_tags as _delay_tags
+
+_lgr = _lgn.getLogger(__name__)
 
 class SignalEdgeEnum(Enum):
     RISEEDGE = 1
@@ -193,52 +197,43 @@ def set_channel_level(
     tagger.setTriggerLevel(channel, level_type.value.trigger_voltage)
 
 
-@njit
+def _as_channels(APD_channels: Union[int, _Sequence[int]]) -> _np.ndarray:
+    """Return detector channels as an array, accepting a single channel."""
+    return _np.atleast_1d(_np.asarray(APD_channels, dtype=_np.int64))
+
+
 def time_tags2delays(timestamps: _np.ndarray, channels: _np.ndarray,
-                     overflow_types: _np.ndarray, APD_channel: int,
+                     overflow_types: _np.ndarray,
+                     APD_channels: Union[int, _Sequence[int]],
                      laser_channel: int, pixel_channel: int, period: int,
-                     last_timestamp: int,
-                     ):
-    """calculate ."""
-    # last_timestamp = 0  # Puede ser que perdamos info, ponerlo en errors[1]
-    n_errors = 0
-    last_pos = 0
+                     last_timestamps: _np.ndarray = None,
+                     ) -> Tuple[_np.ndarray, _np.ndarray]:
+    """Convert time tags into (channel, abs_time, micro_time) records.
+
+    See `tools.gating.delay_tags`. `last_timestamps` keeps the last unpaired
+    photon of each detector between blocks: pass the returned value with the
+    next block.
+
+    Returns
+    -------
+    The (n, 3) records and the updated last timestamps.
+    """
+    APD_channels = _as_channels(APD_channels)
+    if last_timestamps is None:
+        last_timestamps = _np.zeros(APD_channels.shape, dtype=_np.int64)
     rv = _np.empty((len(timestamps), 3,), dtype=_np.int64)
-    for ts, chan, type_ in zip(timestamps, channels, overflow_types):
-        # tag.type can be: 0 - TimeTag, 1- Error, 2 - OverflowBegin, 3 -
-        # OverflowEnd, 4 - MissedEvents (you can use the TimeTagger.TagType IntEnum)
-        if type_ != 0:
-            # tag is not a TimeTag, so we are in an error state, e.g. overflow
-            last_timestamp = 0
-            n_errors += 1
-        elif (chan == laser_channel) and (last_timestamp != 0):
-            # valid event
-            rv[last_pos, 0] = APD_channel
-            rv[last_pos, 2] = period + last_timestamp
-            rv[last_pos, 2] -= ts
-            if rv[last_pos, 2] < 0:
-                rv[last_pos, 2] += period
-            if rv[last_pos, 2] < 0:
-                # print("Tiempo negativo", rv[last_pos]/period, ts, last_timestamp)
-                ...
-            rv[last_pos, 1] = ts
-            last_pos += 1
-        elif chan == APD_channel:
-            last_timestamp = ts
-        elif chan == pixel_channel:
-            rv[last_pos, 0] = pixel_channel
-            rv[last_pos, 1] = ts
-            rv[last_pos, 2] = 0
-            last_pos += 1
-        else:
-            # print("unknown channel")
-            n_errors += 1
+    n_records, n_errors = _delay_tags(timestamps, channels, overflow_types,
+                                      laser_channel, APD_channels,
+                                      pixel_channel, period, last_timestamps,
+                                      rv)
     if n_errors:
-        print("errores = ", n_errors)
-    return rv[:last_pos], last_timestamp
+        _lgr.warning("%s time tags with errors or from unknown channels", n_errors)
+    return rv[:n_records], last_timestamps
 
 
-def swabian2numpy(filename: str, period: int, APD_channel: int, laser_channel: int, pixel_channel: int):
+def swabian2numpy(filename: str, period: int,
+                  APD_channels: Union[int, _Sequence[int]],
+                  laser_channel: int, pixel_channel: int):
     """Extrae info de un archivo de swabian y lo graba en uno numpy."""
     # base_dir = _pathlib.Path.home() / "pMinflux_data"
     # base_dir.mkdir(parents=True, exist_ok=True)
@@ -252,7 +247,7 @@ def swabian2numpy(filename: str, period: int, APD_channel: int, laser_channel: i
     channels = []
     abs_times = []
     rel_times = []
-    lts = 0  # last timestamp
+    lts = None  # last timestamp of each detector
     while filereader.hasData():
         data = filereader.getData(n_events=n_events)
         channel = data.getChannels()            # The channel numbers
@@ -261,7 +256,8 @@ def swabian2numpy(filename: str, period: int, APD_channel: int, laser_channel: i
         missed_events = data.getMissedEvents()  # The numbers of missed events in case of overflow
         # Output to table
         rv, lts = time_tags2delays(timestamps, channel, overflow_types,
-                                      APD_channel, laser_channel, pixel_channel, period, lts)
+                                   APD_channels, laser_channel, pixel_channel,
+                                   period, lts)
         channels.append(rv[:,0])
         abs_times.append(rv[:,1])
         rel_times.append(rv[:,2])
@@ -276,6 +272,223 @@ def swabian2numpy(filename: str, period: int, APD_channel: int, laser_channel: i
         )
 
 
+# Columnar store layout: one raw file per column plus a chunk index and metadata
+_COLUMNS = (
+    ("channel", _np.int8),
+    ("abs_time", _np.int64),
+    ("micro_time", _np.int32),
+)
+_INDEX_FILENAME = "chunks.npy"
+_META_FILENAME = "meta.ini"
+
+
+class _GrowableColumn:
+    """Memory mapped column backed by a raw file that grows on demand."""
+
+    def __init__(self, filename: _pathlib.Path, dtype, capacity: int):
+        self._filename = filename
+        self._dtype = _np.dtype(dtype)
+        self._fd = open(filename, "w+b")
+        self._size = 0
+        self._capacity = 0
+        self._mm = None
+        self._resize(max(int(capacity), 1))
+
+    def _resize(self, capacity: int):
+        if self._mm is not None:
+            self._mm.flush()
+            del self._mm
+        self._fd.truncate(capacity * self._dtype.itemsize)
+        self._capacity = capacity
+        self._mm = _np.memmap(self._fd, dtype=self._dtype, mode="r+",
+                              shape=(capacity,))
+
+    def append(self, values: _np.ndarray):
+        n = len(values)
+        if self._size + n > self._capacity:
+            self._resize(max(2 * self._capacity, self._size + n))
+        self._mm[self._size: self._size + n] = values
+        self._size += n
+
+    def flush(self):
+        """Write the mapped data to disk."""
+        if self._mm is not None:
+            self._mm.flush()
+
+    def close(self):
+        """Flush and trim the file to the actual size."""
+        if self._mm is not None:
+            self._mm.flush()
+            del self._mm
+            self._mm = None
+        self._fd.truncate(self._size * self._dtype.itemsize)
+        self._fd.close()
+
+
+class ColumnarWriter:
+    """Streaming writer of converted time tags in columnar format.
+
+    Columns are written in a directory as raw little endian files
+    (channel: int8, abs_time: int64, micro_time: int32), together with an
+    index of chunk offsets and first absolute times (`chunks.npy`) and a
+    metadata file (`meta.ini`). Use as a context manager.
+
+    Index and metadata are rewritten every `flush_every` chunks, after the
+    data, so the store can be read while it is being written and remains
+    readable (up to the last flush) if the conversion crashes. The metadata
+    `complete` entry tells if the writer was closed.
+    """
+
+    def __init__(self, path: Union[str, _pathlib.Path], capacity: int = int(5E6),
+                 flush_every: int = 1, **metadata):
+        self.path = _pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._columns = [
+            _GrowableColumn(self.path / (name + ".bin"), dtype, capacity)
+            for name, dtype in _COLUMNS
+        ]
+        self._chunks = []
+        self._n_records = 0
+        self._metadata = metadata
+        self._flush_every = max(int(flush_every), 1)
+        self._write_index(False)
+
+    def append(self, channels: _np.ndarray, abs_times: _np.ndarray,
+               micro_times: _np.ndarray):
+        """Append a chunk of records."""
+        n = len(abs_times)
+        if not n:
+            return
+        self._chunks.append((self._n_records, abs_times[0]))
+        for column, values in zip(self._columns, (channels, abs_times, micro_times)):
+            column.append(values)
+        self._n_records += n
+        if len(self._chunks) % self._flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        """Make the records written so far visible to readers."""
+        for column in self._columns:
+            column.flush()
+        self._write_index(False)
+
+    def _write_index(self, complete: bool):
+        """Write index and metadata, each replacing the old file at once."""
+        index_tmp = self.path / (_INDEX_FILENAME + ".tmp")
+        with open(index_tmp, "wb") as fd:
+            _np.save(fd, _np.array(self._chunks, dtype=_np.int64).reshape(-1, 2))
+        index_tmp.replace(self.path / _INDEX_FILENAME)
+        config = _configparser.ConfigParser()
+        config["Columns"] = {name: _np.dtype(dtype).str for name, dtype in _COLUMNS}
+        config["Data"] = {"n_records": self._n_records,
+                          "complete": "yes" if complete else "no",
+                          **{k: str(v) for k, v in self._metadata.items()}}
+        meta_tmp = self.path / (_META_FILENAME + ".tmp")
+        with open(meta_tmp, "wt") as fd:
+            config.write(fd)
+        meta_tmp.replace(self.path / _META_FILENAME)
+
+    def close(self):
+        """Finish writing: trim columns and write index and metadata."""
+        for column in self._columns:
+            column.close()
+        self._write_index(True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+class ColumnarReader:
+    """Read only, memory mapped access to a columnar store.
+
+    Attributes `channel`, `abs_time` and `micro_time` are memory mapped
+    arrays. Records are sorted by absolute time, so time ranges can be found
+    using the chunk index without touching most of the data.
+
+    A store that is still being written (or whose conversion crashed) can be
+    opened: it shows the records up to the writer's last flush, and
+    `complete` is False.
+    """
+
+    def __init__(self, path: Union[str, _pathlib.Path]):
+        self.path = _pathlib.Path(path)
+        config = _configparser.ConfigParser()
+        if not config.read(self.path / _META_FILENAME):
+            raise FileNotFoundError(self.path / _META_FILENAME)
+        self.metadata = dict(config["Data"])
+        self.n_records = config.getint("Data", "n_records")
+        self.complete = config.getboolean("Data", "complete", fallback=True)
+        for name, _ in _COLUMNS:
+            dtype = _np.dtype(config["Columns"][name])
+            if self.n_records:
+                column = _np.memmap(self.path / (name + ".bin"), dtype=dtype,
+                                    mode="r", shape=(self.n_records,))
+            else:
+                column = _np.empty((0,), dtype=dtype)
+            setattr(self, name, column)
+        chunks = _np.load(self.path / _INDEX_FILENAME)
+        # The index may be newer than the metadata while writing
+        self.chunks = chunks[chunks[:, 0] < self.n_records]
+
+    def __len__(self):
+        return self.n_records
+
+    def _search(self, t: int) -> int:
+        """Return the first record with abs_time >= t."""
+        c = _np.searchsorted(self.chunks[:, 1], t, side="right") - 1
+        if c < 0:
+            return 0
+        start = self.chunks[c, 0]
+        stop = self.chunks[c + 1, 0] if c + 1 < len(self.chunks) else self.n_records
+        return int(start + _np.searchsorted(self.abs_time[start:stop], t))
+
+    def time_slice(self, t_start: int, t_end: int) -> slice:
+        """Return the slice of records with t_start <= abs_time < t_end."""
+        return slice(self._search(t_start), self._search(t_end))
+
+    def read(self, t_start: int, t_end: int) -> Tuple[_np.ndarray, _np.ndarray, _np.ndarray]:
+        """Return (channel, abs_time, micro_time) views in a time range."""
+        s = self.time_slice(t_start, t_end)
+        return self.channel[s], self.abs_time[s], self.micro_time[s]
+
+
+def swabian2columns(filename: str, period: int,
+                    APD_channels: Union[int, _Sequence[int]],
+                    laser_channel: int, pixel_channel: int,
+                    out_path: str = None, n_events: int = int(5E6)) -> _pathlib.Path:
+    """Convert a swabian file into a columnar store, in chunks.
+
+    Memory use is bounded by the chunk size, whatever the file size. By
+    default the store is written in a directory named after the file.
+
+    Returns
+    -------
+    The path of the store, to be opened with `ColumnarReader`
+    """
+    original_filename = _pathlib.Path(filename)
+    if out_path is None:
+        out_path = original_filename.with_suffix('.cols')
+    filereader = _TimeTagger.FileReader(filename)
+    lts = None  # last timestamp of each detector
+    with ColumnarWriter(out_path, capacity=n_events, source=original_filename.name,
+                        period=period,
+                        APD_channels=','.join(str(c) for c in _as_channels(APD_channels)),
+                        laser_channel=laser_channel,
+                        pixel_channel=pixel_channel) as writer:
+        while filereader.hasData():
+            data = filereader.getData(n_events=n_events)
+            rv, lts = time_tags2delays(data.getTimestamps(), data.getChannels(),
+                                       data.getEventTypes(), APD_channels,
+                                       laser_channel, pixel_channel, period, lts)
+            writer.append(rv[:, 0].astype(_np.int8), rv[:, 1],
+                          rv[:, 2].astype(_np.int32))
+    return _pathlib.Path(out_path)
+
+
 if __name__ == "__main__":
     input_file = r"C:\Users\Minflux\Documents\PythonScripts\reading_swabian\filename.ttbin"
     input_file = r"C:\Users\Minflux\Documents\Andi\pyflux\lefilename.ttbin"